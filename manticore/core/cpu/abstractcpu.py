@@ -2,10 +2,13 @@ import inspect
 import logging
 import StringIO
 import string
+import struct
 
+from binascii import hexlify, unhexlify
 from functools import wraps
 from itertools import islice, imap
 
+import capstone
 import unicorn
 
 from .disasm import init_disassembler
@@ -18,6 +21,11 @@ from ...utils.event import Eventful
 logger = logging.getLogger(__name__)
 register_logger = logging.getLogger('{}.registers'.format(__name__))
 
+# Max number of straight-line instructions decoded into a block. Blocks are
+# only run when nobody hooks the individual instructions, listeners of
+# did_execute_block get the instructions of each block at once
+max_block_size = 64
+
 ###################################################################################
 # Exceptions
 
@@ -95,6 +103,24 @@ class ConcretizeArgument(CpuException):
 
 SANE_SIZES = {8, 16, 32, 64, 80, 128, 256}
 
+# struct formats of the little endian words
+_int_formats = {8: '<B', 16: '<H', 32: '<I', 64: '<Q'}
+
+
+def _int_to_bytes(value, size):
+    ''' Encodes a concrete int as size / 8 little endian bytes '''
+    value &= (1 << size) - 1
+    if size in _int_formats:
+        return struct.pack(_int_formats[size], value)
+    return unhexlify('%0*x' % (size // 4, value))[::-1]
+
+
+def _bytes_to_int(data, size):
+    ''' Decodes size / 8 little endian bytes from a buffer '''
+    if size in _int_formats:
+        return struct.unpack_from(_int_formats[size], data)[0]
+    return int(hexlify(str(data)[::-1]), 16)
+
 
 class Operand(object):
     """This class encapsulates how to access operands (regs/mem/immediates) for
@@ -443,8 +469,8 @@ class Cpu(Eventful):
     - stack_alias
     '''
 
-    _published_events = {'write_register', 'read_register', 'write_memory', 'read_memory', 'decode_instruction',
-                         'execute_instruction'}
+    _published_events = {'write_register', 'read_register', 'write_memory', 'read_memory', 'write_memory_range',
+                         'read_memory_range', 'decode_instruction', 'execute_instruction', 'execute_block'}
 
     def __init__(self, regfile, memory, **kwargs):
         assert isinstance(regfile, RegisterFile)
@@ -453,6 +479,7 @@ class Cpu(Eventful):
         self._regfile = regfile
         self._memory = memory
         self._instruction_cache = {}
+        self._block_cache = {}
         self._icount = 0
         self._last_pc = None
         if not hasattr(self, "disasm"):
@@ -583,7 +610,10 @@ class Cpu(Eventful):
         assert size in SANE_SIZES
         self._publish('will_write_memory', where, expression, size)
 
-        data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in xrange(0, size, 8)]
+        if isinstance(expression, (int, long)):
+            data = _int_to_bytes(expression, size)
+        else:
+            data = [Operators.CHR(Operators.EXTRACT(expression, offset, 8)) for offset in xrange(0, size, 8)]
         self._memory.write(where, data, force)
 
         self._publish('did_write_memory', where, expression, size)
@@ -603,38 +633,70 @@ class Cpu(Eventful):
         assert size in SANE_SIZES
         self._publish('will_read_memory', where, size)
 
-        data = self._memory.read(where, size / 8, force)
-        assert (8 * len(data)) == size
-        value = Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
+        data = self._memory.view(where, size / 8, force)
+        if data is not None:
+            value = _bytes_to_int(data, size)
+        else:
+            data = self._memory.read(where, size / 8, force)
+            assert (8 * len(data)) == size
+            value = Operators.CONCAT(size, *map(Operators.ORD, reversed(data)))
 
         self._publish('did_read_memory', where, value, size)
         return value
 
+    def _has_int_memory_subscribers(self, access):
+        ''' Whether someone listens to the per integer memory events '''
+        return self._subscribers('will_%s_memory' % access) or self._subscribers('did_%s_memory' % access)
+
     def write_bytes(self, where, data, force=False):
         '''
         Write a concrete or symbolic (or mixed) buffer to memory
 
+        The whole buffer is written at once and published as a single
+        write_memory_range event.
+
         :param int where: address to write to
         :param data: data to write
         :type data: str or list
         :param force: whether to ignore memory permissions
         '''
-        for i in xrange(len(data)):
-            self.write_int(where + i, Operators.ORD(data[i]), 8, force)
+        self._publish('will_write_memory_range', where, data)
+
+        if self._has_int_memory_subscribers('write'):
+            for i in xrange(len(data)):
+                self.write_int(where + i, Operators.ORD(data[i]), 8, force)
+        elif len(data):
+            if not isinstance(data, str):
+                data = map(Operators.CHR, data)
+            self._memory.write(where, data, force)
+
+        self._publish('did_write_memory_range', where, data)
 
     def read_bytes(self, where, size, force=False):
         '''
         Read from memory.
 
+        The whole buffer is read at once and published as a single
+        read_memory_range event.
+
         :param int where: address to read data from
         :param int size: number of bytes
         :param force: whether to ignore memory permissions
         :return: data
         :rtype: list[int or Expression]
         '''
-        result = []
-        for i in xrange(size):
-            result.append(Operators.CHR(self.read_int(where + i, 8, force)))
+        self._publish('will_read_memory_range', where, size)
+
+        if self._has_int_memory_subscribers('read'):
+            result = []
+            for i in xrange(size):
+                result.append(Operators.CHR(self.read_int(where + i, 8, force)))
+        elif size:
+            result = self._memory.read(where, size, force)
+        else:
+            result = []
+
+        self._publish('did_read_memory_range', where, result)
         return result
 
     def write_string(self, where, string, max_length=None, force=False):
@@ -666,18 +728,22 @@ class Cpu(Eventful):
         :rtype: str
         '''
         s = StringIO.StringIO()
-        while True:
-            c = self.read_int(where, 8, force)
-
-            if issymbolic(c) or c == 0:
-                break
-
+        page_size = self._memory.page_size
+        bytewise = self._has_int_memory_subscribers('read')
+        while max_length is None or max_length > 0:
+            # Read up to the end of the page, it is mapped as a whole
+            if bytewise or issymbolic(where):
+                size = 1
+            else:
+                size = page_size - (where & (page_size - 1))
             if max_length is not None:
-                if max_length == 0:
-                    break
-                max_length = max_length - 1
-            s.write(Operators.CHR(c))
-            where += 1
+                size = min(size, max_length)
+                max_length -= size
+            for c in self.read_bytes(where, size, force):
+                if issymbolic(c) or c == '\x00':
+                    return s.getvalue()
+                s.write(c)
+            where += size
         return s.getvalue()
 
     def push_bytes(self, data, force=False):
@@ -743,32 +809,38 @@ class Cpu(Eventful):
 
         :param int pc: address of the instruction
         '''
-        # No dynamic code!!! #TODO!
         # Check if instruction was already decoded
+        self._forget_stale_code()
         if pc in self._instruction_cache:
             return self._instruction_cache[pc]
 
         text = ''
-        # Read Instruction from memory
-        for address in xrange(pc, pc + self.max_instr_width):
-            # This reads a byte from memory ignoring permissions
-            # and concretize it if symbolic
-            if not self.memory.access_ok(address, 'x'):
-                break
+        # Read Instruction from memory, one executable map at a time
+        address = pc
+        stop = pc + self.max_instr_width
+        while address < stop and self.memory.access_ok(address, 'x'):
+            end = min(self.memory.map_containing(address).end, stop)
+            # This reads from memory ignoring permissions
+            chunk = self.memory.view(address, end - address, force=True)
+            if chunk is not None:
+                text += str(chunk)
+                address = end
+                continue
 
-            c = self.memory[address]
-
-            if issymbolic(c):
-                assert isinstance(c, BitVec) and c.size == 8
-                if isinstance(c, Constant):
-                    c = chr(c.value)
-                else:
-                    logger.error('Concretize executable memory %r %r', c, text)
-                    raise ConcretizeMemory(self.memory,
-                                           address=pc,
-                                           size=8 * self.max_instr_width,
-                                           policy='INSTRUCTION')
-            text += c
+            # and concretize it if symbolic
+            for c in self.memory.read(address, end - address, force=True):
+                if issymbolic(c):
+                    assert isinstance(c, BitVec) and c.size == 8
+                    if isinstance(c, Constant):
+                        c = chr(c.value)
+                    else:
+                        logger.error('Concretize executable memory %r %r', c, text)
+                        raise ConcretizeMemory(self.memory,
+                                               address=pc,
+                                               size=8 * self.max_instr_width,
+                                               policy='INSTRUCTION')
+                text += c
+            address = end
 
         # Pad potentially incomplete instruction with zeroes
 
@@ -787,8 +859,32 @@ class Cpu(Eventful):
 
         insn.operands = self._wrap_operands(insn.operands)
         self._instruction_cache[pc] = insn
+        # Decoded again once its bytes are written or remapped
+        self.memory.watch_code(pc, pc + insn.size)
         return insn
 
+    def _forget_stale_code(self):
+        '''
+        Drops the decoded instructions and blocks overlapping the code pages
+        written or remapped since the last call
+        '''
+        stale = self.memory.stale_code()
+        if not stale:
+            return
+
+        bits = self.memory.page_bit_size
+
+        def overlaps(start, stop):
+            return any(page in stale for page in xrange(start >> bits, ((stop - 1) >> bits) + 1))
+
+        for pc, insn in self._instruction_cache.items():
+            if overlaps(pc, pc + insn.size):
+                del self._instruction_cache[pc]
+        for pc, block in self._block_cache.items():
+            last = block[-1][0]
+            if overlaps(pc, last.address + last.size):
+                del self._block_cache[pc]
+
     @property
     def instruction(self):
         if self._last_pc is None:
@@ -850,6 +946,94 @@ class Cpu(Eventful):
         else:
             self._publish_instruction_as_executed(insn)
 
+    def _hooked(self):
+        ''' True if something has to see every single instruction '''
+        if logger.level == logging.DEBUG:
+            return True
+        return any(self._subscribers(name) for name in ('will_decode_instruction',
+                                                        'will_execute_instruction',
+                                                        'did_execute_instruction'))
+
+    def _ends_block(self, insn):
+        return any(insn.group(group) for group in (capstone.CS_GRP_JUMP, capstone.CS_GRP_CALL,
+                                                   capstone.CS_GRP_RET, capstone.CS_GRP_INT,
+                                                   capstone.CS_GRP_IRET))
+
+    def decode_block(self, pc):
+        '''
+        Decode the straight-line run of instructions starting at `pc`, up to
+        the first control flow instruction or `max_block_size` instructions
+
+        :param int pc: address of the first instruction
+        :return: tuple of (instruction, implementation or None)
+        '''
+        self._forget_stale_code()
+        block = self._block_cache.get(pc)
+        if block is not None:
+            return block
+
+        block = []
+        address = pc
+        while len(block) < max_block_size:
+            try:
+                insn = self.decode_instruction(address)
+            except (DecodeException, InvalidMemoryAccess, ConcretizeMemory):
+                # Let single stepping hit it
+                if not block:
+                    raise
+                break
+            name = self.canonicalize_instruction_name(insn)
+            block.append((insn, getattr(type(self), name, None)))
+            if self._ends_block(insn):
+                break
+            address += insn.size
+
+        block = self._block_cache[pc] = tuple(block)
+        return block
+
+    def execute_block(self):
+        '''
+        Decode, and execute the block of instructions pointed by register PC
+        until its end or until an instruction does not fall through to the
+        next one. Executes a single instruction if something hooks them.
+
+        Publishes did_execute_block with the addresses of the instructions
+        executed and the resulting PC, also when one of them raises.
+        '''
+        pc = self.PC
+        if issymbolic(pc) or self._hooked() or not self.memory.access_ok(pc, 'x'):
+            return self.execute()
+
+        block = self.decode_block(pc)
+        last = block[-1][0]
+        if not self.memory.access_ok(slice(pc, last.address + last.size), 'x'):
+            return self.execute()
+
+        executed = []
+        try:
+            for insn, implementation in block:
+                self._last_pc = insn.address
+                try:
+                    if implementation is not None:
+                        implementation(self, *insn.operands)
+                    else:
+                        text_bytes = ' '.join('%02x' % x for x in insn.bytes)
+                        logger.info("Unimplemented instruction: 0x%016x:\t%s\t%s\t%s",
+                                    insn.address, text_bytes, insn.mnemonic, insn.op_str)
+                        self.emulate(insn)
+                except (Interruption, Syscall) as e:
+                    e.on_handled = lambda: self._publish_instruction_as_executed(insn)
+                    raise e
+                self._icount += 1
+                executed.append(insn.address)
+
+                pc = self.PC
+                if issymbolic(pc) or pc != insn.address + insn.size:
+                    break
+        finally:
+            if executed:
+                self._publish('did_execute_block', tuple(executed), pc)
+
     # FIXME(yan): In the case the instruction implementation invokes a system call, we would not be able to
     # publish the did_execute_instruction event from here, so we capture and attach it to the syscall
     # exception for the platform to emit it for us once the syscall has successfully been executed.
@@ -859,6 +1043,7 @@ class Cpu(Eventful):
         '''
         self._icount += 1
         self._publish('did_execute_instruction', self._last_pc, self.PC, insn)
+        self._publish('did_execute_block', (self._last_pc,), self.PC)
 
     def emulate(self, insn):
         '''
@@ -465,6 +465,10 @@ class BinjaCpu(Cpu):
         self._icount += 1
         self._publish('did_execute_instruction', insn)
 
+    def execute_block(self):
+        ''' IL instructions are executed one at a time '''
+        self.execute()
+
     def update_platform_cpu_regs(self):
         for pl_reg, binja_reg in self.regfile.pl2b_map.items():
             if isinstance(binja_reg, tuple) or binja_reg is None:
@@ -18,6 +18,10 @@ from functools import reduce
 
 logger = logging.getLogger(__name__)
 
+# Record the result and operands of the common flag producing instructions
+# and compute each status flag only when it is read
+lazy_flags = True
+
 OP_NAME_MAP = {
     'JNE': 'JNZ',
     'JE': 'JZ',
@@ -117,6 +121,75 @@ def repe(old_method):
             old_method(cpu, *args, **kw_args)
     return new_method
 
+###############################################################################
+# status flags
+
+
+def _parity_flag(res):
+    return (res ^ res >> 1 ^ res >> 2 ^ res >> 3 ^ res >> 4 ^ res >> 5 ^ res >> 6 ^ res >> 7) & 1 == 0
+
+
+def _add_carry_flag(size, res, arg0, arg1):
+    MASK = (1 << size) - 1
+    return Operators.OR(Operators.ULT(res, arg0 & MASK), Operators.ULT(res, arg1 & MASK))
+
+
+def _sub_carry_flag(size, res, arg0, arg1):
+    return Operators.ULT(arg0, arg1)
+
+
+def _adjust_flag(size, res, arg0, arg1):
+    return ((arg0 ^ arg1) ^ res) & 0x10 != 0
+
+
+def _zero_flag(size, res, arg0, arg1):
+    return res == 0
+
+
+def _sign_flag(size, res, arg0, arg1):
+    return (res & (1 << (size - 1))) != 0
+
+
+def _add_overflow_flag(size, res, arg0, arg1):
+    SIGN_MASK = 1 << (size - 1)
+    return (((arg0 ^ arg1 ^ SIGN_MASK) & (res ^ arg1)) & SIGN_MASK) != 0
+
+
+def _sub_overflow_flag(size, res, arg0, arg1):
+    SIGN_MASK = 1 << (size - 1)
+    sign0 = (arg0 & SIGN_MASK) == SIGN_MASK
+    sign1 = (arg1 & SIGN_MASK) == SIGN_MASK
+    signr = (res & SIGN_MASK) == SIGN_MASK
+    return Operators.AND(sign0 ^ sign1, sign0 ^ signr)
+
+
+def _step_overflow_flag(size, res, arg0, arg1):
+    return res == 1 << (size - 1)
+
+
+def _cleared_flag(size, res, arg0, arg1):
+    return False
+
+
+def _parity_flag_of(size, res, arg0, arg1):
+    return _parity_flag(res)
+
+
+_status_flags = ('CF', 'AF', 'ZF', 'SF', 'OF', 'PF')
+
+# How each kind of operation computes the status flags it sets
+# from its operand size, result and operands
+_flag_functions = {
+    'ADD': {'CF': _add_carry_flag, 'AF': _adjust_flag, 'ZF': _zero_flag,
+            'SF': _sign_flag, 'OF': _add_overflow_flag, 'PF': _parity_flag_of},
+    'SUB': {'CF': _sub_carry_flag, 'AF': _adjust_flag, 'ZF': _zero_flag,
+            'SF': _sign_flag, 'OF': _sub_overflow_flag, 'PF': _parity_flag_of},
+    'STEP': {'AF': _adjust_flag, 'ZF': _zero_flag, 'SF': _sign_flag,
+             'OF': _step_overflow_flag, 'PF': _parity_flag_of},
+    'LOGIC': {'CF': _cleared_flag, 'AF': _cleared_flag, 'ZF': _zero_flag,
+              'SF': _sign_flag, 'OF': _cleared_flag, 'PF': _parity_flag_of},
+}
+
 ###############################################################################
 # register/flag descriptors
 
@@ -451,6 +524,9 @@ class AMD64RegFile(RegisterFile):
             self._registers[reg] = 0
 
         self._cache = {}
+        # Flags not computed yet, mapped to the (kind, size, res, arg0, arg1)
+        # operation that set them
+        self._lazy_flags = {}
         for name in ('AF', 'CF', 'DF', 'IF', 'OF', 'PF', 'SF', 'ZF'):
             self.write(name, False)
 
@@ -506,13 +582,32 @@ class AMD64RegFile(RegisterFile):
                 raise TypeError
         if not isinstance(value, (bool, Bool)):
             value = (value != 0)
+        self._lazy_flags.pop(register_id, None)
         self._registers[register_id] = value
         return value
 
     def _get_flag(self, register_id, register_size, offset, size):
         assert size == 1
+        if register_id in self._lazy_flags:
+            self._compute_flag(register_id)
         return self._registers[register_id]
 
+    def defer_flags(self, flags, operation):
+        '''
+        Set flags to the result of operation, a (kind, size, res, arg0, arg1)
+        tuple, but compute each of them only once it is read
+        '''
+        lazy, cache = self._lazy_flags, self._cache
+        for flag in flags:
+            lazy[flag] = operation
+            cache.pop(flag, None)
+        cache.pop('EFLAGS', None)
+        cache.pop('RFLAGS', None)
+
+    def _compute_flag(self, flag):
+        kind, size, res, arg0, arg1 = self._lazy_flags[flag]
+        self._set_flag(flag, 1, 0, 1, False, _flag_functions[kind][flag](size, res, arg0, arg1))
+
     def _set_float(self, register_id, register_size, offset, size, reset, value):
         assert size == 80
         assert offset == 0
@@ -535,6 +630,9 @@ class AMD64RegFile(RegisterFile):
                                    BitVecConstant(register_size, 1 << offset),
                                    BitVecConstant(register_size, 0))
 
+        for flag in self._lazy_flags.keys():
+            self._compute_flag(flag)
+
         flags = []
         for flag, offset in self._flags.iteritems():
             flags.append((self._registers[flag], offset))
@@ -777,29 +875,30 @@ class X86Cpu(Cpu):
     # Instruction Implementations
     #
 
+    def _update_flags(self, kind, size, res, arg0=0, arg1=0, flags=_status_flags):
+        '''
+        Set the status flags a kind operation of size bits on arg0 and arg1
+        sets from its result res. Unless someone listens to register writes,
+        they are only computed when read.
+        '''
+        functions = _flag_functions[kind]
+        listened = self._subscribers('will_write_register') or self._subscribers('did_write_register')
+        if lazy_flags and not listened:
+            self._regfile.defer_flags([flag for flag in flags if flag in functions],
+                                      (kind, size, res, arg0, arg1))
+            return
+        for flag in flags:
+            if flag in functions:
+                self.write_register(flag, functions[flag](size, res, arg0, arg1))
+
     def _calculate_CMP_flags(self, size, res, arg0, arg1):
-        SIGN_MASK = 1 << (size - 1)
-        self.CF = Operators.ULT(arg0, arg1)
-        self.AF = ((arg0 ^ arg1) ^ res) & 0x10 != 0
-        self.ZF = res == 0
-        self.SF = (res & SIGN_MASK) != 0
-        sign0 = (arg0 & SIGN_MASK) == SIGN_MASK
-        sign1 = (arg1 & SIGN_MASK) == SIGN_MASK
-        signr = (res & SIGN_MASK) == SIGN_MASK
-        self.OF = Operators.AND(sign0 ^ sign1, sign0 ^ signr)
-        self.PF = self._calculate_parity_flag(res)
+        self._update_flags('SUB', size, res, arg0, arg1)
 
     def _calculate_parity_flag(self, res):
-        return (res ^ res >> 1 ^ res >> 2 ^ res >> 3 ^ res >> 4 ^ res >> 5 ^ res >> 6 ^ res >> 7) & 1 == 0
+        return _parity_flag(res)
 
     def _calculate_logic_flags(self, size, res):
-        SIGN_MASK = 1 << (size - 1)
-        self.CF = False  # cleared
-        self.AF = False
-        self.ZF = res == 0
-        self.SF = (res & SIGN_MASK) != 0
-        self.OF = False  # cleared
-        self.PF = self._calculate_parity_flag(res)
+        self._update_flags('LOGIC', size, res)
 
     #####################################################
     # Instructions
@@ -925,11 +1024,7 @@ class X86Cpu(Cpu):
         '''
         # Defined Flags: szp
         temp = src1.read() & src2.read()
-        cpu.SF = (temp & (1 << (src1.size - 1))) != 0
-        cpu.ZF = temp == 0
-        cpu.PF = cpu._calculate_parity_flag(temp)
-        cpu.CF = False
-        cpu.OF = False
+        cpu._update_flags('LOGIC', src1.size, temp, flags=('SF', 'ZF', 'PF', 'CF', 'OF'))
 
     @instruction
     def NOT(cpu, dest):
@@ -1223,7 +1318,6 @@ class X86Cpu(Cpu):
 
     def _ADD(cpu, dest, src, carry=False):
         MASK = (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
         arg0 = dest.read()
         if src.size < dest.size:
             arg1 = Operators.SEXTEND(src.read(), src.size, dest.size)
@@ -1232,23 +1326,20 @@ class X86Cpu(Cpu):
 
         to_add = arg1
         if carry:
-            cv = Operators.ITEBV(dest.size, cpu.CF, 1, 0)
+            carry_in = cpu.CF
+            cv = Operators.ITEBV(dest.size, carry_in, 1, 0)
             to_add = arg1 + cv
 
         res = dest.write((arg0 + to_add) & MASK)
 
         # Affected flags: oszapc
-        tempCF = Operators.OR(Operators.ULT(res, arg0 & MASK), Operators.ULT(res, arg1 & MASK))
         if carry:
             # case of 0xFFFFFFFF + 0xFFFFFFFF + CF(1)
-            tempCF = Operators.OR(tempCF, Operators.AND(res == MASK, cpu.CF))
-
-        cpu.CF = tempCF
-        cpu.AF = ((arg0 ^ arg1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = (((arg0 ^ arg1 ^ SIGN_MASK) & (res ^ arg1)) & SIGN_MASK) != 0
-        cpu.PF = cpu._calculate_parity_flag(res)
+            cpu.CF = Operators.OR(_add_carry_flag(dest.size, res, arg0, arg1),
+                                  Operators.AND(res == MASK, carry_in))
+            cpu._update_flags('ADD', dest.size, res, arg0, arg1, flags=('AF', 'ZF', 'SF', 'OF', 'PF'))
+        else:
+            cpu._update_flags('ADD', dest.size, res, arg0, arg1)
 
     @instruction
     def CMP(cpu, src1, src2):
@@ -1516,14 +1607,9 @@ class X86Cpu(Cpu):
         '''
         arg0 = dest.read()
         res = dest.write(arg0 - 1)
-        # Affected Flags o..szapc
         res &= (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
-        cpu.AF = ((arg0 ^ 1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = res == SIGN_MASK
-        cpu.PF = cpu._calculate_parity_flag(res)
+        # Affected Flags o..szap
+        cpu._update_flags('STEP', dest.size, res, arg0, 1)
 
     @instruction
     def DIV(cpu, src):
@@ -1874,12 +1960,8 @@ class X86Cpu(Cpu):
         arg0 = dest.read()
         res = dest.write(arg0 + 1)
         res &= (1 << dest.size) - 1
-        SIGN_MASK = 1 << (dest.size - 1)
-        cpu.AF = ((arg0 ^ 1) ^ res) & 0x10 != 0
-        cpu.ZF = res == 0
-        cpu.SF = (res & SIGN_MASK) != 0
-        cpu.OF = res == SIGN_MASK
-        cpu.PF = cpu._calculate_parity_flag(res)
+        # Affected Flags o..szap
+        cpu._update_flags('STEP', dest.size, res, arg0, 1)
 
     @instruction
     def MUL(cpu, src):
@@ -1,12 +1,15 @@
 from __future__ import absolute_import
 import os
+import heapq
 import random
 import logging
 import signal
+import itertools
+import threading
 
 from ..utils.nointerrupt import WithKeyboardInterruptAs
 from ..utils.event import Eventful
-from .smtlib import Z3Solver, Expression, SolverException
+from .smtlib import Expression, SolverException, solver
 from .state import Concretize, TerminateState
 
 from .workspace import Workspace
@@ -20,11 +23,155 @@ def mgr_init():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
+class Scheduler(object):
+    '''
+    The queue of state ids waiting to be run, served by the manager process.
+
+    Each worker has its own heap of (priority, state_id), the lower the
+    priority the sooner it runs. A worker gets from its own heap (the states
+    it forked itself) and only when it is empty it steals the best state
+    queued by another worker. Every operation is a single round trip to
+    the manager and O(log n) on the number of queued states.
+
+    A state may be queued with a key (i.e. its pc). The priority of every
+    state with a key is its base priority plus the weight of the key, so
+    bumping a key reprioritizes all the states queued with it.
+
+    A state may be queued as resident, when it is kept in the memory of the
+    worker that queued it. Only that worker gets it, until it is shared.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}   # worker -> heap of (priority, order, state_id)
+        self._resident = {}  # worker -> heap of its resident states
+        self._queued = {}   # state_id -> (priority, order, key) of its live entry
+        self._keyed = {}    # key -> set of queued state_ids
+        self._weights = {}  # key -> weight
+        self._owners = {}   # state_id -> worker
+        self._residents = set()  # resident state_ids
+        self._order = itertools.count()
+
+    def _push(self, state_id, priority, order, key, worker, resident=False):
+        queues = self._resident if resident else self._queues
+        heapq.heappush(queues.setdefault(worker, []), (priority, order, state_id))
+        self._queued[state_id] = (priority, order, key)
+        self._owners[state_id] = worker
+
+    def _forget(self, state_id):
+        _, _, key = self._queued.pop(state_id)
+        del self._owners[state_id]
+        self._residents.discard(state_id)
+        if key is not None:
+            self._keyed[key].discard(state_id)
+            if not self._keyed[key]:
+                del self._keyed[key]
+
+    def put(self, state_id, priority=0, worker=None, key=None, resident=False):
+        with self._lock:
+            if key is not None:
+                priority += self._weights.get(key, 0)
+                self._keyed.setdefault(key, set()).add(state_id)
+            if resident:
+                self._residents.add(state_id)
+            self._push(state_id, priority, next(self._order), key, worker, resident)
+
+    def share(self, state_id):
+        ''' Let any worker get a resident state id '''
+        with self._lock:
+            if state_id not in self._residents:
+                return
+            self._residents.remove(state_id)
+            priority, _, key = self._queued[state_id]
+            # A new order drops the resident entry when it surfaces
+            self._push(state_id, priority, next(self._order), key, self._owners[state_id])
+
+    def bump(self, increments, cap=None):
+        '''
+        Add to the weight of some keys.
+
+        :param dict increments: key -> how much to add to its weight
+        :param cap: the maximum weight of a key, if any
+        '''
+        with self._lock:
+            for key, amount in increments.iteritems():
+                weight = self._weights.get(key, 0)
+                new_weight = weight + amount
+                if cap is not None:
+                    new_weight = min(new_weight, cap)
+                if new_weight == weight:
+                    continue
+                self._weights[key] = new_weight
+                for state_id in self._keyed.get(key, ()):
+                    priority, order, _ = self._queued[state_id]
+                    # The old entry is dropped when it surfaces
+                    self._push(state_id, priority + new_weight - weight, order, key,
+                               self._owners[state_id], state_id in self._residents)
+
+    def weight(self, key):
+        with self._lock:
+            return self._weights.get(key, 0)
+
+    def _head(self, queue):
+        # Stale entries are left in the heaps and dropped once they surface
+        while queue and self._queued.get(queue[0][2], (None, None))[:2] != queue[0][:2]:
+            heapq.heappop(queue)
+        return queue[0] if queue else None
+
+    def get(self, worker=None, limit=None):
+        '''
+        Dequeue the best state id of worker, or steal the best one of the
+        other workers if it has none.
+
+        :param limit: states with a higher priority are left in the queue
+        :return: a state id or None if there are no (eligible) states
+        '''
+        def eligible(queue):
+            head = self._head(queue)
+            return head is not None and (limit is None or head[0] <= limit)
+
+        with self._lock:
+            own = [queue for queue in (self._queues.get(worker), self._resident.get(worker))
+                   if queue is not None and eligible(queue)]
+            # The resident states of the other workers are not stolen
+            queues = own or [other for other in self._queues.itervalues() if eligible(other)]
+            if not queues:
+                return None
+            _, _, state_id = heapq.heappop(min(queues, key=lambda queue: queue[0]))
+            self._forget(state_id)
+            return state_id
+
+    def remove(self, state_id):
+        ''' Removes a queued state id. Returns False if it was not queued '''
+        with self._lock:
+            if state_id not in self._queued:
+                return False
+            self._forget(state_id)
+            return True
+
+    def ids(self):
+        ''' All the queued state ids '''
+        with self._lock:
+            return list(self._queued)
+
+    def size(self, worker=None):
+        ''' How many queued states worker may get '''
+        with self._lock:
+            others = sum(1 for state_id in self._residents if self._owners[state_id] != worker)
+            return len(self._queued) - others
+
+
+SyncManager.register('Scheduler', Scheduler)
+
 manager = SyncManager()
 manager.start(mgr_init)
 
 logger = logging.getLogger(__name__)
 
+# How many forked states a worker may keep in memory (and run next) instead of
+# sending them through the workspace. 0 sends every fork to the workspace
+max_resident_states = 1
+
 
 def sync(f):
     """ Synchronization decorator. """
@@ -39,12 +186,21 @@ def sync(f):
 
 
 class Policy(object):
-    ''' Base class for prioritization of state search '''
+    '''
+    Base class for prioritization of state search.
+
+    Every queued state gets a priority (the lower the sooner it runs) and
+    optionally a key. The scheduler adds the weight of the key to the
+    priority, so a policy reprioritizes all the states sharing a key
+    (i.e. a pc) at once by bumping it.
+    '''
+
+    #: States with a higher priority are not run
+    limit = None
 
     def __init__(self, executor, *args, **kwargs):
         super(Policy, self).__init__(*args, **kwargs)
         self._executor = executor
-        self._executor.subscribe('did_enqueue_state', self._add_state_callback)
 
     @contextmanager
     def locked_context(self, key=None, default=dict):
@@ -55,27 +211,19 @@ class Policy(object):
         with self._executor.locked_context('.'.join(keys), default) as policy_context:
             yield policy_context
 
-    def _add_state_callback(self, state_id, state):
-        ''' Save summarize(state) on policy shared context before
-            the state is stored
-        '''
-        summary = self.summarize(state)
-        if summary is None:
-            return
-        with self.locked_context('summaries', dict) as ctx:
-            ctx[state_id] = summary
-
-    def summarize(self, state):
-        '''
-            Extract the relevant information from a state for later
-            prioritization
-        '''
+    def key(self, state):
+        ''' Key of a state being queued, states with the same key are
+            reprioritized together '''
         return None
 
-    def choice(self, state_ids):
-        ''' Select a state id from state_ids.
-            self.context has a dict mapping state_ids -> summarize(state)'''
-        raise NotImplementedError
+    def priority(self, state):
+        ''' Base priority of a state being queued '''
+        return 0
+
+    def flush(self):
+        ''' Send the weights accumulated by this worker to the scheduler.
+            Called before every dequeue. '''
+        pass
 
 
 class Random(Policy):
@@ -83,15 +231,17 @@ class Random(Policy):
         super(Random, self).__init__(executor, *args, **kwargs)
         random.seed(1337)  # For repeatable results
 
-    def choice(self, state_ids):
-        return random.choice(state_ids)
+    def priority(self, state):
+        return random.random()
 
 
 class Uncovered(Policy):
+    ''' Prefer states whose pc was not executed yet, at random '''
+
     def __init__(self, executor, *args, **kwargs):
         super(Uncovered, self).__init__(executor, *args, **kwargs)
-        # hook on the necesary executor signals
-        # on callbacks save data in executor.context['policy']
+        self._visited = set()
+        self._pending = set()
         self._executor.subscribe('will_load_state', self._register)
 
     def _register(self, *args):
@@ -100,63 +250,49 @@ class Uncovered(Policy):
     def _visited_callback(self, state, pc, instr):
         ''' Maintain our own copy of the visited set
         '''
-        with self.locked_context('visited', set) as ctx:
-            ctx.add(pc)
+        if pc not in self._visited:
+            self._visited.add(pc)
+            self._pending.add(pc)
 
-    def summarize(self, state):
-        ''' Save the last pc before storing the state '''
+    def key(self, state):
         return state.cpu.PC
 
-    def choice(self, state_ids):
-        # Use executor.context['uncovered'] = state_id -> stats
-        # am
-        with self._executor.locked_context() as ctx:
-            lastpc = ctx['policy']
-            visited = ctx.get('visited', ())
-            interesting = set()
-            for _id in state_ids:
-                if lastpc.get(_id, None) not in visited:
-                    interesting.add(_id)
-        return random.choice(tuple(interesting))
+    def priority(self, state):
+        return random.random()
+
+    def flush(self):
+        if self._pending:
+            # A visited pc pushes its states behind all the uncovered ones
+            self._executor._states.bump(dict.fromkeys(self._pending, 1), cap=1)
+            self._pending.clear()
 
 
 class BranchLimited(Policy):
+    ''' Prefer the states at the least executed pcs, drop the ones executed
+        more than limit times '''
+
     def __init__(self, executor, *args, **kwargs):
         super(BranchLimited, self).__init__(executor, *args, **kwargs)
         self._executor.subscribe('will_load_state', self._register)
-        self._limit = kwargs.get('limit', 5)
+        self.limit = kwargs.get('limit', 5)
+        self._pending = {}
 
     def _register(self, *args):
         self._executor.subscribe('will_execute_instruction', self._visited_callback)
 
     def _visited_callback(self, state, pc, instr):
-        ''' Maintain our own copy of the visited set
+        ''' Count the executions of pc since the last flush
         '''
         pc = state.platform.current.PC
-        with self.locked_context('visited', dict) as ctx:
-            ctx[pc] = ctx.get(pc, 0) + 1
+        self._pending[pc] = self._pending.get(pc, 0) + 1
 
-    def summarize(self, state):
+    def key(self, state):
         return state.cpu.PC
 
-    def choice(self, state_ids):
-        interesting = set(state_ids)
-        with self.locked_context() as policy_ctx:
-            visited = policy_ctx.get('visited', dict())
-            summaries = policy_ctx.get('summaries', dict())
-            lst = []
-            for id_, pc in summaries.items():
-                cnt = visited.get(pc, 0)
-                if id_ not in state_ids:
-                    continue
-                if cnt <= self._limit:
-                    lst.append((id_, visited.get(pc, 0)))
-            lst = sorted(lst, key=lambda x: x[1])
-
-        if lst:
-            return lst[0][0]
-        else:
-            return None
+    def flush(self):
+        if self._pending:
+            self._executor._states.bump(self._pending)
+            self._pending = {}
 
 
 class Executor(Eventful):
@@ -182,14 +318,21 @@ class Executor(Eventful):
         # Shutdown Event
         self._shutdown = manager.Event()
 
-        # States on storage. Shared dict state name ->  state stats
-        self._states = manager.list()
+        # States on storage waiting to be run
+        self._states = manager.Scheduler()
 
         # Number of currently running workers. Initially no running workers
         self._running = manager.Value('i', 0)
 
+        # Forked states living in this worker process, [(state_id, state)].
+        # They are queued as resident, so the policy still decides when to run them
+        self._resident = []
+
         self._workspace = Workspace(self._lock, store)
 
+        # Solver answers found by any worker are reused by the others
+        solver.cache.shared = manager.list()
+
         # Executor wide shared context
         if context is None:
             context = {}
@@ -256,10 +399,45 @@ class Executor(Eventful):
         '''
         # save the state to secondary storage
         state_id = self._workspace.save_state(state)
-        self.put(state_id)
+        self.put(state_id, state)
+        self._publish('did_enqueue_state', state_id, state)
+        return state_id
+
+    def _keep(self, state):
+        '''
+            Enqueue state as resident, it stays in this worker
+            until it is run or spilled
+        '''
+        self._spill(max(0, len(self._resident) + 1 - max_resident_states))
+        state_id = self._workspace._get_id()
+        self._resident.append((state_id, state))
+        self.put(state_id, state, resident=True)
         self._publish('did_enqueue_state', state_id, state)
         return state_id
 
+    def _spill(self, count=None):
+        '''
+            Save the oldest resident states (all by default) so
+            any worker can pick them up
+        '''
+        if count is None:
+            count = len(self._resident)
+        for state_id, state in self._resident[:count]:
+            self._workspace.save_state(state, state_id)
+            self._states.share(state_id)
+        del self._resident[:count]
+        if count:
+            with self._lock:
+                self._lock.notify_all()
+
+    def _take_resident(self, state_id):
+        ''' Returns the resident state with state_id, or None if it is not resident '''
+        for index, (resident_id, state) in enumerate(self._resident):
+            if resident_id == state_id:
+                del self._resident[index]
+                return state
+        return None
+
     def load_workspace(self):
         # Browse and load states in a workspace in case we are trying to
         # continue from paused run
@@ -268,7 +446,7 @@ class Executor(Eventful):
             return False
 
         for id in loaded_state_ids:
-            self._states.append(id)
+            self.put(id)
 
         return True
 
@@ -304,42 +482,55 @@ class Executor(Eventful):
 
     ###############################################
     # Priority queue
-    @sync
-    def put(self, state_id):
+    # The scheduler serializes its own operations, the executor lock is only
+    # taken to wait for states (and wake up the ones waiting)
+    def put(self, state_id, state=None, resident=False):
         ''' Enqueue it for processing '''
-        self._states.append(state_id)
-        self._lock.notify_all()
+        key = None if state is None else self._policy.key(state)
+        self._states.put(state_id, self._policy.priority(state), os.getpid(), key, resident)
+        # Nobody else may get a resident state
+        if not resident:
+            with self._lock:
+                self._lock.notify_all()
         return state_id
 
-    @sync
     def get(self):
         ''' Dequeue a state with the max priority '''
 
-        # A shutdown has been requested
-        if self.is_shutdown():
-            return None
-
-        # if not more states in the queue lets wait for some forks
-        while len(self._states) == 0:
-            # if no worker is running bail out
-            if self.running == 0:
-                return None
-            # if a shutdown has been requested bail out
-            if self.is_shutdown():
-                return None
-            # if there is actually some workers running wait for state forks
-            logger.debug("Waiting for available states")
-            self._lock.wait()
-
-        state_id = self._policy.choice(list(self._states))
-        if state_id is None:
-            return None
-        del self._states[self._states.index(state_id)]
-        return state_id
+        # Until a shutdown is requested
+        while not self.is_shutdown():
+            self._policy.flush()
+            # Prefer the states forked by this worker
+            state_id = self._states.get(os.getpid(), self._policy.limit)
+            if state_id is not None:
+                return state_id
+
+            with self._lock:
+                # Queued meanwhile, or only states over the limit are left
+                if self._states.size(os.getpid()) != 0:
+                    return self._states.get(os.getpid(), self._policy.limit)
+                # notify siblings we are waiting
+                self._notify_stop_run()
+                try:
+                    # A put notifies holding the lock, so the ones that
+                    # come after this check are not missed
+                    while self._states.size(os.getpid()) == 0:
+                        # if no worker is running bail out
+                        if self.running == 0:
+                            return None
+                        # if a shutdown has been requested bail out
+                        if self.is_shutdown():
+                            return None
+                        # if there is actually some workers running wait for state forks
+                        logger.debug("Waiting for available states")
+                        self._lock.wait()
+                finally:
+                    self._notify_start_run()
+        return None
 
     def list(self):
         ''' Returns the list of states ids currently queued '''
-        return list(self._states)
+        return self._states.ids()
 
     def generate_testcase(self, state, message='Testcase generated'):
         '''
@@ -391,23 +582,38 @@ class Executor(Eventful):
 
         self._publish('will_fork_state', state, expression, solutions, policy)
 
+        def setup(new_state, new_value):
+            new_state.constrain(expression == new_value)
+
+            # and set the PC of the new state to the concrete pc-dest
+            #(or other register or memory address to concrete)
+            setstate(new_state, new_value)
+
+            self._publish('did_fork_state', new_state, expression, new_value, policy)
+
         # Build and enqueue a state for each solution
         children = []
-        for new_value in solutions:
+        for new_value in solutions[:-1]:
             with state as new_state:
-                new_state.constrain(expression == new_value)
-
-                # and set the PC of the new state to the concrete pc-dest
-                #(or other register or memory address to concrete)
-                setstate(new_state, new_value)
-
-                self._publish('did_fork_state', new_state, expression, new_value, policy)
+                setup(new_state, new_value)
 
                 # enqueue new_state
                 state_id = self.enqueue(new_state)
                 # maintain a list of childres for logging purpose
                 children.append(state_id)
 
+        # The parent is dropped after forking, so the last child can take over
+        # its objects in place and stay in this worker instead of being saved
+        new_value = solutions[-1]
+        if max_resident_states > 0:
+            new_state = state.inherit()
+            setup(new_state, new_value)
+            children.append(self._keep(new_state))
+        else:
+            with state as new_state:
+                setup(new_state, new_value)
+                children.append(self.enqueue(new_state))
+
         logger.info("Forking current state into states %r", children)
         return None
 
@@ -425,28 +631,27 @@ class Executor(Eventful):
             self._notify_start_run()
 
             logger.debug("Starting Manticore Symbolic Emulator Worker (pid %d).", os.getpid())
-            solver = Z3Solver()
             while not self.is_shutdown():
                 try:  # handle fatal errors: exceptions in Manticore
                     try:  # handle external (e.g. solver) errors, and executor control exceptions
                         # select a suitable state to analyze
                         if current_state is None:
-                            with self._lock:
-                                # notify siblings we are about to stop this run
-                                self._notify_stop_run()
-                                try:
-                                    # Select a single state_id
-                                    current_state_id = self.get()
+                            # Trade solver answers with the other workers
+                            solver.cache.sync()
+                            # Select a single state_id
+                            current_state_id = self.get()
+                            if current_state_id is not None:
+                                self._publish('will_load_state', current_state_id)
+                                # A state forked in this worker is already loaded
+                                current_state = self._take_resident(current_state_id)
+                                if current_state is None:
+                                    # The resident states were not chosen, let the other workers run them
+                                    self._spill()
                                     # load selected state from secondary storage
-                                    if current_state_id is not None:
-                                        self._publish('will_load_state', current_state_id)
-                                        current_state = self._workspace.load_state(current_state_id)
-                                        self.forward_events_from(current_state, True)
-                                        self._publish('did_load_state', current_state, current_state_id)
-                                        logger.info("load state %r", current_state_id)
-                                    # notify siblings we have a state to play with
-                                finally:
-                                    self._notify_start_run()
+                                    current_state = self._workspace.load_state(current_state_id)
+                                self.forward_events_from(current_state, True)
+                                self._publish('did_load_state', current_state, current_state_id)
+                                logger.info("load state %r", current_state_id)
 
                         # If current_state is still None. We are done.
                         if current_state is None:
@@ -506,5 +711,10 @@ class Executor(Eventful):
 
             assert current_state is None or self.is_shutdown()
 
+            # Do not lose the states that never left this worker
+            self._spill()
+            self._workspace.release_held_pages()
+            solver.cache.sync()
+
             # notify siblings we are about to stop this run
             self._notify_stop_run()
@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
+import ctypes
 from weakref import WeakValueDictionary
 from .smtlib import *
 import logging
@@ -7,6 +8,15 @@ from ..utils.helpers import issymbolic
 
 logger = logging.getLogger(__name__)
 
+# How SMemory resolves an access at a symbolic address by default:
+#  'enumerate' reads or writes at every solution of the address
+#  'array' selects from an array holding the whole [min, max] range of it
+#  'fork' forks a state per solution of the address
+symbolic_access_strategy = 'enumerate'
+
+# Widest range (in bytes) the 'array' strategy models, wider ones are enumerated
+max_symbolic_range = 0x1000
+
 
 class MemoryException(Exception):
     '''
@@ -45,6 +55,17 @@ class ConcretizeMemory(MemoryException):
         self.policy = policy
 
 
+class ForkMemoryAddress(MemoryException):
+    '''
+    Raised when the state is to be forked once per solution of a symbolic
+    memory address.
+    '''
+
+    def __init__(self, address, message='Forking on symbolic memory address'):
+        super(ForkMemoryAddress, self).__init__(message, address)
+        self.policy = 'ALL'
+
+
 class InvalidMemoryAccess(MemoryException):
     _message = 'Invalid memory access'
 
@@ -204,6 +225,18 @@ class Map(object):
         :param value: byte or sequence of bytes to put in this map.
         '''
 
+    @abstractmethod
+    def view(self, start, stop):
+        '''
+        Reads the bytes of a range of addresses without copying them when
+        they are held in a single buffer.
+
+        :param start: the first address of the range.
+        :param stop: the address after the range.
+        :return: the bytes in the range.
+        :rtype: buffer or str
+        '''
+
     @abstractmethod
     def split(self, address):
         '''
@@ -254,11 +287,88 @@ class AnonMap(Map):
     def __getitem__(self, index):
         index = self._get_offset(index)
         if isinstance(index, slice):
-            return map(chr, self._data[index])
+            return list(buffer(self._data, index.start, index.stop - index.start))
         return chr(self._data[index])
 
+    def view(self, start, stop):
+        assert self._in_range(slice(start, stop))
+        return buffer(self._data, start - self.start, stop - start)
 
-class FileMap(Map):
+
+class OverlayMap(Map):
+    '''
+    A map that writes to page sized copies of an underlying read only content.
+    '''
+
+    #: Size of the copies, maps are aligned to it
+    page_size = 0x1000
+
+    def __init__(self, start, size, perms, overlay=None, **kwargs):
+        '''
+        :param overlay: the copied pages, a dict from their first address to
+                        a bytearray with their content.
+        '''
+        super(OverlayMap, self).__init__(start, size, perms, **kwargs)
+        if overlay is not None:
+            self._overlay = dict(overlay)
+        else:
+            self._overlay = dict()
+
+    @abstractmethod
+    def _content(self, start, stop):
+        '''
+        Reads a range of the underlying content.
+
+        :rtype: buffer or str
+        '''
+
+    def _page_bounds(self, address):
+        ''' Returns the range of the page holding address, clipped to the map '''
+        page = address & ~(self.page_size - 1)
+        return max(page, self.start), min(page + self.page_size, self.end)
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            index, value = slice(index, index + 1), (value,)
+        assert self._in_range(index) and \
+            len(value) == index.stop - index.start
+        address = index.start
+        while address < index.stop:
+            lo, hi = self._page_bounds(address)
+            stop = min(hi, index.stop)
+            page = self._overlay.get(lo)
+            if page is None:
+                page = self._overlay[lo] = bytearray(self._content(lo, hi))
+            page[address - lo:stop - lo] = value[address - index.start:stop - index.start]
+            address = stop
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.view(index.start, index.stop))
+        return self.view(index, index + 1)[0]
+
+    def view(self, start, stop):
+        assert self._in_range(slice(start, stop))
+        if not self._overlay:
+            return self._content(start, stop)
+
+        chunks = []
+        address = start
+        while address < stop:
+            lo, hi = self._page_bounds(address)
+            end = min(hi, stop)
+            page = self._overlay.get(lo)
+            if page is None:
+                chunks.append(self._content(address, end))
+            else:
+                chunks.append(buffer(page, address - lo, end - address))
+            address = end
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(map(str, chunks))
+
+
+class FileMap(OverlayMap):
     '''
     A file map.
 
@@ -280,7 +390,7 @@ class FileMap(Map):
         :param offset: the offset into the file where to start the mapping. \
                 This offset must be a multiple of pagebitsize.
         '''
-        super(FileMap, self).__init__(addr, size, perms, **kwargs)
+        super(FileMap, self).__init__(addr, size, perms, overlay, **kwargs)
         assert isinstance(offset, (int, long))
         assert offset >= 0
         self._filename = filename
@@ -290,10 +400,7 @@ class FileMap(Map):
             file_size = fileobject.tell()
             self._mapped_size = min(size, file_size - offset)
             self._data = mmap(fileobject.fileno(), offset, self._mapped_size)
-        if overlay is not None:
-            self._overlay = dict(overlay)
-        else:
-            self._overlay = dict()
+        self._mapped = (ctypes.c_char * self._mapped_size).from_address(ctypes.addressof(self._data.contents))
 
     def __reduce__(self):
         return (self.__class__, (self.start, len(self), self.perms, self._filename, self._offset, self._overlay))
@@ -304,33 +411,14 @@ class FileMap(Map):
     def __repr__(self):
         return '<%s [%s+%x] 0x%016x-0x%016x %s>' % (self.__class__.__name__, self._filename, self._offset, self.start, self.end, self.perms)
 
-    def __setitem__(self, index, value):
-        assert not isinstance(index, slice) or \
-            len(value) == index.stop - index.start
-        index = self._get_offset(index)
-        if isinstance(index, slice):
-            for i in xrange(index.stop - index.start):
-                self._overlay[index.start + i] = value[i]
-        else:
-            self._overlay[index] = value
-
-    def __getitem__(self, index):
-        def get_byte_at_offset(offset):
-            if offset in self._overlay:
-                return self._overlay[offset]
-            else:
-                if offset >= self._mapped_size:
-                    return '\x00'  # , 'Extra data must initially be zero'
-                return self._data[offset]
-
-        index = self._get_offset(index)
-        if isinstance(index, slice):
-            result = []
-            for i in xrange(index.stop - index.start):
-                result.append(get_byte_at_offset(i + index.start))
-            return result
-        else:
-            return get_byte_at_offset(index)
+    def _content(self, start, stop):
+        start, stop = start - self.start, stop - self.start
+        if stop <= self._mapped_size:
+            return buffer(self._mapped, start, stop - start)
+        # Extra data must initially be zero
+        if start >= self._mapped_size:
+            return '\x00' * (stop - start)
+        return self._mapped[start:] + '\x00' * (stop - self._mapped_size)
 
     def split(self, address):
         if address <= self.start:
@@ -344,7 +432,7 @@ class FileMap(Map):
         return head, tail
 
 
-class COWMap(Map):
+class COWMap(OverlayMap):
     '''
     Copy-on-write based map.
     '''
@@ -370,32 +458,9 @@ class COWMap(Map):
         super(COWMap, self).__init__(parent.start + offset, size, perms, **kwargs)
         self._parent = parent
         self._parent.__setitem__ = False
-        self._cow = {}
-
-    def __setitem__(self, index, value):
-        assert self._in_range(index)
-        if isinstance(index, slice):
-            for i in xrange(index.stop - index.start):
-                self._cow[index.start + i] = value[i]
-        else:
-            self._cow[index] = value
 
-    def __getitem__(self, index):
-        assert self._in_range(index)
-
-        if isinstance(index, slice):
-            result = []
-            for i in xrange(index.start, index.stop):
-                if i in self._cow:
-                    result.append(self._cow[i])
-                else:
-                    result.append(self._parent[i])
-            return result
-        else:
-            if index in self._cow:
-                return self._cow[index]
-            else:
-                return self._parent[index]
+    def _content(self, start, stop):
+        return self._parent.view(start, stop)
 
     def split(self, address):
         if address <= self.start:
@@ -428,6 +493,10 @@ class Memory(object):
             self._maps = set(maps)
         self._page2map = WeakValueDictionary()  # {page -> ref{MAP}}
         self._recording_stack = []
+        # Pages some cpu decoded instructions from, and the ones of them
+        # written or remapped since it last asked (see watch_code)
+        self._code_pages = set()
+        self._stale_code = set()
         for m in self._maps:
             for i in range(self._page(m.start), self._page(m.end)):
                 assert i not in self._page2map
@@ -628,6 +697,7 @@ class Memory(object):
         assert m.start & self.page_mask == 0
         assert m.end & self.page_mask == 0
         self._maps.add(m)
+        self._code_changed(m.start, m.end)
         # updating the page to map translation
         for i in range(self._page(m.start), self._page(m.end)):
             self._page2map[i] = m
@@ -640,6 +710,40 @@ class Memory(object):
             del self._page2map[p]
         # remove m from the maps set
         self._maps.remove(m)
+        self._code_changed(m.start, m.end)
+
+    def watch_code(self, start, stop):
+        '''
+        Track the pages of [start, stop), that instructions were decoded
+        from. Once they are written or remapped they are returned by
+        `stale_code`.
+        '''
+        self._code_pages.update(xrange(self._page(start), self._page(stop - 1) + 1))
+
+    def stale_code(self):
+        '''
+        The watched pages written or remapped since the last call. They are
+        no longer watched.
+
+        :rtype: set
+        '''
+        stale = self._stale_code
+        if stale:
+            self._stale_code = set()
+        return stale
+
+    def _code_changed(self, start, stop):
+        ''' Marks the watched pages in [start, stop) as stale '''
+        if not self._code_pages:
+            return
+        first, last = self._page(start), self._page(stop - 1)
+        if last - first < len(self._code_pages):
+            stale = self._code_pages.intersection(xrange(first, last + 1))
+        else:
+            stale = [page for page in self._code_pages if first <= page <= last]
+        if stale:
+            self._code_pages.difference_update(stale)
+            self._stale_code.update(stale)
 
     def map_containing(self, address):
         '''
@@ -769,25 +873,56 @@ class Memory(object):
             m = self.map_containing(index)
             return force or m.access_ok(access)
 
+    def _chunks(self, address, size, access, force=False):
+        '''
+        Splits the range [address, address + size) by the maps holding it,
+        checking the access permissions once per map.
+
+        :param int address: the first address of the range
+        :param int size: the size of the range
+        :param str access: 'r' or 'w'
+        :param force: whether to ignore memory permissions
+        :return: a list of (map, start, stop)
+        :raises InvalidMemoryAccess: at the first address not accessible
+        '''
+        chunks = []
+        stop = address + size
+        while address < stop:
+            m = self._page2map.get(self._page(address))
+            if m is None or not (force or m.access_ok(access)):
+                raise InvalidMemoryAccess(address, access)
+            end = min(m.end, stop)
+            chunks.append((m, address, end))
+            address = end
+        return chunks
+
     # write and read potentially symbolic bytes at symbolic indexes
     def read(self, addr, size, force=False):
-        if not self.access_ok(slice(addr, addr + size), 'r', force):
-            raise InvalidMemoryAccess(addr, 'r')
-
+        chunks = self._chunks(addr, size, 'r', force)
         assert size > 0
-        result = []
-        stop = addr + size
-        p = addr
-        while p < stop:
-            m = self.map_containing(p)
-
-            _size = min(m.end - p, stop - p)
-            result += m[p:p + _size]
-            p += _size
-        assert p == stop
 
+        result = []
+        for m, start, stop in chunks:
+            result += m[start:stop]
         return result
 
+    def view(self, addr, size, force=False):
+        '''
+        Reads a concrete buffer from memory, without copying it when a single
+        map holds it.
+
+        :param int addr: address to read from
+        :param int size: number of bytes
+        :param force: whether to ignore memory permissions
+        :return: the bytes read, or None when some of them are symbolic
+        :rtype: buffer or str
+        '''
+        chunks = self._chunks(addr, size, 'r', force)
+        if len(chunks) == 1:
+            m, start, stop = chunks[0]
+            return m.view(start, stop)
+        return ''.join(str(m.view(start, stop)) for m, start, stop in chunks)
+
     def push_record_writes(self):
         '''
         Begin recording all writes. Retrieve all writes with `pop_record_writes()`
@@ -823,21 +958,16 @@ class Memory(object):
 
     def write(self, addr, buf, force=False):
         size = len(buf)
-        if not self.access_ok(slice(addr, addr + size), 'w', force):
-            raise InvalidMemoryAccess(addr, 'w')
+        chunks = self._chunks(addr, size, 'w', force)
         assert size > 0
-        stop = addr + size
-        start = addr
 
         if self._recording_stack:
             self._recording_stack[-1].append((addr, buf))
 
-        while addr < stop:
-            m = self.map_containing(addr)
-            size = min(m.end - addr, stop - addr)
-            m[addr:addr + size] = buf[addr - start:addr - start + size]
-            addr += size
-        assert addr == stop
+        for m, start, stop in chunks:
+            if 'x' in m.perms:
+                self._code_changed(start, stop)
+            m[start:stop] = buf[start - addr:stop - addr]
 
     def _get_size(self, size):
         return size
@@ -880,10 +1010,61 @@ class SMemory(Memory):
             self._symbols = {}
         else:
             self._symbols = dict(symbols)
+        # page -> the addresses of that page in _symbols
+        self._symbolic_pages = {}
+        for address in self._symbols:
+            self._symbolic_pages.setdefault(self._page(address), set()).add(address)
+        # (start, stop) -> array with the bytes of that range, see _range_array
+        self._range_arrays = {}
 
     def __reduce__(self):
         return (self.__class__, (self.constraints, self._symbols, self._maps, ))
 
+    def _add_symbol(self, address, condition, value):
+        ''' Adds a symbolic value for the byte at address '''
+        self._symbols.setdefault(address, []).append((condition, value))
+        self._symbolic_pages.setdefault(self._page(address), set()).add(address)
+
+    def _pages_with_symbols(self, start, stop):
+        ''' Yields the sets of symbolic addresses of the pages in [start, stop) '''
+        first, last = self._page(start), self._page(stop - 1)
+        if last - first < len(self._symbolic_pages):
+            pages = xrange(first, last + 1)
+        else:
+            pages = [page for page in self._symbolic_pages if first <= page <= last]
+        for page in pages:
+            addresses = self._symbolic_pages.get(page)
+            if addresses:
+                yield page, addresses
+
+    def _symbolic_addresses(self, start, stop):
+        '''
+        Returns the addresses in [start, stop) that hold symbolic values
+
+        :rtype: list
+        '''
+        result = []
+        if self._symbolic_pages and start < stop:
+            for page, addresses in self._pages_with_symbols(start, stop):
+                lo = max(start, page << self.page_bit_size)
+                hi = min(stop, (page + 1) << self.page_bit_size)
+                # Walk whichever is smaller, the range or the page's addresses
+                if hi - lo < len(addresses):
+                    result.extend(address for address in xrange(lo, hi) if address in addresses)
+                else:
+                    result.extend(address for address in addresses if lo <= address < hi)
+        return result
+
+    def _clear_symbols(self, start, stop):
+        ''' Forgets the symbolic values in [start, stop) '''
+        for address in self._symbolic_addresses(start, stop):
+            del self._symbols[address]
+            page = self._page(address)
+            addresses = self._symbolic_pages[page]
+            addresses.remove(address)
+            if not addresses:
+                del self._symbolic_pages[page]
+
     @property
     def constraints(self):
         return self._constraints
@@ -891,6 +1072,7 @@ class SMemory(Memory):
     @constraints.setter
     def constraints(self, constraints):
         self._constraints = constraints
+        self._range_arrays = {}
 
     def _get_size(self, size):
         if isinstance(size, BitVec):
@@ -909,12 +1091,55 @@ class SMemory(Memory):
         :param start: the starting address to delete.
         :param size: the length of the unmapping.
         '''
-        for addr in xrange(start, start + size):
-            if addr in self._symbols:
-                del self._symbols[addr]
+        self._clear_symbols(self._floor(start), self._floor(start + size - 1) + self.page_size)
+        self._forget_range_arrays(start, start + size)
         super(SMemory, self).munmap(start, size)
 
-    def read(self, address, size, force=False):
+    def _address_range(self, address, size, access, force=False):
+        '''
+        Bounds a symbolic address with its minimum and maximum solutions.
+
+        :return: the (min, max) of address, or None if accessing size bytes
+                 from anywhere in between is not allowed or the range is wider
+                 than max_symbolic_range
+        '''
+        m, M = solver.minmax(self.constraints, address)
+        if M - m + size > max_symbolic_range or \
+                not self.access_ok(slice(m, M + size), access, force):
+            return None
+        return m, M
+
+    def _range_array(self, start, stop, force=False):
+        '''
+        Returns an array holding the bytes in [start, stop) at their addresses.
+        Other indexes are unconstrained. It is kept until the range is written.
+        '''
+        array = self._range_arrays.get((start, stop))
+        if array is None:
+            array = self.constraints.new_array(index_bits=self.memory_bit_size, name='MEM_%x' % start)
+            for addr, byte in enumerate(self.read(start, stop - start, force), start):
+                array.store(addr, Operators.ORD(byte))
+            self._range_arrays[(start, stop)] = array
+        return array
+
+    def _forget_range_arrays(self, start=None, stop=None):
+        ''' Drops the range arrays overlapping [start, stop), or all of them '''
+        if not self._range_arrays:
+            return
+        if start is None:
+            self._range_arrays = {}
+            return
+        for key in [key for key in self._range_arrays if key[0] < stop and start < key[1]]:
+            del self._range_arrays[key]
+
+    def _fork_on_address(self, address):
+        ''' Forks the state once per solution of address unless there is only one '''
+        try:
+            solver.get_all_values(self.constraints, address, maxcnt=2)
+        except TooManySolutions:
+            raise ForkMemoryAddress(address)
+
+    def read(self, address, size, force=False, strategy=None):
         '''
         Read a stream of potentially symbolic bytes from a potentially symbolic
         address
@@ -922,12 +1147,22 @@ class SMemory(Memory):
         :param address: Where to read from
         :param size: How many bytes
         :param force: Whether to ignore permissions
+        :param strategy: How to resolve a symbolic address, see symbolic_access_strategy
         :rtype: list
         '''
         size = self._get_size(size)
         assert not issymbolic(size)
 
         if issymbolic(address):
+            strategy = strategy or symbolic_access_strategy
+            if strategy == 'array':
+                bounds = self._address_range(address, size, 'r', force)
+                if bounds is not None:
+                    array = self._range_array(bounds[0], bounds[1] + size, force)
+                    return [array.select(address + offset) for offset in xrange(size)]
+            elif strategy == 'fork':
+                self._fork_on_address(address)
+
             assert solver.check(self.constraints)
             logger.debug('Reading %d bytes from symbolic address %s', size, address)
             try:
@@ -978,17 +1213,26 @@ class SMemory(Memory):
                     assert len(result) == offset + 1
             return map(Operators.CHR, result)
         else:
-            result = map(Operators.ORD, super(SMemory, self).read(address, size, force))
-            for offset in range(size):
-                if address + offset in self._symbols:
-                    for condition, value in self._symbols[address + offset]:
-                        if condition is True:
-                            result[offset] = Operators.ORD(value)
-                        else:
-                            result[offset] = Operators.ITEBV(8, condition, Operators.ORD(value), result[offset])
-            return map(Operators.CHR, result)
+            result = super(SMemory, self).read(address, size, force)
+            # Only pages holding symbolic bytes need the overlay
+            for addr in self._symbolic_addresses(address, address + size):
+                offset = addr - address
+                byte = Operators.ORD(result[offset])
+                for condition, value in self._symbols[addr]:
+                    if condition is True:
+                        byte = Operators.ORD(value)
+                    else:
+                        byte = Operators.ITEBV(8, condition, Operators.ORD(value), byte)
+                result[offset] = Operators.CHR(byte)
+            return result
 
-    def write(self, address, value, force=False):
+    def view(self, address, size, force=False):
+        ''' Also None when the address is symbolic '''
+        if issymbolic(address) or self._symbolic_addresses(address, address + size):
+            return None
+        return super(SMemory, self).view(address, size, force)
+
+    def write(self, address, value, force=False, strategy=None):
         '''
         Write a value at address.
         :param address: The address at which to write
@@ -996,28 +1240,66 @@ class SMemory(Memory):
         :param value: Bytes to write
         :type value: str or list
         :param force: Whether to ignore permissions
+        :param strategy: How to resolve a symbolic address, see symbolic_access_strategy
         '''
         size = len(value)
         if issymbolic(address):
+            self._forget_range_arrays()
+            strategy = strategy or symbolic_access_strategy
+            if strategy == 'array':
+                bounds = self._address_range(address, size, 'w', force)
+                if bounds is not None:
+                    self._code_changed(bounds[0], bounds[1] + size)
+                    # Every byte in range may be the written one
+                    for base in xrange(bounds[0], bounds[1] + 1):
+                        condition = address == base
+                        for offset in xrange(size):
+                            self._add_symbol(base + offset, condition, value[offset])
+                    return
+            elif strategy == 'fork':
+                self._fork_on_address(address)
 
             solutions = self._try_get_solutions(address, size, 'w', force=force)
+            for base in solutions:
+                self._code_changed(base, base + size)
 
             for offset in xrange(size):
                 for base in solutions:
                     condition = base == address
-                    self._symbols.setdefault(base + offset, []).append((condition, value[offset]))
+                    self._add_symbol(base + offset, condition, value[offset])
         else:
-
-            for offset in xrange(size):
-                if issymbolic(value[offset]):
-                    if not self.access_ok(address + offset, 'w', force):
-                        raise InvalidMemoryAccess(address + offset, 'w')
-                    self._symbols[address + offset] = [(True, value[offset])]
-                else:
-                    # overwrite all previous items
-                    if address + offset in self._symbols:
-                        del self._symbols[address + offset]
-                    super(SMemory, self).write(address + offset, [value[offset]], force)
+            chunks = self._chunks(address, size, 'w', force)
+            recording = self._recording_stack[-1] if self._recording_stack else None
+
+            # overwrite all previous items
+            self._clear_symbols(address, address + size)
+            self._forget_range_arrays(address, address + size)
+
+            # Concrete runs go to the maps as slices, symbolic bytes to _symbols
+            for m, start, stop in chunks:
+                if 'x' in m.perms:
+                    self._code_changed(start, stop)
+                if isinstance(value, str):
+                    self._write_run(m, address, value, start, stop, recording)
+                    continue
+                run = start
+                for addr in xrange(start, stop):
+                    byte = value[addr - address]
+                    if issymbolic(byte):
+                        if run < addr:
+                            self._write_run(m, address, value, run, addr, recording)
+                        self._add_symbol(addr, True, byte)
+                        run = addr + 1
+                if run < stop:
+                    self._write_run(m, address, value, run, stop, recording)
+
+    @staticmethod
+    def _write_run(m, address, value, start, stop, recording):
+        ''' Writes the concrete bytes of value at [start, stop) to map m '''
+        data = value[start - address:stop - address]
+        if recording is not None:
+            recording.append((start, list(data)))
+        m[start:stop] = data
 
     def _try_get_solutions(self, address, size, access, max_solutions=0x1000, force=False):
         '''
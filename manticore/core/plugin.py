@@ -69,9 +69,13 @@ def _dict_diff(d1, d2):
     return d
 
 
+# The default plugins listen to did_execute_block rather than to the single
+# instructions, so that they do not keep the cpus from running whole blocks
+
+
 class Tracer(Plugin):
-    def did_execute_instruction_callback(self, state, pc, target_pc, instruction):
-        state.context.setdefault('trace', []).append(pc)
+    def did_execute_block_callback(self, state, pcs, target_pc):
+        state.context.setdefault('trace', []).extend(pcs)
 
 
 class ExtendedTracer(Plugin):
@@ -178,10 +182,11 @@ class Follower(Plugin):
 
 
 class RecordSymbolicBranches(Plugin):
-    def did_execute_instruction_callback(self, state, last_pc, target_pc, instruction):
+    def did_execute_block_callback(self, state, pcs, target_pc):
         if state.context.get('forking_pc', False):
             branches = state.context.setdefault('branches', {})
-            branch = (last_pc, target_pc)
+            # The first instruction after the fork, and where it went
+            branch = (pcs[0], pcs[1] if len(pcs) > 1 else target_pc)
             if branch in branches:
                 branches[branch] += 1
             else:
@@ -203,11 +208,9 @@ class InstructionCounter(Plugin):
             manticore_instructions_count = manticore_context.get('instructions_count', 0)
             manticore_context['instructions_count'] = manticore_instructions_count + state_instructions_count
 
-    def did_execute_instruction_callback(self, state, prev_pc, target_pc, instruction):
-        address = prev_pc
-        if not issymbolic(address):
-            count = state.context.get('instructions_count', 0)
-            state.context['instructions_count'] = count + 1
+    def did_execute_block_callback(self, state, pcs, target_pc):
+        count = state.context.get('instructions_count', 0)
+        state.context['instructions_count'] = count + len(pcs)
 
     def did_finish_run_callback(self):
         _shared_context = self.manticore.context
@@ -235,9 +238,9 @@ class Visited(Plugin):
             manticore_context['visited'] = manticore_visited.union(state_visited)
         state.context['visited_since_last_fork'] = set()
 
-    def did_execute_instruction_callback(self, state, prev_pc, target_pc, instruction):
-        state.context.setdefault('visited_since_last_fork', set()).add(prev_pc)
-        state.context.setdefault('visited', set()).add(prev_pc)
+    def did_execute_block_callback(self, state, pcs, target_pc):
+        state.context.setdefault('visited_since_last_fork', set()).update(pcs)
+        state.context.setdefault('visited', set()).update(pcs)
 
     def did_finish_run_callback(self):
         _shared_context = self.manticore.context
@@ -298,6 +301,9 @@ class ExamplePlugin(Plugin):
     def did_execute_instruction_callback(self, state, pc, target_pc, instruction):
         logger.info('did_execute_instruction %r %r %r %r', state, pc, target_pc, instruction)
 
+    def did_execute_block_callback(self, state, pcs, target_pc):
+        logger.info('did_execute_block %r %r %r', state, pcs, target_pc)
+
     def will_start_run_callback(self, state):
         ''' Called once at the begining of the run.
             state is the initial root state
@@ -1,10 +1,174 @@
 from __future__ import absolute_import
 from .expression import BitVecVariable, BoolVariable, ArrayVariable, Array, Bool, BitVec, BoolConstant, ArrayProxy, BoolEq, Variable, Constant
-from .visitors import GetDeclarations, TranslatorSmtlib, get_variables, simplify, replace
+from .visitors import GetDeclarations, TranslatorSmtlib, get_variables, simplify, replace, fingerprint, evaluate
+from weakref import ref
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
+# A child set with up to this many constraints of its own answers related_to
+# over the index of its parent instead of copying it
+max_overlay_constraints = 16
+
+# Translations of the constraints to smtlib, shared by every set holding them.
+# Keyed by id as expressions overload __eq__ (so no WeakKeyDictionary)
+_smtlib = {}  # id(constraint) -> (ref(constraint), variables, {constants: smtlib})
+
+# Translations kept per constraint for different sets of constant bindings
+max_smtlib_variants = 4
+
+
+def _constant_binding(constraint):
+    ''' The (variable, constant) pair constraint binds if it is a var == const '''
+    if isinstance(constraint, BoolEq) and \
+       isinstance(constraint.operands[0], Variable) and \
+       isinstance(constraint.operands[1], Constant):
+        return constraint.operands
+    return None
+
+
+def _translate(constraint, bindings):
+    '''
+    The smtlib declarations and assertion of constraint once its variables
+    bound in bindings are replaced by their constants. Memoized per constraint.
+    '''
+    key = id(constraint)
+    entry = _smtlib.get(key)
+    if entry is None or entry[0]() is not constraint:
+        variables = tuple(get_variables(constraint))
+        entry = (ref(constraint, lambda _, key=key: _smtlib.pop(key, None)), variables, {})
+        _smtlib[key] = entry
+    _, variables, translations = entry
+
+    replacements = {}
+    for variable in variables:
+        constant = bindings.get(variable)
+        if constant is not None:
+            replacements[variable] = constant
+    constants = tuple((variable.name, replacements[variable].value) for variable in variables
+                      if variable in replacements)
+    result = translations.get(constants)
+    if result is not None:
+        return result
+
+    if replacements:
+        constraint = replace(constraint, replacements)
+    translator = TranslatorSmtlib(use_bindings=True)
+    translator.visit(simplify(constraint))
+
+    declarations = ''
+    for name, exp, smtlib in translator.bindings:
+        if isinstance(exp, BitVec):
+            declarations += '(declare-fun %s () (_ BitVec %d))' % (name, exp.size)
+        elif isinstance(exp, Bool):
+            declarations += '(declare-fun %s () Bool)' % name
+        elif isinstance(exp, Array):
+            declarations += '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec %d)))' % (name, exp.index_bits, exp.value_bits)
+        else:
+            raise Exception("Type not supported %r", exp)
+        declarations += '(assert (= %s %s))\n' % (name, smtlib)
+
+    constraint_str = translator.pop()
+    assertion = '' if constraint_str == 'true' else '(assert %s)\n' % constraint_str
+
+    if len(translations) >= max_smtlib_variants:
+        translations.clear()
+    result = translations[constants] = (declarations, assertion)
+    return result
+
+
+class _VariableIndex(object):
+    '''
+    Union-find over the variables of a sequence of constraints. Each class of
+    variables keeps the constraints over them, so the constraints related to an
+    expression are collected without walking the others. Classes are merged
+    in O(1) as pairs of trees of constraints and of variables.
+    '''
+
+    def __init__(self, other=None):
+        if other is None:
+            self._parents = {}  # variable -> parent variable, roots are their own parent
+            self._classes = {}  # root -> (constraints tree, variables tree, number of variables)
+            self.false = None   # a False constraint if any
+            self.size = 0       # number of constraints indexed
+            self.bindings = {}  # variable -> constant it is constrained to equal
+        else:
+            self._parents = dict(other._parents)
+            self._classes = dict(other._classes)
+            self.false = other.false
+            self.bindings = dict(other.bindings)
+            self.size = other.size
+
+    def find(self, variable):
+        ''' The root of the class of variable, None if it is not indexed '''
+        parents = self._parents
+        root = parents.get(variable)
+        if root is None:
+            return None
+        while parents[root] is not root:
+            root = parents[root]
+        while variable is not root:
+            parents[variable], variable = root, parents[variable]
+        return root
+
+    def add(self, constraint):
+        self.size += 1
+        if isinstance(constraint, BoolConstant):
+            if not constraint.value:
+                self.false = constraint
+            return
+
+        binding = _constant_binding(constraint)
+        if binding is not None:
+            variable, constant = binding
+            self.bindings[variable] = constant
+
+        roots = []
+        for variable in get_variables(constraint):
+            root = self.find(variable)
+            if root is None:
+                root = self._parents[variable] = variable
+                self._classes[root] = (None, variable, 1)
+            if all(root is not r for r in roots):
+                roots.append(root)
+        if not roots:
+            return
+
+        # Merge everything into the biggest class
+        classes = self._classes
+        roots.sort(key=lambda r: classes[r][2])
+        root = roots.pop()
+        constraints, variables, count = classes[root]
+        constraints = constraint if constraints is None else (constraints, constraint)
+        for other in roots:
+            other_constraints, other_variables, other_count = classes.pop(other)
+            self._parents[other] = root
+            if other_constraints is not None:
+                constraints = (constraints, other_constraints)
+            variables = (variables, other_variables)
+            count += other_count
+        classes[root] = (constraints, variables, count)
+
+    def related(self, roots):
+        ''' The constraints and the variables of the classes of roots '''
+        constraints, variables = set(), set()
+        for root in roots:
+            class_constraints, class_variables, _ = self._classes[root]
+            for tree, result in ((class_constraints, constraints), (class_variables, variables)):
+                stack = [tree]
+                while stack:
+                    node = stack.pop()
+                    if isinstance(node, tuple):
+                        stack.extend(node)
+                    elif node is not None:
+                        result.add(node)
+        return constraints, variables
+
+    @property
+    def variables(self):
+        return set(self._parents)
+
 
 class ConstraintSet(object):
     ''' Constraint Sets
@@ -18,15 +182,26 @@ class ConstraintSet(object):
         self._parent = None
         self._sid = 0
         self._child = None
+        # (_VariableIndex, ref to the parent it was built on, its own length)
+        self._index = None
+        # The last known model: [assignment, constraints it may not satisfy,
+        # number of own constraints checked against it] or None
+        self._model = [{}, [], 0]
 
     def __reduce__(self):
-        return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid})
+        return (self.__class__, (), {'_parent': self._parent, '_constraints': self._constraints, '_sid': self._sid,
+                                     '_model': self._model})
 
     def __enter__(self):
         assert self._child is None
         self._child = self.__class__()
         self._child._parent = self
         self._child._sid = self._sid
+        model = self._get_model()
+        if model is None:
+            self._child._model = None
+        else:
+            self._child._model = [model[0], list(model[1]), 0]
         return self._child
 
     def __exit__(self, ty, value, traceback):
@@ -48,6 +223,9 @@ class ConstraintSet(object):
         '''
         # XXX(yan): check is an unused param
         if isinstance(constraint, bool):
+            if constraint and self._child is None:
+                # Concrete checks pass a True, there is nothing to add
+                return
             constraint = BoolConstant(constraint)
         assert isinstance(constraint, Bool)
         constraint = simplify(constraint)
@@ -62,6 +240,8 @@ class ConstraintSet(object):
             if not constraint.value:
                 logger.info("Adding an imposible constant constraint")
                 self._constraints = [constraint]
+                self._index = None
+                self._model = None
             else:
                 return
 
@@ -73,87 +253,210 @@ class ConstraintSet(object):
         self._sid += 1
         return self._sid
 
-    def __get_related(self, related_to=None):
-        if related_to is not None:
-            number_of_constraints = len(self.constraints)
-            remaining_constraints = set(self.constraints)
-            related_variables = get_variables(related_to)
-            related_constraints = set()
-
-            added = True
-            while added:
-                added = False
-                logger.debug('Related variables %r', map(lambda x: x.name, related_variables))
-                for constraint in list(remaining_constraints):
-                    if isinstance(constraint, BoolConstant):
-                        if constraint.value:
-                            continue
-                        else:
-                            related_constraints = set((constraint,))
-                            break
-
-                    variables = get_variables(constraint)
-                    if related_variables & variables:
-                        remaining_constraints.remove(constraint)
-                        related_constraints.add(constraint)
-                        related_variables |= variables
-                        added = True
-
-            logger.debug('Reduced %d constraints!!', number_of_constraints - len(related_constraints))
+    def _get_index(self):
+        '''
+        The _VariableIndex of all the constraints. It is kept up to date
+        incrementally and a child set starts from a copy of the index of its
+        parent, which is frozen while the child exists.
+        '''
+        parent = self._parent
+        if self._index is not None:
+            index, parent_ref, parent_length, indexed = self._index
+            if parent_ref is None:
+                stale = parent is not None
+            else:
+                stale = parent_ref() is not parent or len(parent._constraints) != parent_length
         else:
-            related_variables = set()
-            for constraint in self.constraints:
-                related_variables |= get_variables(constraint)
-            related_constraints = set(self.constraints)
+            stale = True
+
+        if stale:
+            if parent is not None:
+                index = _VariableIndex(parent._get_index())
+                self._index = [index, ref(parent), len(parent._constraints), 0]
+            else:
+                index = _VariableIndex()
+                self._index = [index, None, 0, 0]
+            indexed = 0
+
+        for constraint in self._constraints[indexed:]:
+            index.add(constraint)
+        self._index[3] = len(self._constraints)
+        return index
+
+    def _overlay(self):
+        ''' Whether to resolve our few own constraints over the index of the parent '''
+        return self._parent is not None and self._index is None and \
+            len(self._constraints) <= max_overlay_constraints
+
+    def _get_bindings(self):
+        ''' The constants the variables of the set are constrained to equal '''
+        if not self._overlay():
+            return self._get_index().bindings
+        bindings = self._parent._get_index().bindings
+        own = [_constant_binding(constraint) for constraint in self._constraints]
+        own = [binding for binding in own if binding is not None]
+        if own:
+            bindings = dict(bindings)
+            bindings.update(own)
+        return bindings
 
+    def __get_related(self, related_to=None):
+        if related_to is None:
+            return self._get_index().variables, set(self.constraints)
+
+        if self._overlay():
+            # Few constraints of our own, resolve them over the index of the parent
+            index = self._parent._get_index()
+            own = [(constraint, get_variables(constraint)) for constraint in self._constraints]
+        else:
+            index = self._get_index()
+            own = []
+
+        related_variables = get_variables(related_to)
+        false = index.false
+        for constraint, _ in own:
+            if isinstance(constraint, BoolConstant) and not constraint.value:
+                false = constraint
+        if false is not None:
+            return related_variables, set((false,))
+
+        # Roots of the indexed classes of variables, by id
+        roots = {}
+
+        def add_roots(variables):
+            for variable in variables:
+                root = index.find(variable)
+                if root is not None:
+                    roots[id(root)] = root
+                else:
+                    roots[id(variable)] = variable
+
+        add_roots(related_variables)
+        related_own = []
+        added = True
+        while added:
+            added = False
+            for i, item in enumerate(own):
+                if any(id(variable) in roots or id(index.find(variable)) in roots for variable in item[1]):
+                    del own[i]
+                    related_own.append(item)
+                    add_roots(item[1])
+                    added = True
+                    break
+
+        related_constraints, variables = index.related(root for root in roots.itervalues()
+                                                       if index.find(root) is root)
+        related_variables |= variables
+        for constraint, variables in related_own:
+            related_constraints.add(constraint)
+            related_variables |= variables
+
+        logger.debug('%d related constraints', len(related_constraints))
         return related_variables, related_constraints
 
+    def _get_model(self):
+        '''
+        The last known model, with the constraints added since it was known
+        checked against it
+        '''
+        model = self._model
+        if model is None:
+            return None
+        assignment, pending, checked = model
+        for constraint in self._constraints[checked:]:
+            if evaluate(constraint, assignment) is not True:
+                pending.append(constraint)
+        model[2] = len(self._constraints)
+        return model
+
+    def model_satisfies(self, expression):
+        '''
+        Whether the last model known for the set satisfies every constraint and
+        expression, which then can be true. False means unknown.
+
+        :param expression: a Bool expression
+        :rtype: bool
+        '''
+        model = self._get_model()
+        if model is None or model[1]:
+            return False
+        return evaluate(expression, model[0]) is True
+
+    def update_model(self, values, related_to=None):
+        '''
+        Remember the model found by a sat check over the constraints related to
+        related_to (or all of them if it is None). The values of the other
+        variables are kept as they are still good for the other constraints.
+
+        :param values: a callable mapping a list of variables to their values in the model
+        :param related_to: the expression the check was related to
+        '''
+        model = self._get_model()
+        if model is None:
+            if related_to is not None:
+                return
+            model = [{}, [], 0]
+        variables, constraints = self.__get_related(related_to)
+        if any(isinstance(variable, Array) for variable in variables):
+            return
+        variables = list(variables)
+        assignment = dict(model[0])
+        assignment.update(zip(variables, values(variables)))
+        if related_to is None:
+            pending = []
+        else:
+            solved = set(id(constraint) for constraint in constraints)
+            pending = [constraint for constraint in model[1] if id(constraint) not in solved]
+        self._model = [assignment, pending, len(self._constraints)]
+
+    def related_to(self, expression=None):
+        '''
+        Get the constraints that (transitively) share variables with expression
+
+        :param expression: an expression or None to get all the constraints
+        :rtype: set
+        '''
+        return self.__get_related(expression)[1]
+
+    def fingerprint(self, related_to=None):
+        '''
+        Canonical digest of the constraints related to related_to. Sets holding
+        the same constraints get the same fingerprint regardless of their order
+        or of the objects representing them.
+
+        :param related_to: an expression or None to consider all the constraints
+        :rtype: str
+        '''
+        digests = sorted(fingerprint(constraint) for constraint in self.related_to(related_to))
+        return hashlib.sha1(''.join(digests)).digest()
+
     def to_string(self, related_to=None, replace_constants=False):
-        replace_constants = True
+        '''
+        The smtlib declarations and assertions of the constraints related to
+        related_to. Variables constrained to equal a constant are replaced by it.
+        Each constraint is translated once and its text reused by every query
+        and by every set forked from this one.
+        '''
         related_variables, related_constraints = self.__get_related(related_to)
+        bindings = self._get_bindings()
 
-        if replace_constants:
-            constant_bindings = {}
-            for expression in self.constraints:
-                if isinstance(expression, BoolEq) and \
-                   isinstance(expression.operands[0], Variable) and \
-                   isinstance(expression.operands[1], Constant):
-                    constant_bindings[expression.operands[0]] = expression.operands[1]
-
-        tmp = set()
-        result = ''
+        declared = set()
+        result = []
         for var in related_variables:
             # FIXME
             # band aid hack around the fact that we are double declaring stuff :( :(
-            if var.declaration in tmp:
-                #logger.warning("Variable '%s' was copied twice somewhere", var.name)
-                continue
-            tmp.add(var.declaration)
-            result += var.declaration + '\n'
+            declaration = var.declaration
+            if declaration not in declared:
+                declared.add(declaration)
+                result.append(declaration + '\n')
 
-        translator = TranslatorSmtlib(use_bindings=True)
+        assertions = []
         for constraint in related_constraints:
-            if replace_constants:
-                constraint = simplify(replace(constraint, constant_bindings))
-            translator.visit(constraint)
-
-        for name, exp, smtlib in translator.bindings:
-            if isinstance(exp, BitVec):
-                result += '(declare-fun %s () (_ BitVec %d))' % (name, exp.size)
-            elif isinstance(exp, Bool):
-                result += '(declare-fun %s () Bool)' % name
-            elif isinstance(exp, Array):
-                result += '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec %d)))' % (name, exp.index_bits, exp.value_bits)
-            else:
-                raise Exception("Type not supported %r", exp)
-            result += '(assert (= %s %s))\n' % (name, smtlib)
-
-        constraint_str = translator.pop()
-        while constraint_str is not None:
-            if constraint_str != 'true':
-                result += '(assert %s)\n' % constraint_str
-            constraint_str = translator.pop()
-        return result
+            declarations, assertion = _translate(constraint, bindings)
+            result.append(declarations)
+            assertions.append(assertion)
+        result.extend(assertions)
+        return ''.join(result)
 
     @property
     def declarations(self):
@@ -174,10 +477,10 @@ class ConstraintSet(object):
     def constraints(self):
         '''
         :rtype tuple
-        :return: All constraints represented by this and parent sets.
+        :return: All constraints represented by this and parent sets, oldest first.
         '''
         if self._parent is not None:
-            return tuple(self._constraints) + self._parent.constraints
+            return self._parent.constraints + tuple(self._constraints)
         return tuple(self._constraints)
 
     def __iter__(self):
@@ -185,35 +488,6 @@ class ConstraintSet(object):
 
     def __str__(self):
         ''' Returns a smtlib representation of the current state '''
-        result = ''
-        translator = TranslatorSmtlib()
-        for expression in self.constraints:
-            translator.visit(simplify(expression))
-
-        # band aid hack around the fact that we are double declaring stuff :( :(
-        tmp = set()
-        for d in self.declarations:
-            tmp.add(d.declaration)
-        for d in tmp:
-            result += d + '\n'
-
-        for name, exp, smtlib in translator.bindings:
-            if isinstance(exp, BitVec):
-                result += '(declare-fun %s () (_ BitVec %d))' % (name, exp.size)
-            elif isinstance(exp, Bool):
-                result += '(declare-fun %s () Bool)' % name
-            elif isinstance(exp, Array):
-                result += '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec %d)))' % (name, exp.index_bits, exp.value_bits)
-            else:
-                raise Exception("Type not supported %r", exp)
-            result += '(assert (= %s %s))\n' % (name, smtlib)
-
-        constraint_str = translator.pop()
-        while constraint_str is not None:
-            if constraint_str != 'true':
-                result += '(assert %s)\n' % constraint_str
-            constraint_str = translator.pop()
-
         return self.to_string()
 
     def _get_new_name(self, name='VAR'):
@@ -1,8 +1,61 @@
-from functools import reduce
+from weakref import WeakValueDictionary
+
+# Unique table of the immutable expressions, keyed by their structure:
+# (class, taint, constructor arguments with subexpressions replaced by id).
+# As subexpressions are unique too, structurally equal expressions built
+# anywhere are the same object.
+_unique = WeakValueDictionary()
+
+
+def _build(cls, args, taint):
+    return cls(*args, taint=taint)
+
+
+class InterningMetaclass(type):
+    '''
+    Metaclass of the expressions. Classes get no __dict__ unless they ask for it
+    in __slots__, and building an expression of an _interned class returns the
+    existing structurally equal one if there is any.
+    '''
+    def __new__(cls, name, parents, d):
+        d.setdefault('__slots__', ())
+        return super(InterningMetaclass, cls).__new__(cls, name, parents, d)
+
+    def __call__(cls, *args, **kwargs):
+        if not cls._interned or len(kwargs) > ('taint' in kwargs):
+            return super(InterningMetaclass, cls).__call__(*args, **kwargs)
+
+        key = [cls, None]
+        taint = kwargs.get('taint')
+        derived = taint is None and issubclass(cls, Operation)
+        for arg in args:
+            if isinstance(arg, Expression):
+                if arg._mutable:
+                    return super(InterningMetaclass, cls).__call__(*args, **kwargs)
+                if derived and arg.taint:
+                    taint = arg.taint if not taint else taint.union(arg.taint)
+                key.append(id(arg))
+            else:
+                key.append(arg)
+        key[1] = taint = frozenset(taint or ())
+        key = tuple(key)
+
+        expression = _unique.get(key)
+        if expression is None:
+            expression = super(InterningMetaclass, cls).__call__(*args, taint=taint)
+            _unique[key] = expression
+        return expression
 
 
 class Expression(object):
     ''' Abstract taintable Expression. '''
+    __metaclass__ = InterningMetaclass
+    __slots__ = ('_taint', '__weakref__')
+
+    # Expressions of _interned classes are unique and must never change
+    _interned = True
+    # Expressions that may change are never part of an interned one
+    _mutable = False
 
     def __init__(self, taint=()):
         if self.__class__ is Expression:
@@ -14,6 +67,13 @@ class Expression(object):
     def __repr__(self):
         return "<%s at %x>" % (type(self).__name__, id(self))
 
+    def _args(self):
+        ''' The constructor arguments rebuilding this expression '''
+        raise NotImplementedError
+
+    def __reduce__(self):
+        return _build, (self.__class__, self._args(), self.taint)
+
     @property
     def is_tainted(self):
         return len(self._taint) != 0
@@ -24,6 +84,8 @@ class Expression(object):
 
 
 class Variable(Expression):
+    _interned = False
+
     def __init__(self, name, *args, **kwargs):
         if self.__class__ is Variable:
             raise TypeError
@@ -68,7 +130,7 @@ class Operation(Expression):
 
         # If taint was not forced by a keyword argument calculate default
         if 'taint' not in kwargs:
-            kwargs['taint'] = reduce(lambda x, y: x.union(y.taint), operands, frozenset())
+            kwargs['taint'] = frozenset().union(*(x.taint for x in operands))
 
         super(Operation, self).__init__(**kwargs)
 
@@ -76,6 +138,11 @@ class Operation(Expression):
     def operands(self):
         return self._operands
 
+    def _args(self, operands=None):
+        ''' The constructor arguments rebuilding this operation, over other
+            operands if given '''
+        return self._operands if operands is None else tuple(operands)
+
 
 ###############################################################################
 # Booleans
@@ -124,6 +191,8 @@ class Bool(Expression):
 
 
 class BoolVariable(Bool, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, name, *args, **kwargs):
         super(BoolVariable, self).__init__(name, *args, **kwargs)
 
@@ -131,17 +200,27 @@ class BoolVariable(Bool, Variable):
     def declaration(self):
         return '(declare-fun %s () Bool)' % self.name
 
+    def _args(self):
+        return (self.name,)
+
 
 class BoolConstant(Bool, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, value, *args, **kwargs):
         assert isinstance(value, bool)
         super(BoolConstant, self).__init__(value, *args, **kwargs)
 
+    def _args(self):
+        return (self.value,)
+
     def __nonzero__(self):
         return self.value
 
 
 class BoolOperation(Operation, Bool):
+    __slots__ = ('_operands',)
+
     def __init__(self, *operands, **kwargs):
         super(BoolOperation, self).__init__(*operands, **kwargs)
 
@@ -183,6 +262,7 @@ class BoolITE(BoolOperation):
 
 class BitVec(Expression):
     ''' This adds a bitsize to the Expression class '''
+    __slots__ = ('size',)
 
     def __init__(self, size, *operands, **kwargs):
         super(BitVec, self).__init__(*operands, **kwargs)
@@ -372,6 +452,8 @@ class BitVec(Expression):
 
 
 class BitVecVariable(BitVec, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, *args, **kwargs):
         super(BitVecVariable, self).__init__(*args, **kwargs)
 
@@ -379,12 +461,20 @@ class BitVecVariable(BitVec, Variable):
     def declaration(self):
         return '(declare-fun %s () (_ BitVec %d))' % (self.name, self.size)
 
+    def _args(self):
+        return (self.size, self.name)
+
 
 class BitVecConstant(BitVec, Constant):
+    __slots__ = ('_value',)
+
     def __init__(self, size, value, *args, **kwargs):
         assert isinstance(value, (int, long))
         super(BitVecConstant, self).__init__(size, value, *args, **kwargs)
 
+    def _args(self):
+        return (self.size, self.value)
+
     def __nonzero__(self):
         return self.value != 0
 
@@ -395,6 +485,8 @@ class BitVecConstant(BitVec, Constant):
 
 
 class BitVecOperation(BitVec, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, size, *operands, **kwargs):
         #assert all(x.size == size for x in operands)
         super(BitVecOperation, self).__init__(size, *operands, **kwargs)
@@ -545,6 +637,8 @@ class UnsignedGreaterOrEqual(BoolOperation):
 ###############################################################################
 # Array  BV32 -> BV8  or BV64 -> BV8
 class Array(Expression):
+    __slots__ = ('_index_bits', '_index_max', '_value_bits')
+
     def __init__(self, index_bits, index_max, value_bits, *operands, **kwargs):
         assert index_bits in (32, 64, 256)
         assert value_bits in (8, 16, 32, 64, 256)
@@ -637,16 +731,25 @@ class Array(Expression):
         return BitVecConcat(size * self.value_bits, *reversed(bytes))
 
     def write_BE(self, address, value, size):
-        address = self.cast_index(address)
-        value = BitVec(size * self.value_bits).cast(value)
+        if not isinstance(address, (int, long)):
+            address = self.cast_index(address)
+        if isinstance(value, BitVecConstant) and not value.taint:
+            value = value.value
         array = self
+        if not isinstance(value, BitVec):
+            # concrete values are split in python
+            for offset in xrange(size):
+                shift = (size - 1 - offset) * self.value_bits
+                array = self.store(address + offset, (value >> shift) & ((1 << self.value_bits) - 1))
+            return array
         for offset in xrange(size):
             array = self.store(address + offset, BitVecExtract(value, (size - 1 - offset) * self.value_bits, self.value_bits))
         return array
 
     def write_LE(self, address, value, size):
         address = self.cast_index(address)
-        value = BitVec(size * self.value_bits).cast(value)
+        if not isinstance(value, BitVec):
+            value = BitVecConstant(size * self.value_bits, value)
         array = self
         for offset in reversed(xrange(size)):
             array = self.store(address + offset, BitVecExtract(value, (size - 1 - offset) * self.value_bits, self.value_bits))
@@ -654,6 +757,8 @@ class Array(Expression):
 
 
 class ArrayVariable(Array, Variable):
+    __slots__ = ('_name',)
+
     def __init__(self, index_bits, index_max, value_bits, name, *operands, **kwargs):
         super(ArrayVariable, self).__init__(index_bits, index_max, value_bits, name, **kwargs)
 
@@ -661,8 +766,13 @@ class ArrayVariable(Array, Variable):
     def declaration(self):
         return '(declare-fun %s () (Array (_ BitVec %d) (_ BitVec %d)))' % (self.name, self.index_bits, self.value_bits)
 
+    def _args(self):
+        return (self.index_bits, self.index_max, self.value_bits, self.name)
+
 
 class ArrayOperation(Array, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, array, *operands, **kwargs):
         assert isinstance(array, Array)
         super(ArrayOperation, self).__init__(array.index_bits, array.index_max, array.value_bits, array, *operands, **kwargs)
@@ -693,6 +803,10 @@ class ArrayStore(ArrayOperation):
 
 
 class ArraySlice(Array):
+    __slots__ = ('__dict__',)
+    _interned = False
+    _mutable = True
+
     def __init__(self, array, offset, size):
         if not isinstance(array, Array):
             raise ValueError("Array expected")
@@ -730,20 +844,50 @@ class ArraySlice(Array):
     def store(self, index, value):
         return self._array.store(index + self.slice_offset, value)
 
+    # A view over a mutable array, it is not rebuilt from operands
+    def __getstate__(self):
+        state = {}
+        state['_array'] = self._array
+        state['_slice_offset'] = self._slice_offset
+        state['_slice_size'] = self._slice_size
+        return state
+
+    def __setstate__(self, state):
+        self._array = state['_array']
+        self._slice_offset = state['_slice_offset']
+        self._slice_size = state['_slice_size']
+
+    __reduce__ = object.__reduce__
+
 
 class ArrayProxy(Array):
+    ''' A mutable array. Stores at concrete indexes are kept in a dict
+        overlay and only turned into a chain of ArrayStore when the whole
+        array is needed (see the array property) or a store at a symbolic
+        index must go over them. Reads at concrete indexes are resolved from
+        the overlay.
+    '''
+    __slots__ = ('__dict__',)
+    _interned = False
+    _mutable = True
+
     def __init__(self, array):
         assert isinstance(array, Array)
+        # concrete index -> value stored there not yet in self._array
+        self._pending = {}
+        # concrete index -> (value, how many symbolic stores preceded it)
         self._concrete_cache = {}
-        self._written = None
+        # (index, value) of the stores at symbolic indexes, in order
+        self._symbolic = []
         if isinstance(array, ArrayProxy):
             #copy constructor
             super(ArrayProxy, self).__init__(array.index_bits, array.index_max, array.value_bits)
             self._array = array._array
             self._name = array._name
+            self._pending = dict(array._pending)
             self._concrete_cache = dict(array._concrete_cache)
-            if array._written is not None:
-                self._written = set(array._written)
+            self._symbolic = list(array._symbolic)
+            self._taint = array._taint
         elif isinstance(array, ArrayVariable):
             #fresh array proxy
             super(ArrayProxy, self).__init__(array.index_bits, array.index_max, array.value_bits)
@@ -754,6 +898,15 @@ class ArrayProxy(Array):
             super(ArrayProxy, self).__init__(array.index_bits, array.index_max, array.value_bits)
             self._name = array.underlying_variable.name
             self._array = array
+            stores = []
+            while isinstance(array, ArrayStore):
+                stores.append((array.index, array.value))
+                array = array.array
+            for index, value in reversed(stores):
+                if isinstance(index, Constant):
+                    self._concrete_cache[index.value] = (value, len(self._symbolic))
+                else:
+                    self._symbolic.append((index, value))
 
     @property
     def underlying_variable(self):
@@ -761,6 +914,13 @@ class ArrayProxy(Array):
 
     @property
     def array(self):
+        ''' The array expression, with every store done so far '''
+        if self._pending:
+            array = self._array
+            for index in sorted(self._pending):
+                array = ArrayStore(array, BitVecConstant(self.index_bits, index), self._pending[index])
+            self._array = array
+            self._pending = {}
         return self._array
 
     @property
@@ -769,7 +929,7 @@ class ArrayProxy(Array):
 
     @property
     def operands(self):
-        return self._array.operands
+        return self.array.operands
 
     @property
     def index_bits(self):
@@ -785,32 +945,64 @@ class ArrayProxy(Array):
 
     @property
     def taint(self):
-        return self._array.taint
+        # _taint gathers the taints of the values stored at concrete indexes,
+        # which may not be in self._array yet
+        return self._array.taint | self._taint
 
     def select(self, index):
-        if not isinstance(index, Expression):
-            index = self.cast_index(index)
-        if self.index_max is not None:
-            from manticore.core.smtlib.visitors import simplify
-            index = simplify(BitVecITE(self.index_bits, index < 0, self.index_max + index + 1, index))
-        if isinstance(index, Constant) and index.value in self._concrete_cache:
-            return self._concrete_cache[index.value]
+        from manticore.core.smtlib.visitors import simplify
+        if isinstance(index, (int, long)) and 0 <= index < 1 << (self.index_bits - 1):
+            entry = self._concrete_cache.get(index)
+            if entry is not None and entry[1] == len(self._symbolic):
+                return entry[0]
+            index = BitVecConstant(self.index_bits, index)
+        else:
+            if not isinstance(index, Expression):
+                index = self.cast_index(index)
+            if self.index_max is not None:
+                index = simplify(BitVecITE(self.index_bits, index < 0, self.index_max + index + 1, index))
+            elif isinstance(index, Operation):
+                index = simplify(index)
+
+        if not isinstance(index, Constant):
+            return self.array.select(index)
 
-        return self._array.select(index)
+        entry = self._concrete_cache.get(index.value)
+        if entry is None:
+            # Only stores at other concrete indexes may be pending
+            return self._array.select(index)
+
+        # read over write, only the later symbolic stores may alias it
+        value, preceding = entry
+        if preceding == len(self._symbolic):
+            return value
+        for symbolic_index, symbolic_value in self._symbolic[preceding:]:
+            value = BitVecITE(self.value_bits, symbolic_index == index, symbolic_value, value)
+        return simplify(value)
 
     def store(self, index, value):
+        if isinstance(index, (int, long)):
+            if not isinstance(value, Expression):
+                value = self.cast_value(value)
+            self._pending[index] = value
+            self._concrete_cache[index] = (value, len(self._symbolic))
+            self._taint |= value.taint
+            return self
         if not isinstance(index, Expression):
             index = self.cast_index(index)
+        elif isinstance(index, Operation):
+            from manticore.core.smtlib.visitors import simplify
+            index = simplify(index)
         if not isinstance(value, Expression):
             value = self.cast_value(value)
-        from manticore.core.smtlib.visitors import simplify
-        index = simplify(index)
         if isinstance(index, Constant):
-            self._concrete_cache[index.value] = value
-        self.written.add(index)
-        auxiliar = self._array.store(index, value)
-        self._array = auxiliar
-        return auxiliar
+            self._pending[index.value] = value
+            self._concrete_cache[index.value] = (value, len(self._symbolic))
+            self._taint |= value.taint
+        else:
+            self._array = self.array.store(index, value)
+            self._symbolic.append((index, value))
+        return self
 
     def _fix_index(self, index):
         """
@@ -871,34 +1063,46 @@ class ArrayProxy(Array):
         state = {}
         state['_array'] = self._array
         state['name'] = self.name
+        state['_pending'] = self._pending
         state['_concrete_cache'] = self._concrete_cache
-        state['_written'] = self._written
+        state['_symbolic'] = self._symbolic
+        state['_taint'] = self._taint
         return state
 
     def __setstate__(self, state):
         self._array = state['_array']
         self._name = state['name']
+        self._pending = state['_pending']
         self._concrete_cache = state['_concrete_cache']
-        self._written = state['_written']
+        self._symbolic = state['_symbolic']
+        self._taint = state['_taint']
+
+    __reduce__ = object.__reduce__
 
     def __copy__(self):
         return ArrayProxy(self)
 
     @property
     def written(self):
-        if self._written is None:
-            written = set()
-            array = self._array
-            while not isinstance(array, ArrayVariable):
-                written.add(array.index)
-                array = array.array
-            self._written = written
-        return self._written
+        written = set(BitVecConstant(self.index_bits, index) for index in self._concrete_cache)
+        written.update(index for index, _ in self._symbolic)
+        return written
 
     def is_known(self, index):
         #return reduce(BoolOr, map(lambda known_index: index == known_index, self.written), BoolConstant(False))
+        if isinstance(self._array, ArraySlice) and isinstance(self._array._array, ArrayProxy) and \
+                not self._concrete_cache and not self._symbolic:
+            return self._array._array.is_known(index + self._array._slice_offset)
+        if not isinstance(index, Expression):
+            index = self.cast_index(index)
+        if isinstance(index, Constant):
+            if index.value in self._concrete_cache:
+                return BoolConstant(True)
+            # Then only a store at a symbolic index may have written it
+            written = [symbolic_index for symbolic_index, _ in self._symbolic]
+        else:
+            written = self.written
         is_known_index = BoolConstant(False)
-        written = self.written
         for known_index in written:
             if isinstance(index, Constant) and isinstance(known_index, Constant):
                 if known_index.value == index.value:
@@ -915,10 +1119,14 @@ class ArrayProxy(Array):
         is_known = self.is_known(index)
         index = self.cast_index(index)
         default = self.cast_value(default)
+        if isinstance(is_known, Constant):
+            return value if is_known.value else default
         return BitVecITE(self._array.value_bits, is_known, value, default)
 
 
 class ArraySelect(BitVec, Operation):
+    __slots__ = ('_operands',)
+
     def __init__(self, array, index, *args, **kwargs):
         assert isinstance(array, Array)
         assert isinstance(index, BitVec) and index.size == array.index_bits
@@ -934,6 +1142,8 @@ class ArraySelect(BitVec, Operation):
 
 
 class BitVecSignExtend(BitVecOperation):
+    __slots__ = ('extend',)
+
     def __init__(self, operand, size_dest, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, (int, long))
@@ -941,8 +1151,13 @@ class BitVecSignExtend(BitVecOperation):
         super(BitVecSignExtend, self).__init__(size_dest, operand, *args, **kwargs)
         self.extend = size_dest - operand.size
 
+    def _args(self, operands=None):
+        return tuple(operands or self.operands) + (self.size,)
+
 
 class BitVecZeroExtend(BitVecOperation):
+    __slots__ = ('extend',)
+
     def __init__(self, size_dest, operand, *args, **kwargs):
         assert isinstance(operand, BitVec)
         assert isinstance(size_dest, (int, long))
@@ -950,8 +1165,13 @@ class BitVecZeroExtend(BitVecOperation):
         super(BitVecZeroExtend, self).__init__(size_dest, operand, *args, **kwargs)
         self.extend = size_dest - operand.size
 
+    def _args(self, operands=None):
+        return (self.size,) + tuple(operands or self.operands)
+
 
 class BitVecExtract(BitVecOperation):
+    __slots__ = ('begining', 'end')
+
     def __init__(self, operand, offset, size, *args, **kwargs):
         assert isinstance(offset, (int, long))
         assert isinstance(size, (int, long))
@@ -960,6 +1180,9 @@ class BitVecExtract(BitVecOperation):
         self.begining = offset
         self.end = offset + size - 1
 
+    def _args(self, operands=None):
+        return tuple(operands or self.operands) + (self.begining, self.size)
+
 
 class BitVecConcat(BitVecOperation):
     def __init__(self, size_dest, *operands, **kwargs):
@@ -968,6 +1191,9 @@ class BitVecConcat(BitVecOperation):
         assert size_dest == sum(map(lambda x: x.size, operands))
         super(BitVecConcat, self).__init__(size_dest, *operands, **kwargs)
 
+    def _args(self, operands=None):
+        return (self.size,) + tuple(operands or self.operands)
+
 
 class BitVecITE(BitVecOperation):
     def __init__(self, size, condition, true_value, false_value, *args, **kwargs):
@@ -976,3 +1202,6 @@ class BitVecITE(BitVecOperation):
         assert true_value.size == size
         assert false_value.size == size
         super(BitVecITE, self).__init__(size, condition, true_value, false_value, *args, **kwargs)
+
+    def _args(self, operands=None):
+        return (self.size,) + tuple(operands or self.operands)
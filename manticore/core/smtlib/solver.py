@@ -19,11 +19,18 @@ from . import operators as Operators
 from .expression import *
 from .constraints import *
 import logging
+import os
 import re
 import time
 from .visitors import *
 from ...utils.helpers import issymbolic, istainted, taint_with, get_taints, memoized
+import atexit
 import collections
+from weakref import ref, WeakSet
+try:
+    import z3
+except ImportError:
+    z3 = None
 
 logger = logging.getLogger(__name__)
 
@@ -46,9 +53,98 @@ class TooManySolutions(SolverException):
         self.solutions = solutions
 
 
+class SolverCache(object):
+    ''' A bounded LRU map from query fingerprints to solver answers.
+
+        It can be backed by a list shared among workers (ex. a SyncManager
+        list proxy) so an answer found by one worker is reused by the others.
+        The answers go through it in batches, see sync. Once it holds
+        max_shared answers the new ones stay local.
+    '''
+
+    def __init__(self, maxsize=0x4000, shared=None, batch_size=0x100, max_shared=0x10000):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_shared = max_shared
+        self._entries = collections.OrderedDict()
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return self._shared
+
+    @shared.setter
+    def shared(self, shared):
+        self._shared = shared
+        self._outgoing = []  # answers found here not published yet
+        self._seen = 0       # batches of the shared list already taken
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        ''' Returns the answer cached for key or None '''
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        ''' Remember value as the answer for key '''
+        assert value is not None
+        self._remember(key, value)
+        if self._shared is not None:
+            self._outgoing.append((key, value))
+            if len(self._outgoing) >= self.batch_size:
+                self.sync()
+
+    def _remember(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def sync(self):
+        ''' Publish the answers found here since the last sync and take the
+            ones the other workers published in the meantime
+        '''
+        if self._shared is None:
+            return
+        if self._outgoing and self._seen * self.batch_size < self.max_shared:
+            self._shared.append(tuple(self._outgoing))
+        self._outgoing = []
+        batches = self._shared[self._seen:]
+        self._seen += len(batches)
+        for batch in batches:
+            for key, value in batch:
+                self._remember(key, value)
+
+    def clear(self):
+        ''' Forget the answers cached here (the shared ones stay) '''
+        self._entries.clear()
+        self._outgoing = []
+
+
 class Solver(object):
     def __init__(self):
-        pass
+        self.cache = SolverCache()
+
+    def _query_key(self, kind, constraints, expression=None, *args):
+        ''' Builds a cache key for a query about expression. Only the slice of
+            constraints related to expression takes part in the key, so
+            different constraint sets sharing that slice share the answer.
+        '''
+        if expression is None:
+            expression_fingerprint = None
+        else:
+            expression_fingerprint = fingerprint(expression)
+        return (kind, constraints.fingerprint(related_to=expression), expression_fingerprint) + args
 
     def optimize(self, constraints, X, operation, M=10000):
         ''' Iterativelly finds the maximum or minimal value for the operation
@@ -67,6 +163,53 @@ class Solver(object):
         ''' Check if expression can be valid '''
         raise Exception("Abstract method not implemented")
 
+    def can_be_true_many(self, constraints, expressions):
+        ''' Check if each of expressions can be valid, independently of the others.
+            Implementations may answer the checks concurrently.
+            :param expressions: a list of Bool expressions
+            :rtype: list[bool]
+        '''
+        return [self.can_be_true(constraints, expression) for expression in expressions]
+
+    def _dispatch_checks(self, constraints, expressions, solvers):
+        ''' Auxiliary method to split the non cached checks of expressions
+            among solvers. All the queries are sent before any answer is
+            read back so the external processes work on them concurrently.
+        '''
+        results = []
+        pending = []
+        for i, expression in enumerate(expressions):
+            if isinstance(expression, bool):
+                results.append(self.can_be_true(constraints, expression))
+                continue
+            assert isinstance(expression, Bool)
+            key = self._query_key('can_be_true', constraints, expression)
+            result = self.cache.get(key)
+            if result is None:
+                pending.append((i, key))
+            results.append(result)
+
+        if not pending:
+            return results
+
+        chunks = [pending[i::len(solvers)] for i in xrange(len(solvers))]
+        busy = []
+        try:
+            for solver, chunk in zip(solvers, chunks):
+                if chunk:
+                    busy.append(solver)
+                    solver._submit_checks(constraints, [expressions[i] for i, _ in chunk])
+            for solver, chunk in zip(solvers, chunks):
+                for (i, key), result in zip(chunk, solver._collect_checks(len(chunk))):
+                    self.cache.put(key, result)
+                    results[i] = result
+        except BaseException:
+            # Answers left in the pipes would be taken for the next queries
+            for solver in busy:
+                solver._stop_proc()
+            raise
+        return results
+
     def get_all_values(self, constraints, x, maxcnt=10000, silent=False):
         ''' Returns a list with all the possible values for the symbol x'''
         raise Exception("Abstract method not implemented")
@@ -78,6 +221,12 @@ class Solver(object):
             :param val: an expression or symbol '''
         raise Exception("Abstract method not implemented")
 
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one model and return the values it assigns to
+            each of expressions. The current set of assertions must be sat.
+            :param expressions: a list of expressions or symbols '''
+        raise Exception("Abstract method not implemented")
+
     def max(self, constraints, X, M=10000):
         ''' Iterativelly finds the maximum value for a symbol.
             :param X: a symbol or expression
@@ -107,17 +256,41 @@ class Solver(object):
 # FixME move this \/ This configuration should be registered as global config
 consider_unknown_as_unsat = True
 
+# Number of external solver processes a SolverPool may keep warm
+solver_pool_size = 4
+
+# Answer the queries in process through the z3 python bindings when they are
+# installed. The external z3 process is used otherwise
+use_native_solver = True
+
+# Keep a live session in the external z3 processes built by new_solver, only
+# pushing and popping the constraints that changed between their queries
+incremental_solver = True
+
 
 Version = collections.namedtuple('Version', 'major minor patch')
 
 
 class Z3Solver(Solver):
-    def __init__(self):
+    def __init__(self, incremental=False):
         ''' Build a Z3 solver instance.
             This is implemented using an external z3 solver (via a subprocess).
+
+            :param incremental: if True keep a live z3 session and only push/pop
+                                the constraints that changed between queries
+                                instead of resending the whole set every time
         '''
         super(Z3Solver, self).__init__()
         self._proc = None
+        self._pid = None
+
+        # Incremental session. Every asserted constraint lives in its own
+        # (push 1) level together with the declarations it introduced.
+        self.incremental = incremental
+        self._asserted = []         # [(constraint, fingerprint)] one per level
+        self._declared = []         # [set(declaration)] one per level
+        self._declarations = set()  # union of self._declared
+        self._in_query = False      # an extra level for the running query
 
         self.version = self._solver_version()
 
@@ -140,6 +313,7 @@ class Z3Solver(Solver):
         self._command = 'z3 -t:240000 -memory:16384 -smt2 -in'
         self._init = ['(set-logic QF_AUFBV)', '(set-option :global-decls false)']
         self._get_value_fmt = (re.compile('\(\((?P<expr>(.*))\ #x(?P<value>([0-9a-fA-F]*))\)\)'), 16)
+        self._get_values_fmt = re.compile(r'\((?P<expr>[^\s()]+)\s+(?P<value>#x[0-9a-fA-F]+|#b[01]+|true|false)\)')
 
     @staticmethod
     def _solver_version():
@@ -174,6 +348,8 @@ class Z3Solver(Solver):
             print(e, "Probably too  much cached expressions? visitors._cache...")
             # Z3 was removed from the system in the middle of operation
             raise Z3NotFoundError  # TODO(mark) don't catch this exception in two places
+        self._pid = os.getpid()
+        self._clear_session()
 
         # run solver specific initializations
         for cfg in self._init:
@@ -195,6 +371,14 @@ class Z3Solver(Solver):
         except BaseException:
             pass
         self._proc = None
+        self._clear_session()
+
+    def _clear_session(self):
+        ''' Forget everything the incremental session has asserted '''
+        self._asserted = []
+        self._declared = []
+        self._declarations = set()
+        self._in_query = False
 
     # marshaling/pickle
     def __getstate__(self):
@@ -226,6 +410,74 @@ class Z3Solver(Solver):
         if constraints is not None:
             self._send(constraints)
 
+    def _sync(self, constraints):
+        ''' Auxiliary method to bring the live solver session in line with
+            constraints. The longest already asserted prefix is kept, the stale
+            levels are popped and only the missing constraints are pushed.
+            Anything sent after this lands in a scratch level that is discarded
+            on the next sync.
+        '''
+        if self._proc is None or self._pid != os.getpid():
+            # The process was inherited from the parent of this worker. It is
+            # not ours to talk to, so just spawn a fresh one.
+            self._proc = None
+            self._start_proc()
+
+        try:
+            if self._in_query:
+                self._pop()
+                self._in_query = False
+
+            new_constraints = constraints.constraints
+            common = 0
+            for (asserted, digest), constraint in zip(self._asserted, new_constraints):
+                if asserted is not constraint:
+                    # Same constraint coming from a different object (ex. a
+                    # state that was just unpickled) can be kept as well
+                    if fingerprint(constraint) != digest:
+                        break
+                    self._asserted[common] = (constraint, digest)
+                common += 1
+
+            stale = len(self._asserted) - common
+            if stale:
+                self._send('(pop %d)' % stale)
+                for declared in self._declared[common:]:
+                    self._declarations -= declared
+                del self._asserted[common:]
+                del self._declared[common:]
+
+            for constraint in new_constraints[common:]:
+                smtlib = translate_to_smtlib(constraint, use_bindings=True)
+                declared = set(var.declaration for var in get_variables(constraint))
+                declared -= self._declarations
+                self._push()
+                for declaration in declared:
+                    self._send(declaration)
+                self._send('(assert %s)' % smtlib)
+                self._asserted.append((constraint, fingerprint(constraint)))
+                self._declared.append(declared)
+                self._declarations |= declared
+
+            self._push()
+            self._in_query = True
+        except BaseException:
+            # The session is in an unknown state. Start over next time
+            self._stop_proc()
+            raise
+
+    def _prepare(self, constraints, related_to=None):
+        ''' Auxiliary method to get the solver ready to answer a query over
+            constraints. Non incremental solvers only get the constraints
+            related to related_to (or all of them if it is None)
+        '''
+        if self.incremental:
+            self._sync(constraints)
+        elif related_to is None:
+            self._reset(constraints)
+        else:
+            self._reset(constraints.to_string(related_to=related_to))
+
     def _send(self, cmd):
         ''' Send a string to the solver.
             :param cmd: a SMTLIBv2 command (ex. (check-sat))
@@ -266,8 +518,13 @@ class Z3Solver(Solver):
         logger.debug("Solver.check() ")
         start = time.time()
         self._send('(check-sat)')
-        _status = self._recv()
+        _status = self._recv_status()
         logger.debug("Check took %s seconds (%s)", time.time() - start, _status)
+        return _status
+
+    def _recv_status(self):
+        ''' Reads the answer to a (check-sat) '''
+        _status = self._recv()
         if _status not in ('sat', 'unsat', 'unknown'):
             raise SolverException(_status)
         if consider_unknown_as_unsat:
@@ -308,6 +565,29 @@ class Z3Solver(Solver):
             return int(value, base)
         raise NotImplementedError("_getvalue only implemented for Bool and BitVec")
 
+    def _getvalues(self, variables):
+        ''' Ask the solver for the values of variables in the model of the
+            last check, which must have been sat '''
+        if not variables:
+            return []
+        self._send('(get-value (%s))' % ' '.join(var.name for var in variables))
+        ret = self._recv()
+        if not (ret.startswith('((') and ret.endswith('))')):
+            raise SolverException('SMTLIB error parsing response: %s' % ret)
+        model = {}
+        for m in self._get_values_fmt.finditer(ret):
+            value = m.group('value')
+            if value in ('true', 'false'):
+                model[m.group('expr')] = value == 'true'
+            elif value.startswith('#x'):
+                model[m.group('expr')] = int(value[2:], 16)
+            else:
+                model[m.group('expr')] = int(value[2:], 2)
+        try:
+            return [model[var.name] for var in variables]
+        except KeyError as e:
+            raise SolverException('SMTLIB error parsing response, %s not found' % e)
+
     # push pop
     def _push(self):
         ''' Pushes and save the current constraint store and state.'''
@@ -317,7 +597,6 @@ class Z3Solver(Solver):
         ''' Recall the last pushed constraint store  and state. '''
         self._send('(pop 1)')
 
-    #@memoized
     def can_be_true(self, constraints, expression):
         ''' Check if two potentially symbolic values can be equal '''
         if isinstance(expression, bool):
@@ -325,17 +604,64 @@ class Z3Solver(Solver):
                 return expression
             else:
                 #if True check if constraints are feasible
-                self._reset(constraints)
-                return self._check() == 'sat'
+                key = self._query_key('check', constraints)
+                result = self.cache.get(key)
+                if result is None:
+                    self._prepare(constraints)
+                    result = self._check() == 'sat'
+                    if result:
+                        constraints.update_model(self._getvalues)
+                    self.cache.put(key, result)
+                return result
         assert isinstance(expression, Bool)
 
+        # The last model may already be an answer
+        if constraints.model_satisfies(expression):
+            return True
+
+        key = self._query_key('can_be_true', constraints, expression)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
         with constraints as temp_cs:
             temp_cs.add(expression)
-            self._reset(temp_cs.to_string(related_to=expression))
-            return self._check() == 'sat'
+            self._prepare(temp_cs, related_to=expression)
+            result = self._check() == 'sat'
+            if result:
+                constraints.update_model(self._getvalues, related_to=expression)
+        self.cache.put(key, result)
+        return result
+
+    def can_be_true_many(self, constraints, expressions):
+        ''' Check if each of expressions can be valid, independently of the others.
+            The checks are pipelined through the solver process.
+        '''
+        return self._dispatch_checks(constraints, expressions, [self])
+
+    def _submit_checks(self, constraints, expressions):
+        ''' Auxiliary method to send one (check-sat) per expression without
+            waiting for the answers. They must be read with _collect_checks.
+        '''
+        with constraints as temp_cs:
+            flags = []
+            for expression in expressions:
+                flag = temp_cs.new_bool()
+                temp_cs.add(flag == expression)
+                flags.append(flag)
+            self._prepare(temp_cs)
+
+        for flag in flags:
+            self._push()
+            self._send('(assert %s)' % flag.name)
+            self._send('(check-sat)')
+            self._pop()
+
+    def _collect_checks(self, count):
+        ''' Auxiliary method to read back the answers of count pending checks '''
+        return [self._recv_status() == 'sat' for _ in xrange(count)]
 
     # get-all-values min max minmax
-    #@memoized
     def get_all_values(self, constraints, expression, maxcnt=30000, silent=False):
         ''' Returns a list with all the possible values for the symbol x'''
         if not isinstance(expression, Expression):
@@ -343,6 +669,14 @@ class Z3Solver(Solver):
         assert isinstance(constraints, ConstraintSet)
         assert isinstance(expression, Expression)
 
+        key = self._query_key('get_all_values', constraints, expression, maxcnt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            values, complete = cached
+            if not complete and not silent:
+                raise TooManySolutions(list(values))
+            return list(values)
+
         with constraints as temp_cs:
             if isinstance(expression, Bool):
                 var = temp_cs.new_bool()
@@ -352,16 +686,19 @@ class Z3Solver(Solver):
                 raise NotImplementedError("get_all_values only implemted for Bool and BitVec")
 
             temp_cs.add(var == expression)
-            self._reset(temp_cs.to_string(related_to=var))
+            self._prepare(temp_cs, related_to=var)
 
             result = []
             val = None
             while self._check() == 'sat':
+                if not result:
+                    constraints.update_model(self._getvalues, related_to=expression)
                 value = self._getvalue(var)
                 result.append(value)
                 self._assert(var != value)
 
                 if len(result) >= maxcnt:
+                    self.cache.put(key, (tuple(result), False))
                     if silent:
                         # do not throw an exception if set to silent
                         # Default is not silent, assume user knows
@@ -370,9 +707,10 @@ class Z3Solver(Solver):
                         break
                     else:
                         raise TooManySolutions(result)
+            else:
+                self.cache.put(key, (tuple(result), True))
             return result
 
-    #@memoized
     def optimize(self, constraints, x, goal, M=10000):
         ''' Iterativelly finds the maximum or minimal value for the operation
             (Normally Operators.UGT or Operators.ULT)
@@ -381,13 +719,22 @@ class Z3Solver(Solver):
         '''
         assert goal in ('maximize', 'minimize')
         assert isinstance(x, BitVec)
+
+        key = self._query_key('optimize', constraints, x, goal)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._optimize(constraints, x, goal, M)
+            self.cache.put(key, result)
+        return result
+
+    def _optimize(self, constraints, x, goal, M=10000):
         operation = {'maximize': Operators.UGE, 'minimize': Operators.ULE}[goal]
 
         with constraints as temp_cs:
             X = temp_cs.new_bitvec(x.size)
             temp_cs.add(X == x)
             aux = temp_cs.new_bitvec(X.size, name='optimized_')
-            self._reset(temp_cs.to_string(related_to=X))
+            self._prepare(temp_cs, related_to=X)
             self._send(aux.declaration)
 
             if getattr(self, 'support_{}'.format(goal)):
@@ -419,8 +766,9 @@ class Z3Solver(Solver):
                         return int(value)
                 finally:
                     self._pop()
-                    self._reset(temp_cs)
-                    self._send(aux.declaration)
+                    if not self.incremental:
+                        self._reset(temp_cs)
+                        self._send(aux.declaration)
 
             operation = {'maximize': Operators.UGT, 'minimize': Operators.ULT}[goal]
             self._assert(aux == X)
@@ -436,7 +784,6 @@ class Z3Solver(Solver):
                 return last_value
             raise SolverException("Optimizing error, unsat or unknown core")
 
-    #@memoized
     def get_value(self, constraints, expression):
         ''' Ask the solver for one possible assignment for val using current set
             of constraints.
@@ -445,6 +792,20 @@ class Z3Solver(Solver):
         if not issymbolic(expression):
             return expression
         assert isinstance(expression, (Bool, BitVec, Array))
+
+        key = self._query_key('get_value', constraints, expression)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._get_value(constraints, expression)
+            if isinstance(result, bytearray):
+                self.cache.put(key, str(result))
+            else:
+                self.cache.put(key, result)
+        elif isinstance(result, str):
+            result = bytearray(result)
+        return result
+
+    def _get_value(self, constraints, expression):
         with constraints as temp_cs:
             if isinstance(expression, Bool):
                 var = temp_cs.new_bool()
@@ -458,9 +819,10 @@ class Z3Solver(Solver):
                     var.append(subvar)
                     temp_cs.add(subvar == expression[i])
 
-                self._reset(temp_cs)
+                self._prepare(temp_cs)
                 if self._check() != 'sat':
                     raise SolverException('Model is not available')
+                constraints.update_model(self._getvalues)
 
                 for i in xrange(expression.index_max):
                     self._send('(get-value (%s))' % var[i].name)
@@ -474,10 +836,11 @@ class Z3Solver(Solver):
 
             temp_cs.add(var == expression)
 
-            self._reset(temp_cs)
+            self._prepare(temp_cs)
 
         if self._check() != 'sat':
             raise SolverException('Model is not available')
+        constraints.update_model(self._getvalues)
 
         self._send('(get-value (%s))' % var.name)
         ret = self._recv()
@@ -493,5 +856,533 @@ class Z3Solver(Solver):
             return int(value, base)
         raise NotImplementedError("get_value only implemented for Bool and BitVec")
 
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one model and return the values it assigns to
+            each of expressions. A single check-sat and get-value is sent no
+            matter how many expressions are asked for.
+            The current set of assertions must be sat.
+            :param expressions: a list of expressions or symbols '''
+        expressions = list(expressions)
+        symbolic = [x for x in expressions if issymbolic(x)]
+        if not symbolic:
+            return expressions
+        for expression in symbolic:
+            assert isinstance(expression, (Bool, BitVec, Array))
+
+        key = ('get_values', constraints.fingerprint(), tuple(fingerprint(x) for x in symbolic))
+        values = self.cache.get(key)
+        if values is None:
+            values = self._get_values(constraints, symbolic)
+            self.cache.put(key, tuple(str(v) if isinstance(v, bytearray) else v for v in values))
+        else:
+            values = [bytearray(v) if isinstance(v, str) else v for v in values]
+
+        values = iter(values)
+        return [next(values) if issymbolic(x) else x for x in expressions]
+
+    def _get_values(self, constraints, expressions):
+        with constraints as temp_cs:
+            variables = []
+            for expression in expressions:
+                if isinstance(expression, Bool):
+                    var = temp_cs.new_bool()
+                    temp_cs.add(var == expression)
+                elif isinstance(expression, BitVec):
+                    var = temp_cs.new_bitvec(expression.size)
+                    temp_cs.add(var == expression)
+                else:
+                    var = []
+                    for i in xrange(expression.index_max):
+                        subvar = temp_cs.new_bitvec(expression.value_bits)
+                        var.append(subvar)
+                        temp_cs.add(subvar == expression[i])
+                variables.append(var)
+
+            self._prepare(temp_cs)
+
+        if self._check() != 'sat':
+            raise SolverException('Model is not available')
+        constraints.update_model(self._getvalues)
+
+        names = []
+        for var in variables:
+            if isinstance(var, list):
+                names.extend(subvar.name for subvar in var)
+            else:
+                names.append(var.name)
+
+        model = {}
+        if names:
+            self._send('(get-value (%s))' % ' '.join(names))
+            ret = self._recv()
+            if not (ret.startswith('((') and ret.endswith('))')):
+                raise SolverException('SMTLIB error parsing response: %s' % ret)
+            for m in self._get_values_fmt.finditer(ret):
+                value = m.group('value')
+                if value in ('true', 'false'):
+                    model[m.group('expr')] = value == 'true'
+                elif value.startswith('#x'):
+                    model[m.group('expr')] = int(value[2:], 16)
+                else:
+                    model[m.group('expr')] = int(value[2:], 2)
+
+        try:
+            result = []
+            for var in variables:
+                if isinstance(var, list):
+                    result.append(bytearray(model[subvar.name] for subvar in var))
+                else:
+                    result.append(model[var.name])
+        except KeyError as e:
+            raise SolverException('SMTLIB error parsing response, %s not found' % e)
+        return result
+
+
+class _TermCache(object):
+    ''' The z3 terms of the expressions translated so far. Keyed by id as
+        expressions overload __eq__, an entry goes away with its expression.
+    '''
+
+    def __init__(self):
+        self._entries = {}  # id(expression) -> (ref(expression), term)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, expression):
+        entry = self._entries.get(id(expression))
+        return entry is not None and entry[0]() is expression
+
+    def __getitem__(self, expression):
+        entry = self._entries.get(id(expression))
+        if entry is None or entry[0]() is not expression:
+            raise KeyError(expression)
+        return entry[1]
+
+    def __setitem__(self, expression, term):
+        key = id(expression)
+        entries = self._entries
+        entries[key] = (ref(expression, lambda _, key=key: entries.pop(key, None)), term)
+
+
+class TranslatorZ3(Visitor):
+    ''' Translates an expression to a term of the z3 python bindings '''
+
+    def __init__(self, context, *args, **kw):
+        super(TranslatorZ3, self).__init__(*args, **kw)
+        self.context = context
+
+    translation_table = {
+        BoolNot: lambda a: z3.Not(a),
+        BoolEq: lambda a, b: a == b,
+        BoolAnd: lambda *operands: z3.And(*operands),
+        BoolOr: lambda *operands: z3.Or(*operands),
+        BoolXor: lambda a, b: z3.Xor(a, b),
+        BoolITE: lambda c, a, b: z3.If(c, a, b),
+        BitVecAdd: lambda a, b: a + b,
+        BitVecSub: lambda a, b: a - b,
+        BitVecMul: lambda a, b: a * b,
+        BitVecDiv: lambda a, b: a / b,
+        BitVecUnsignedDiv: lambda a, b: z3.UDiv(a, b),
+        BitVecMod: lambda a, b: a % b,
+        BitVecRem: lambda a, b: z3.SRem(a, b),
+        BitVecUnsignedRem: lambda a, b: z3.URem(a, b),
+        BitVecShiftLeft: lambda a, b: a << b,
+        BitVecShiftRight: lambda a, b: z3.LShR(a, b),
+        BitVecArithmeticShiftLeft: lambda a, b: a << b,
+        BitVecArithmeticShiftRight: lambda a, b: a >> b,
+        BitVecAnd: lambda a, b: a & b,
+        BitVecOr: lambda a, b: a | b,
+        BitVecXor: lambda a, b: a ^ b,
+        BitVecNot: lambda a: ~a,
+        BitVecNeg: lambda a: -a,
+        LessThan: lambda a, b: a < b,
+        LessOrEqual: lambda a, b: a <= b,
+        Equal: lambda a, b: a == b,
+        GreaterThan: lambda a, b: a > b,
+        GreaterOrEqual: lambda a, b: a >= b,
+        UnsignedLessThan: lambda a, b: z3.ULT(a, b),
+        UnsignedLessOrEqual: lambda a, b: z3.ULE(a, b),
+        UnsignedGreaterThan: lambda a, b: z3.UGT(a, b),
+        UnsignedGreaterOrEqual: lambda a, b: z3.UGE(a, b),
+        # z3.Concat needs two operands at least
+        BitVecConcat: lambda *operands: z3.Concat(*operands) if len(operands) > 1 else operands[0],
+        BitVecITE: lambda c, a, b: z3.If(c, a, b),
+        ArrayStore: lambda a, i, v: z3.Store(a, i, v),
+        ArraySelect: lambda a, i: z3.Select(a, i),
+    }
+
+    def visit_BitVecConstant(self, expression):
+        return z3.BitVecVal(expression.value & expression.mask, expression.size, self.context)
+
+    def visit_BoolConstant(self, expression):
+        return z3.BoolVal(expression.value, self.context)
+
+    def visit_BitVecVariable(self, expression):
+        return z3.BitVec(expression.name, expression.size, self.context)
+
+    def visit_BoolVariable(self, expression):
+        return z3.Bool(expression.name, self.context)
+
+    def visit_ArrayVariable(self, expression):
+        return z3.Array(expression.name,
+                        z3.BitVecSort(expression.index_bits, self.context),
+                        z3.BitVecSort(expression.value_bits, self.context))
+
+    def visit_BitVecSignExtend(self, expression, operand):
+        return z3.SignExt(expression.extend, operand)
+
+    def visit_BitVecZeroExtend(self, expression, operand):
+        return z3.ZeroExt(expression.extend, operand)
+
+    def visit_BitVecExtract(self, expression, operand):
+        return z3.Extract(expression.end, expression.begining, operand)
+
+    def visit_Operation(self, expression, *operands):
+        return self.translation_table[type(expression)](*operands)
+
+
+# The z3 terms must go before the z3 module is torn down at exit
+_native_solvers = WeakSet()
+
+
+@atexit.register
+def _stop_native_solvers():
+    for native_solver in list(_native_solvers):
+        native_solver._stop_proc()
+
+
+class Z3NativeSolver(Solver):
+    def __init__(self):
+        ''' Build a Z3 solver instance over the z3 python bindings.
+            Expressions are translated straight to z3 terms, each one once, so
+            no smtlib is printed nor parsed and there is no process to talk to.
+        '''
+        if z3 is None:
+            raise Z3NotFoundError
+        super(Z3NativeSolver, self).__init__()
+        self._pid = None
+        self._context = None
+        self._solver = None
+        self._terms = None
+        self._timeout = 240000
+
+    def _start(self):
+        ''' Auxiliary method to set up a fresh z3 solver '''
+        self._context = z3.main_ctx()
+        self._solver = z3.SolverFor('QF_AUFBV', ctx=self._context)
+        self._solver.set('timeout', self._timeout)
+        self._terms = _TermCache()
+        self._pid = os.getpid()
+        _native_solvers.add(self)
+
+    def _stop_proc(self):
+        ''' Auxiliary method to drop the z3 solver and its terms '''
+        self._pid = None
+        self._context = None
+        self._solver = None
+        self._terms = None
+
+    # marshaling/pickle
+    def __getstate__(self):
+        raise Exception()
+
+    def __setstate__(self, state):
+        raise Exception()
+
+    def _term(self, expression):
+        ''' Auxiliary method to translate expression to a z3 term '''
+        translator = TranslatorZ3(self._context, cache=self._terms)
+        translator.visit(expression)
+        return translator.result
+
+    def _prepare(self, constraints, related_to=None):
+        ''' Auxiliary method to get the solver ready to answer a query over
+            constraints, only the ones related to related_to if it is given
+        '''
+        if self._pid != os.getpid():
+            # A context inherited from the parent of this worker is not ours
+            self._start()
+        if related_to is None:
+            assertions = constraints.constraints
+        else:
+            assertions = constraints.related_to(related_to)
+        self._solver.reset()
+        for constraint in assertions:
+            self._solver.add(self._term(constraint))
+
+    def _assert(self, expression):
+        ''' Auxiliary method to add an assertion to the current query '''
+        assert isinstance(expression, Bool)
+        self._solver.add(self._term(expression))
+
+    def _check(self):
+        ''' Check the satisfiability of the current query '''
+        logger.debug("Solver.check() ")
+        start = time.time()
+        _status = str(self._solver.check())
+        logger.debug("Check took %s seconds (%s)", time.time() - start, _status)
+        if consider_unknown_as_unsat:
+            if _status == 'unknown':
+                logger.warning('Found an unknown core, probably a solver timeout')
+                _status = 'unsat'
+
+        if _status == 'unknown':
+            raise SolverUnknown(_status)
+
+        return _status
+
+    def _getvalue(self, expression, model=None):
+        ''' Auxiliary method to read the value of expression in the model of
+            the last check, which must have been sat
+        '''
+        if model is None:
+            model = self._solver.model()
+        value = model.eval(self._term(expression), model_completion=True)
+        if isinstance(expression, Bool):
+            return z3.is_true(value)
+        if isinstance(expression, BitVec):
+            return value.as_long()
+        raise NotImplementedError("_getvalue only implemented for Bool and BitVec")
+
+    def _getvalues(self, variables):
+        ''' Auxiliary method to read the values of variables in the model of
+            the last check, which must have been sat
+        '''
+        model = self._solver.model()
+        return [self._getvalue(variable, model) for variable in variables]
+
+    def _model_value(self, expression, model):
+        ''' Auxiliary method to read any value of expression from model '''
+        if isinstance(expression, Array):
+            return bytearray(self._getvalue(expression[i], model) for i in xrange(expression.index_max))
+        return self._getvalue(expression, model)
+
+    def can_be_true(self, constraints, expression):
+        ''' Check if two potentially symbolic values can be equal '''
+        if isinstance(expression, bool):
+            if not expression:
+                return expression
+            else:
+                #if True check if constraints are feasible
+                key = self._query_key('check', constraints)
+                result = self.cache.get(key)
+                if result is None:
+                    self._prepare(constraints)
+                    result = self._check() == 'sat'
+                    if result:
+                        constraints.update_model(self._getvalues)
+                    self.cache.put(key, result)
+                return result
+        assert isinstance(expression, Bool)
+
+        # The last model may already be an answer
+        if constraints.model_satisfies(expression):
+            return True
+
+        key = self._query_key('can_be_true', constraints, expression)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        self._prepare(constraints, related_to=expression)
+        self._assert(expression)
+        result = self._check() == 'sat'
+        if result:
+            constraints.update_model(self._getvalues, related_to=expression)
+        self.cache.put(key, result)
+        return result
+
+    # get-all-values min max minmax
+    def get_all_values(self, constraints, expression, maxcnt=30000, silent=False):
+        ''' Returns a list with all the possible values for the symbol x'''
+        if not isinstance(expression, Expression):
+            return [expression]
+        assert isinstance(constraints, ConstraintSet)
+        if not isinstance(expression, (Bool, BitVec)):
+            raise NotImplementedError("get_all_values only implemted for Bool and BitVec")
+
+        key = self._query_key('get_all_values', constraints, expression, maxcnt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            values, complete = cached
+            if not complete and not silent:
+                raise TooManySolutions(list(values))
+            return list(values)
+
+        self._prepare(constraints, related_to=expression)
+        result = []
+        while self._check() == 'sat':
+            if not result:
+                constraints.update_model(self._getvalues, related_to=expression)
+            value = self._getvalue(expression)
+            result.append(value)
+            self._assert(expression != value)
+
+            if len(result) >= maxcnt:
+                self.cache.put(key, (tuple(result), False))
+                if silent:
+                    break
+                else:
+                    raise TooManySolutions(result)
+        else:
+            self.cache.put(key, (tuple(result), True))
+        return result
+
+    def optimize(self, constraints, x, goal, M=10000):
+        ''' Finds the maximum or minimal (unsigned) value of x
+            :param X: a symbol or expression
+            :param M: unused, z3 optimizes in a single query
+        '''
+        assert goal in ('maximize', 'minimize')
+        assert isinstance(x, BitVec)
+
+        key = self._query_key('optimize', constraints, x, goal)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+
+        self._prepare(constraints, related_to=x)
+        optimizer = z3.Optimize(ctx=self._context)
+        optimizer.set('timeout', self._timeout)
+        optimizer.add(*self._solver.assertions())
+        term = self._term(x)
+        getattr(optimizer, goal)(term)
+        if optimizer.check() != z3.sat:
+            raise SolverException("Optimizing error, unsat or unknown core")
+        result = optimizer.model().eval(term, model_completion=True).as_long()
+        self.cache.put(key, result)
+        return result
+
+    def get_value(self, constraints, expression):
+        ''' Ask the solver for one possible assignment for val using current set
+            of constraints.
+            The current set of assertions must be sat.
+            :param val: an expression or symbol '''
+        if not issymbolic(expression):
+            return expression
+        assert isinstance(expression, (Bool, BitVec, Array))
+
+        key = self._query_key('get_value', constraints, expression)
+        result = self.cache.get(key)
+        if result is None:
+            self._prepare(constraints)
+            if self._check() != 'sat':
+                raise SolverException('Model is not available')
+            constraints.update_model(self._getvalues)
+            result = self._model_value(expression, self._solver.model())
+            if isinstance(result, bytearray):
+                self.cache.put(key, str(result))
+            else:
+                self.cache.put(key, result)
+        elif isinstance(result, str):
+            result = bytearray(result)
+        return result
+
+    def get_values(self, constraints, expressions):
+        ''' Ask the solver for one model and return the values it assigns to
+            each of expressions.
+            The current set of assertions must be sat.
+            :param expressions: a list of expressions or symbols '''
+        expressions = list(expressions)
+        symbolic = [x for x in expressions if issymbolic(x)]
+        if not symbolic:
+            return expressions
+        for expression in symbolic:
+            assert isinstance(expression, (Bool, BitVec, Array))
+
+        key = ('get_values', constraints.fingerprint(), tuple(fingerprint(x) for x in symbolic))
+        values = self.cache.get(key)
+        if values is None:
+            self._prepare(constraints)
+            if self._check() != 'sat':
+                raise SolverException('Model is not available')
+            constraints.update_model(self._getvalues)
+            model = self._solver.model()
+            values = [self._model_value(x, model) for x in symbolic]
+            self.cache.put(key, tuple(str(v) if isinstance(v, bytearray) else v for v in values))
+        else:
+            values = [bytearray(v) if isinstance(v, str) else v for v in values]
+
+        values = iter(values)
+        return [next(values) if issymbolic(x) else x for x in expressions]
+
+
+def new_solver(**kwargs):
+    ''' Builds a solver over the z3 python bindings if they are installed
+        (and use_native_solver is set), or else one over an external z3
+        process taking kwargs (see Z3Solver). The process is incremental
+        unless told otherwise or incremental_solver is unset.
+    '''
+    if use_native_solver and z3 is not None:
+        return Z3NativeSolver()
+    kwargs.setdefault('incremental', incremental_solver)
+    return Z3Solver(**kwargs)
+
+
+class SolverPool(Solver):
+    def __init__(self, size=None, factory=None):
+        ''' A set of solvers, each one owning its own external process (or z3
+            context).
+            Batches of independent queries (see can_be_true_many) are split
+            among external processes, single queries always go to the first
+            solver. The solvers are built the first time they are needed.
+
+            :param size: how many solvers at most, defaults to solver_pool_size
+            :param factory: callable building a solver, defaults to external
+                            z3 processes, incremental unless incremental_solver
+                            is unset so they stay warm between batches
+        '''
+        super(SolverPool, self).__init__()
+        self.size = size or solver_pool_size
+        self._factory = factory or (lambda: Z3Solver(incremental=incremental_solver))
+        self._solvers = []
+
+    def _solver(self, index=0):
+        while len(self._solvers) <= index:
+            solver = self._factory()
+            # Every solver of the pool shares its answers
+            solver.cache = self.cache
+            self._solvers.append(solver)
+        return self._solvers[index]
+
+    def _stop_proc(self):
+        ''' Auxiliary method to stop every external solver process '''
+        for solver in self._solvers:
+            solver._stop_proc()
+
+    # marshaling/pickle
+    def __getstate__(self):
+        raise Exception()
+
+    def __setstate__(self, state):
+        raise Exception()
+
+    def can_be_true(self, constraints, expression):
+        return self._solver().can_be_true(constraints, expression)
+
+    def can_be_true_many(self, constraints, expressions):
+        if not isinstance(self._solver(), Z3Solver):
+            # Only external processes work on their checks concurrently. The
+            # z3 python bindings (the default backend of new_solver) run in
+            # this process and a z3 context is not thread safe, so the first
+            # solver answers the whole batch
+            return self._solver().can_be_true_many(constraints, expressions)
+        count = max(1, min(self.size, len(expressions)))
+        solvers = [self._solver(i) for i in xrange(count)]
+        return self._dispatch_checks(constraints, expressions, solvers)
+
+    def get_all_values(self, constraints, expression, maxcnt=30000, silent=False):
+        return self._solver().get_all_values(constraints, expression, maxcnt, silent)
+
+    def optimize(self, constraints, x, goal, M=10000):
+        return self._solver().optimize(constraints, x, goal, M)
+
+    def get_value(self, constraints, expression):
+        return self._solver().get_value(constraints, expression)
+
+    def get_values(self, constraints, expressions):
+        return self._solver().get_values(constraints, expressions)
+
 
-solver = Z3Solver()
+solver = SolverPool(factory=new_solver)
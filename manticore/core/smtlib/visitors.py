@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 from .expression import *
-from functools32 import lru_cache
+from collections import OrderedDict
+from weakref import ref
+import hashlib
 import logging
 import operator
 logger = logging.getLogger(__name__)
@@ -116,10 +118,7 @@ class Visitor(object):
         if isinstance(expression, Constant):
             return expression
         if isinstance(expression, Operation):
-            import copy
-            aux = copy.copy(expression)
-            aux._operands = operands
-            return aux
+            return type(expression)(*expression._args(operands), taint=expression.taint)
         return type(expression)(*operands, taint=expression.taint)
 
 
@@ -240,104 +239,82 @@ def pretty_print(expression, **kwargs):
     return pp.result
 
 
-class ConstantFolderSimplifier(Visitor):
-    def __init__(self, **kw):
-        super(ConstantFolderSimplifier, self).__init__(**kw)
-
-    operations = {BitVecAdd: operator.__add__,
-                  BitVecSub: operator.__sub__,
-                  BitVecMul: operator.__mul__,
-                  BitVecDiv: operator.__div__,
-                  BitVecShiftLeft: operator.__lshift__,
-                  BitVecShiftRight: operator.__rshift__,
-                  BitVecAnd: operator.__and__,
-                  BitVecOr: operator.__or__,
-                  BitVecXor: operator.__xor__,
-                  BitVecNot: operator.__not__,
-                  BitVecNeg: operator.__invert__,
-                  LessThan: operator.__lt__,
-                  LessOrEqual: operator.__le__,
-                  Equal: operator.__eq__,
-                  GreaterThan: operator.__gt__,
-                  GreaterOrEqual: operator.__ge__,
-                  BoolAnd: operator.__and__,
-                  BoolOr: operator.__or__,
-                  BoolNot: operator.__not__}
-
-    def visit_BitVecConcat(self, expression, *operands):
-        if all(isinstance(o, Constant) for o in operands):
-            result = 0
-            for o in operands:
-                result <<= o.size
-                result |= o.value
-            return BitVecConstant(expression.size, result, taint=expression.taint)
-
-    def visit_BitVecZeroExtend(self, expression, *operands):
-        if all(isinstance(o, Constant) for o in operands):
-            return BitVecConstant(expression.size, operands[0].value, taint=expression.taint)
-
-    def visit_BitVecExtract(self, expression, *operands):
-        if all(isinstance(o, Constant) for o in expression.operands):
-            value = expression.operands[0].value
-            begining = expression.begining
-            end = expression.end
-            value = value >> begining
-            mask = 2**(end - begining + 1) - 1
-            value = value & mask
-            return BitVecConstant(expression.size, value, taint=expression.taint)
-
-    def visit_BoolAnd(self, expression, a, b):
-        if isinstance(a, Constant) and a.value == True:
-            return b
-        if isinstance(b, Constant) and b.value == True:
-            return a
-
-    def visit_BoolOr(self, expression, a, b):
-        if isinstance(a, Constant) and a.value == False:
-            return b
-        if isinstance(b, Constant) and b.value == False:
-            return a
-
-    def visit_Operation(self, expression, *operands):
-        ''' constant folding, if all operands of an expression are a Constant do the math '''
-        operation = self.operations.get(type(expression), None)
-        if operation is not None and \
-                all(isinstance(o, Constant) for o in operands):
-            value = operation(*(x.value for x in operands))
-            if isinstance(expression, BitVec):
-                return BitVecConstant(expression.size, value, taint=expression.taint)
-            else:
-                isinstance(expression, Bool)
-                return BoolConstant(value, taint=expression.taint)
-        else:
-            if any(operands[i] is not expression.operands[i] for i in xrange(len(operands))):
-                expression = self._rebuild(expression, operands)
-        return expression
-
-
-def clean_cache(cache):
-    #print "cleaning cache", id(cache), deep_getsizeof(cache), 'M'
-    M = 256
-    if len(cache) > M:
-        import random
-        N = len(cache) - M
-        for i in range(N):
-            cache.pop(random.choice(cache.keys()))
-
+class LRUCache(object):
+    ''' A bounded mapping that forgets its least recently used entries. It
+        can be given as the cache of a Visitor.
+    '''
 
-constant_folder_simplifier_cache = {}
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        entries = self._entries
+        entries.pop(key, None)
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _value(expression):
+    ''' The value of a constant (masked for bitvecs) or None '''
+    if not isinstance(expression, Constant):
+        return None
+    if isinstance(expression, BitVec):
+        return expression.value & expression.mask
+    return bool(expression.value)
+
+
+_comparisons = (Equal, LessThan, LessOrEqual, GreaterThan, GreaterOrEqual,
+                UnsignedLessThan, UnsignedLessOrEqual, UnsignedGreaterThan,
+                UnsignedGreaterOrEqual)
+
+# The comparison holding when the operands are swapped
+_swapped = {Equal: Equal,
+            LessThan: GreaterThan,
+            LessOrEqual: GreaterOrEqual,
+            GreaterThan: LessThan,
+            GreaterOrEqual: LessOrEqual,
+            UnsignedLessThan: UnsignedGreaterThan,
+            UnsignedLessOrEqual: UnsignedGreaterOrEqual,
+            UnsignedGreaterThan: UnsignedLessThan,
+            UnsignedGreaterOrEqual: UnsignedLessOrEqual}
+
+# The comparison holding when this one does not
+_negated = {LessThan: GreaterOrEqual,
+            LessOrEqual: GreaterThan,
+            GreaterThan: LessOrEqual,
+            GreaterOrEqual: LessThan,
+            UnsignedLessThan: UnsignedGreaterOrEqual,
+            UnsignedLessOrEqual: UnsignedGreaterThan,
+            UnsignedGreaterThan: UnsignedLessOrEqual,
+            UnsignedGreaterOrEqual: UnsignedLessThan}
 
 
-def constant_folder(expression):
-    global constant_folder_simplifier_cache
-    #constant_folder_simplifier_cache = {}
-    simp = ConstantFolderSimplifier(cache=constant_folder_simplifier_cache)
-    simp.visit(expression)
-    clean_cache(constant_folder_simplifier_cache)
-    return simp.result
+class ArithmeticSimplifier(Visitor):
+    ''' Single pass rewriting simplifier.
 
+        Operands are simplified before the operation using them, then the
+        rules of the operation (the rewrite_<Class> methods) are applied to it
+        until none matches. Nodes built by a rule are simplified right away
+        so every node is visited once. Constant operations are folded with the
+        Evaluator. A rewrite never drops the taint of what it replaces.
+    '''
 
-class ArithmeticSimplifier(Visitor):
     def __init__(self, parent=None, **kw):
         super(ArithmeticSimplifier, self).__init__(**kw)
 
@@ -347,154 +324,323 @@ class ArithmeticSimplifier(Visitor):
             isinstance(b, Constant) and\
             a.value == b.value or a is b
 
-    @staticmethod
-    def _changed(expression, operands):
-        if isinstance(expression, Constant) and len(operands) > 0:
-            return True
-        arity = len(operands)
-        return any(operands[i] is not expression.operands[i] for i in range(arity))
-
     def visit_Operation(self, expression, *operands):
-        ''' constant folding, if all operands of an expression are a Constant do the math '''
-        if all(isinstance(o, Constant) for o in operands):
-            expression = constant_folder(expression)
-        if self._changed(expression, operands):
+        if any(x is not y for x, y in zip(operands, expression.operands)):
             expression = self._rebuild(expression, operands)
-        return expression
+        return self._rewrite(expression)
 
-    def visit_BitVecZeroExtend(self, expression, *operands):
-        if self._changed(expression, operands):
-            return BitVecZeroExtend(expression.size, *operands, taint=expression.taint)
-        else:
-            return expression
+    def visit_Expression(self, expression, *operands):
+        assert len(operands) == 0
+        assert not isinstance(expression, Operation)
+        return expression
 
-    def visit_BitVecITE(self, expression, *operands):
-        if isinstance(expression.operands[0], Constant):
-            if expression.operands[0].value:
-                return expression.operands[1]
+    def _rewrite(self, expression):
+        ''' Applies the rules of the operation expression (whose operands are
+            already simplified) until none matches '''
+        original = expression
+        while isinstance(expression, Operation):
+            if all(isinstance(x, Constant) for x in expression.operands):
+                new_expression = self._fold(expression)
             else:
-                return expression.operands[2]
-        if self._changed(expression, operands):
-            return BitVecITE(expression.size, *operands, taint=expression.taint)
-
-    def visit_BitVecExtract(self, expression, *operands):
-        ''' extract(0,sizeof(a))(a)  ==> a
-            extract(0, 16 )( concat(a,b,c,d) ) => concat(c, d)
-            extract(m,M)(and/or/xor a b ) => and/or/xor((extract(m,M) a) (extract(m,M) a)
-        '''
-        op = expression.operands[0]
-        begining = expression.begining
-        end = expression.end
+                rule = getattr(self, 'rewrite_%s' % type(expression).__name__, None)
+                new_expression = None if rule is None else rule(expression, *expression.operands)
+            if new_expression is None or new_expression is expression:
+                break
+            expression = new_expression
 
-        if isinstance(op, BitVecConcat):
-            new_operands = []
-            bitcount = 0
-            for item in reversed(op.operands):
-                if begining >= item.size:
-                    begining -= item.size
-                else:
-                    if bitcount < expression.size:
-                        new_operands.append(item)
-                    bitcount += item.size
-            if begining != expression.begining:
-                return BitVecExtract(BitVecConcat(sum(map(lambda x: x.size, new_operands)), *reversed(new_operands)),
-                                     begining, expression.size, taint=expression.taint)
-        if isinstance(op, (BitVecAnd, BitVecOr, BitVecXor)):
-            bitoperand_a, bitoperand_b = op.operands
-            return op.__class__(BitVecExtract(bitoperand_a, begining, expression.size), BitVecExtract(bitoperand_b, begining, expression.size), taint=expression.taint)
+        if expression is original or original.taint <= expression.taint:
+            return expression
+        # Keep the taint of the operands the rewrite dropped. Variables can
+        # not be rebuilt, those are left unsimplified.
+        if isinstance(expression, Variable) or not expression._interned:
+            return original
+        return type(expression)(*expression._args(), taint=original.taint | expression.taint)
+
+    @staticmethod
+    def _fold(expression):
+        value = evaluate(expression, {})
+        if value is None:
+            return None
+        if isinstance(expression, BitVec):
+            return BitVecConstant(expression.size, value, taint=expression.taint)
+        return BoolConstant(value, taint=expression.taint)
 
-    def visit_BitVecAdd(self, expression, *operands):
+    def _fold_ite_comparison(self, expression, a, b):
+        ''' ITE(c, k1, k2) op k  ==> c, not c, True or False '''
+        if not isinstance(a, BitVecITE) or _value(b) is None:
+            return None
+        condition, true_value, false_value = a.operands
+        if _value(true_value) is None or _value(false_value) is None:
+            return None
+        cls = type(expression)
+        if_true = evaluate(cls(true_value, b), {})
+        if_false = evaluate(cls(false_value, b), {})
+        if if_true == if_false:
+            return BoolConstant(if_true)
+        if if_true:
+            return condition
+        return self._rewrite(BoolNot(condition))
+
+    def _constant(self, expression, value):
+        return BitVecConstant(expression.size, value)
+
+    # Bit vector arithmetic
+    def rewrite_BitVecAdd(self, expression, a, b):
         ''' a + 0  ==> a
-            0 + a  ==> a
+            k + a  ==> a + k
+            (a + k1) + k2  ==> a + (k1 + k2)
         '''
-        left = expression.operands[0]
-        right = expression.operands[1]
-        if isinstance(right, BitVecConstant):
-            if right.value == 0:
-                return left
-        if isinstance(left, BitVecConstant):
-            if left.value == 0:
-                return right
-
-    def visit_BitVecSub(self, expression, *operands):
-        ''' a - 0 ==> 0
+        if _value(b) == 0:
+            return a
+        if _value(a) == 0:
+            return b
+        if isinstance(a, Constant):
+            return BitVecAdd(b, a)
+        if isinstance(b, Constant) and isinstance(a, BitVecAdd) and isinstance(a.operands[1], Constant):
+            return BitVecAdd(a.operands[0], self._rewrite(BitVecAdd(a.operands[1], b)))
+
+    def rewrite_BitVecSub(self, expression, a, b):
+        ''' a - 0  ==> a
+            a - a  ==> 0
             (a + b) - b  ==> a
             (b + a) - b  ==> a
+            a - k  ==> a + (-k)
         '''
-        left = expression.operands[0]
-        right = expression.operands[1]
-        if isinstance(left, BitVecAdd):
-            if self._same_constant(left.operands[0], right):
-                return left.operands[1]
-            elif self._same_constant(left.operands[1], right):
-                return left.operands[0]
-
-    def visit_BitVecOr(self, expression, *operands):
-        ''' a | 0 => a
-            0 | a => a
-            0xffffffff & a => 0xffffffff
-            a & 0xffffffff => 0xffffffff
+        if _value(b) == 0:
+            return a
+        if a is b:
+            return self._constant(expression, 0)
+        if isinstance(a, BitVecAdd):
+            if self._same_constant(a.operands[0], b):
+                return a.operands[1]
+            elif self._same_constant(a.operands[1], b):
+                return a.operands[0]
+        if isinstance(b, Constant):
+            return self._rewrite(BitVecAdd(a, self._constant(expression, -_value(b) & expression.mask)))
+
+    def rewrite_BitVecMul(self, expression, a, b):
+        ''' a * 0  ==> 0
+            a * 1  ==> a
+            k * a  ==> a * k
+        '''
+        if isinstance(a, Constant):
+            return BitVecMul(b, a)
+        if _value(b) == 0:
+            return b
+        if _value(b) == 1:
+            return a
 
+    def rewrite_BitVecAnd(self, expression, a, b):
+        ''' k & a  ==> a & k                    move constants to the right
+            a & 0  ==> 0                        remove zero
+            a & 0xffffffff  ==> a               remove full mask
+            (a & k1) & k2  ==> a & (k1 & k2)
+            (a | b) & k  ==> (a & k) | (b & k)  distribute over |
+            a & a  ==> a
         '''
-        left = expression.operands[0]
-        right = expression.operands[1]
-        if isinstance(right, BitVecConstant):
-            if right.value == 0:
-                return left
-            elif right.value == left.mask:
-                return right
-            elif isinstance(left, BitVecOr):
-                left_left = left.operands[0]
-                left_right = left.operands[1]
-                if isinstance(right, Constant):
-                    return BitVecOr(left_left, (left_right | right), taint=expression.taint)
-        elif isinstance(left, BitVecConstant):
-            return BitVecOr(right, left, taint=expression.taint)
-
-    def visit_BitVecAnd(self, expression, *operands):
-        ''' ct & x => x & ct                move constants to the right
-            a & 0 => 0                      remove zero
-            a & 0xffffffff => a             remove full mask
-            (b & ct2) & ct => b & (ct&ct2)  ?
-            (a & (b | c) => a&b | a&c       distribute over |
+        if a is b:
+            return a
+        if isinstance(a, Constant):
+            return BitVecAnd(b, a)
+        value = _value(b)
+        if value is None:
+            return None
+        if value == 0:
+            return b
+        if value == expression.mask:
+            return a
+        if isinstance(a, BitVecAnd) and isinstance(a.operands[1], Constant):
+            return BitVecAnd(a.operands[0], self._rewrite(BitVecAnd(a.operands[1], b)))
+        if isinstance(a, BitVecOr):
+            return BitVecOr(self._rewrite(BitVecAnd(a.operands[0], b)),
+                            self._rewrite(BitVecAnd(a.operands[1], b)))
+
+    def rewrite_BitVecOr(self, expression, a, b):
+        ''' k | a  ==> a | k
+            a | 0  ==> a
+            a | 0xffffffff  ==> 0xffffffff
+            (a | k1) | k2  ==> a | (k1 | k2)
+            a | a  ==> a
         '''
-        left = expression.operands[0]
-        right = expression.operands[1]
-        if isinstance(right, BitVecConstant):
-            if right.value == 0:
-                return right
-            elif right.value == right.mask:
-                return left
-            elif isinstance(left, BitVecAnd):
-                left_left = left.operands[0]
-                left_right = left.operands[1]
-                if isinstance(right, Constant):
-                    return BitVecAnd(left_left, left_right & right, taint=expression.taint)
-            elif isinstance(left, BitVecOr):
-                left_left = left.operands[0]
-                left_right = left.operands[1]
-                return BitVecOr(right & left_left, right & left_right, taint=expression.taint)
-
-        elif isinstance(left, BitVecConstant):
-            return BitVecAnd(right, left, taint=expression.taint)
-
-    def visit_BitVecShiftLeft(self, expression, *operands):
-        ''' a << 0 => a                       remove zero
-            a << ct => 0 if ct > sizeof(a)    remove big constant shift
+        if a is b:
+            return a
+        if isinstance(a, Constant):
+            return BitVecOr(b, a)
+        value = _value(b)
+        if value is None:
+            return None
+        if value == 0:
+            return a
+        if value == expression.mask:
+            return b
+        if isinstance(a, BitVecOr) and isinstance(a.operands[1], Constant):
+            return BitVecOr(a.operands[0], self._rewrite(BitVecOr(a.operands[1], b)))
+
+    def rewrite_BitVecXor(self, expression, a, b):
+        ''' k ^ a  ==> a ^ k
+            a ^ 0  ==> a
+            a ^ a  ==> 0
+            (a ^ k1) ^ k2  ==> a ^ (k1 ^ k2)
         '''
-        left = expression.operands[0]
-        right = expression.operands[1]
-        if isinstance(right, BitVecConstant):
-            if right.value == 0:
-                return left
-            elif right.value >= right.size:
-                return left
+        if a is b:
+            return self._constant(expression, 0)
+        if isinstance(a, Constant):
+            return BitVecXor(b, a)
+        if _value(b) == 0:
+            return a
+        if isinstance(b, Constant) and isinstance(a, BitVecXor) and isinstance(a.operands[1], Constant):
+            return BitVecXor(a.operands[0], self._rewrite(BitVecXor(a.operands[1], b)))
 
-    def visit_ArraySelect(self, expression, *operands):
+    def rewrite_BitVecShiftLeft(self, expression, a, b):
+        ''' a << 0  ==> a                       remove zero
+            a << k  ==> 0 if k >= sizeof(a)     remove big constant shift
+        '''
+        value = _value(b)
+        if value == 0:
+            return a
+        if value is not None and value >= expression.size:
+            return self._constant(expression, 0)
+
+    rewrite_BitVecShiftRight = rewrite_BitVecShiftLeft
+
+    def rewrite_BitVecNot(self, expression, a):
+        ''' ~~a  ==> a '''
+        if isinstance(a, BitVecNot):
+            return a.operands[0]
+
+    def rewrite_BitVecNeg(self, expression, a):
+        ''' --a  ==> a '''
+        if isinstance(a, BitVecNeg):
+            return a.operands[0]
+
+    # Bit vector structure
+    def rewrite_BitVecExtract(self, expression, op):
+        ''' extract(0, sizeof(a))(a)  ==> a
+            extract(m, M)(extract(n, N)(a))  ==> extract(n + m, n + M)(a)
+            extract(0, 16)(concat(a, b, c, d))  ==> concat(c, d)
+            extract(m, M)(zero/sign extend a)  ==> extract(m, M)(a) if M < sizeof(a)
+            extract(m, M)(and/or/xor a b)  ==> and/or/xor(extract(m, M)(a), extract(m, M)(b))
+            extract(m, M)(ite(c, k1, k2))  ==> ite(c, k1', k2')
+        '''
+        begining, size = expression.begining, expression.size
+        if begining == 0 and size == op.size:
+            return op
+
+        if isinstance(op, BitVecExtract):
+            return BitVecExtract(op.operands[0], op.begining + begining, size)
+
+        if isinstance(op, BitVecConcat):
+            pieces = []
+            offset = 0
+            for item in reversed(op.operands):
+                low = max(begining, offset)
+                high = min(expression.end, offset + item.size - 1)
+                if low <= high:
+                    pieces.append(self._rewrite(BitVecExtract(item, low - offset, high - low + 1)))
+                offset += item.size
+            if len(pieces) == 1:
+                return pieces[0]
+            return self._rewrite(BitVecConcat(size, *reversed(pieces)))
+
+        if isinstance(op, (BitVecZeroExtend, BitVecSignExtend)):
+            operand = op.operands[0]
+            if expression.end < operand.size:
+                return BitVecExtract(operand, begining, size)
+            if isinstance(op, BitVecZeroExtend):
+                if begining >= operand.size:
+                    return self._constant(expression, 0)
+                return BitVecZeroExtend(size, self._rewrite(BitVecExtract(operand, begining, operand.size - begining)))
+
+        if isinstance(op, (BitVecAnd, BitVecOr, BitVecXor)):
+            bitoperand_a, bitoperand_b = op.operands
+            return op.__class__(self._rewrite(BitVecExtract(bitoperand_a, begining, size)),
+                                self._rewrite(BitVecExtract(bitoperand_b, begining, size)))
+
+        if isinstance(op, BitVecITE):
+            condition, true_value, false_value = op.operands
+            if isinstance(true_value, Constant) and isinstance(false_value, Constant):
+                return BitVecITE(size, condition,
+                                 self._fold(BitVecExtract(true_value, begining, size)),
+                                 self._fold(BitVecExtract(false_value, begining, size)))
+
+    def rewrite_BitVecConcat(self, expression, *operands):
+        ''' concat(a, concat(b, c))  ==> concat(a, b, c)
+            concat(k1, k2, a)  ==> concat(k1k2, a)
+            concat(extract(n, N)(a), extract(m, n-1)(a))  ==> extract(m, N)(a)
+            concat(0, a)  ==> zero extend a
+            concat(a)  ==> a
+        '''
+        flat = []
+        for operand in operands:
+            if isinstance(operand, BitVecConcat):
+                flat.extend(operand.operands)
+            else:
+                flat.append(operand)
+
+        merged = []
+        for operand in flat:
+            if merged:
+                last = merged[-1]
+                if isinstance(last, Constant) and isinstance(operand, Constant):
+                    merged[-1] = BitVecConstant(last.size + operand.size,
+                                                (_value(last) << operand.size) | _value(operand),
+                                                taint=last.taint | operand.taint)
+                    continue
+                if isinstance(last, BitVecExtract) and isinstance(operand, BitVecExtract) and \
+                        last.operands[0] is operand.operands[0] and last.begining == operand.end + 1:
+                    merged[-1] = self._rewrite(BitVecExtract(operand.operands[0], operand.begining,
+                                                             last.size + operand.size))
+                    continue
+            merged.append(operand)
+
+        if len(merged) == 1:
+            return merged[0]
+        if _value(merged[0]) == 0:
+            rest = merged[1:]
+            if len(rest) == 1:
+                rest = rest[0]
+            else:
+                rest = self._rewrite(BitVecConcat(expression.size - merged[0].size, *rest))
+            return BitVecZeroExtend(expression.size, rest)
+        if len(merged) != len(operands) or any(x is not y for x, y in zip(merged, operands)):
+            return BitVecConcat(expression.size, *merged)
+
+    def rewrite_BitVecZeroExtend(self, expression, op):
+        ''' zero extend a to sizeof(a)  ==> a
+            zero extend (zero extend a)  ==> zero extend a
+        '''
+        if expression.size == op.size:
+            return op
+        if isinstance(op, BitVecZeroExtend):
+            return BitVecZeroExtend(expression.size, op.operands[0])
+
+    def rewrite_BitVecSignExtend(self, expression, op):
+        ''' sign extend a to sizeof(a)  ==> a
+            sign extend (sign extend a)  ==> sign extend a
+        '''
+        if expression.size == op.size:
+            return op
+        if isinstance(op, BitVecSignExtend):
+            return BitVecSignExtend(op.operands[0], expression.size)
+
+    def rewrite_BitVecITE(self, expression, condition, true_value, false_value):
+        ''' ite(True, a, b)  ==> a
+            ite(False, a, b)  ==> b
+            ite(c, a, a)  ==> a
+            ite(not c, a, b)  ==> ite(c, b, a)
+        '''
+        value = _value(condition)
+        if value is not None:
+            return true_value if value else false_value
+        if true_value is false_value:
+            return true_value
+        if isinstance(condition, BoolNot):
+            return BitVecITE(expression.size, condition.operands[0], false_value, true_value)
+
+    def rewrite_ArraySelect(self, expression, arr, index):
         ''' ArraySelect (ArrayStore((ArrayStore(x0,v0) ...),xn, vn), x0)
                 -> v0
         '''
-        arr, index = operands
         if isinstance(arr, ArrayVariable):
             return
 
@@ -504,31 +650,174 @@ class ArithmeticSimplifier(Visitor):
         if isinstance(index, BitVecConstant) and isinstance(arr, ArrayStore) and isinstance(arr.index, BitVecConstant) and arr.index.value == index.value:
             return arr.value
         else:
-            if arr != expression.array:
+            if arr is not expression.array:
                 return arr.select(index)
 
-    def visit_Expression(self, expression, *operands):
-        assert len(operands) == 0
-        assert not isinstance(expression, Operation)
-        return expression
+    # Booleans
+    def rewrite_BoolNot(self, expression, a):
+        ''' not not a  ==> a
+            not (a < b)  ==> a >= b
+        '''
+        if isinstance(a, BoolNot):
+            return a.operands[0]
+        negated = _negated.get(type(a))
+        if negated is not None:
+            return negated(*a.operands)
+
+    def rewrite_BoolAnd(self, expression, a, b):
+        ''' True and a  ==> a
+            False and a  ==> False
+            a and a  ==> a
+        '''
+        if a is b:
+            return a
+        for x, y in ((a, b), (b, a)):
+            value = _value(x)
+            if value is not None:
+                return y if value else x
+
+    def rewrite_BoolOr(self, expression, a, b):
+        ''' False or a  ==> a
+            True or a  ==> True
+            a or a  ==> a
+        '''
+        if a is b:
+            return a
+        for x, y in ((a, b), (b, a)):
+            value = _value(x)
+            if value is not None:
+                return x if value else y
+
+    def rewrite_BoolXor(self, expression, a, b):
+        ''' False xor a  ==> a
+            True xor a  ==> not a
+            a xor a  ==> False
+        '''
+        if a is b:
+            return BoolConstant(False)
+        for x, y in ((a, b), (b, a)):
+            value = _value(x)
+            if value is not None:
+                return BoolNot(y) if value else y
+
+    def rewrite_BoolEq(self, expression, a, b):
+        ''' a == True  ==> a
+            a == False  ==> not a
+            a == a  ==> True
+        '''
+        if a is b:
+            return BoolConstant(True)
+        for x, y in ((a, b), (b, a)):
+            value = _value(x)
+            if value is not None:
+                return y if value else BoolNot(y)
+
+    def rewrite_BoolITE(self, expression, condition, true_value, false_value):
+        ''' ite(True, a, b)  ==> a
+            ite(False, a, b)  ==> b
+            ite(c, a, a)  ==> a
+            ite(c, True, False)  ==> c
+            ite(not c, a, b)  ==> ite(c, b, a)
+        '''
+        value = _value(condition)
+        if value is not None:
+            return true_value if value else false_value
+        if true_value is false_value:
+            return true_value
+        if _value(true_value) is True and _value(false_value) is False:
+            return condition
+        if isinstance(condition, BoolNot):
+            return BoolITE(condition.operands[0], false_value, true_value)
+
+    # Comparisons
+    def rewrite_Equal(self, expression, a, b):
+        ''' a == a  ==> True
+            k == a  ==> a == k
+            ite(c, k1, k2) == k  ==> c, not c, True or False
+            zero extend a == k  ==> a == k or False
+            a + k1 == k2  ==> a == k2 - k1
+            a ^ k1 == k2  ==> a == k2 ^ k1
+            ~a == k  ==> a == ~k
+            concat(a, b) == k  ==> a == k[high] and b == k[low]
+        '''
+        if a is b:
+            return BoolConstant(True)
+        if isinstance(a, Constant):
+            return Equal(b, a)
+        folded = self._fold_ite_comparison(expression, a, b)
+        if folded is not None:
+            return folded
+        value = _value(b)
+        if value is None:
+            return None
+        if isinstance(a, BitVecZeroExtend):
+            operand = a.operands[0]
+            if value >> operand.size:
+                return BoolConstant(False)
+            return Equal(operand, BitVecConstant(operand.size, value))
+        if isinstance(a, (BitVecAdd, BitVecXor)) and isinstance(a.operands[1], Constant):
+            inverse = BitVecSub if isinstance(a, BitVecAdd) else BitVecXor
+            return Equal(a.operands[0], self._fold(inverse(b, a.operands[1])))
+        if isinstance(a, BitVecNot):
+            return Equal(a.operands[0], self._fold(BitVecNot(b)))
+        if isinstance(a, BitVecConcat):
+            result = None
+            offset = 0
+            for item in reversed(a.operands):
+                part = self._rewrite(Equal(item, BitVecConstant(item.size, value >> offset)))
+                result = part if result is None else self._rewrite(BoolAnd(result, part))
+                offset += item.size
+            return result
+
+    def _rewrite_comparison(self, expression, a, b):
+        ''' a <= a  ==> True
+            a < a  ==> False
+            k < a  ==> a > k
+            ite(c, k1, k2) < k  ==> c, not c, True or False
+            a < 0  ==> False (unsigned bounds)
+        '''
+        cls = type(expression)
+        if a is b:
+            return BoolConstant(cls in (LessOrEqual, GreaterOrEqual, UnsignedLessOrEqual, UnsignedGreaterOrEqual))
+        if isinstance(a, Constant) and not isinstance(b, Constant):
+            return _swapped[cls](b, a)
+        folded = self._fold_ite_comparison(expression, a, b)
+        if folded is not None:
+            return folded
+        value = _value(b)
+        if value == 0:
+            if cls is UnsignedLessThan:
+                return BoolConstant(False)
+            if cls is UnsignedGreaterOrEqual:
+                return BoolConstant(True)
+        elif value is not None and value == a.mask:
+            if cls is UnsignedLessOrEqual:
+                return BoolConstant(True)
+            if cls is UnsignedGreaterThan:
+                return BoolConstant(False)
+
+    rewrite_LessThan = rewrite_LessOrEqual = rewrite_GreaterThan = \
+        rewrite_GreaterOrEqual = rewrite_UnsignedLessThan = \
+        rewrite_UnsignedLessOrEqual = rewrite_UnsignedGreaterThan = \
+        rewrite_UnsignedGreaterOrEqual = _rewrite_comparison
+
+
+max_simplifier_cache = 0x4000
+simplifier_cache = LRUCache(max_simplifier_cache)
 
 
-# FIXME this should forget old expressions lru?
-arithmetic_simplifier_cache = {}
+def simplify(expression):
+    simp = ArithmeticSimplifier(cache=simplifier_cache)
+    simp.visit(expression)
+    return simp.result
 
 
-def arithmetic_simplify(expression):
-    global arithmetic_simplifier_cache
-    #arithmetic_simplifier_cache = {}
-    simp = ArithmeticSimplifier(cache=arithmetic_simplifier_cache)
-    simp.visit(expression, use_fixed_point=True)
-    value = simp.result
-    clean_cache(arithmetic_simplifier_cache)
-    return value
+# Older entry points, all the rules run in a single pass now
+constant_folder = arithmetic_simplify = simplify
 
 
 def to_constant(expression):
-    value = arithmetic_simplify(expression)
+    value = simplify(expression)
     if isinstance(value, Constant):
         return value.value
     elif isinstance(value, Array):
@@ -544,13 +833,6 @@ def to_constant(expression):
     return value
 
 
-@lru_cache(maxsize=128)
-def simplify(expression):
-    expression = constant_folder(expression)
-    expression = arithmetic_simplify(expression)
-    return expression
-
-
 class TranslatorSmtlib(Visitor):
     ''' Simple visitor to translate an expression to its smtlib representation
     '''
@@ -695,3 +977,197 @@ def get_variables(expression):
     visitor = GetDeclarations()
     visitor.visit(expression)
     return visitor.result
+
+
+class _Unknown(Exception):
+    pass
+
+
+def _signed(value, size):
+    if value & (1 << (size - 1)):
+        return value - (1 << size)
+    return value
+
+
+def _sdiv(size, a, b):
+    a, b = _signed(a, size), _signed(b, size)
+    if b == 0:
+        return -1 if a >= 0 else 1
+    quotient = abs(a) // abs(b)
+    return -quotient if (a < 0) != (b < 0) else quotient
+
+
+def _srem(size, a, b):
+    a, b = _signed(a, size), _signed(b, size)
+    if b == 0:
+        return a
+    remainder = abs(a) % abs(b)
+    return -remainder if a < 0 else remainder
+
+
+def _smod(size, a, b):
+    a, b = _signed(a, size), _signed(b, size)
+    if b == 0:
+        return a
+    return a % b
+
+
+class Evaluator(Visitor):
+    ''' Computes the concrete value of an expression under an assignment of
+        its variables, following the smtlib semantics. Bitvectors evaluate to
+        unsigned ints and booleans to bools.
+    '''
+
+    def __init__(self, assignment, **kwargs):
+        super(Evaluator, self).__init__(**kwargs)
+        self.assignment = assignment
+
+    operations = {
+        BitVecAdd: lambda size, a, b: a + b,
+        BitVecSub: lambda size, a, b: a - b,
+        BitVecMul: lambda size, a, b: a * b,
+        BitVecDiv: _sdiv,
+        BitVecUnsignedDiv: lambda size, a, b: a // b if b else -1,
+        BitVecMod: _smod,
+        BitVecRem: _srem,
+        BitVecUnsignedRem: lambda size, a, b: a % b if b else a,
+        BitVecShiftLeft: lambda size, a, b: a << b if b < size else 0,
+        BitVecArithmeticShiftLeft: lambda size, a, b: a << b if b < size else 0,
+        BitVecShiftRight: lambda size, a, b: a >> b if b < size else 0,
+        BitVecArithmeticShiftRight: lambda size, a, b: _signed(a, size) >> min(b, size),
+        BitVecAnd: lambda size, a, b: a & b,
+        BitVecOr: lambda size, a, b: a | b,
+        BitVecXor: lambda size, a, b: a ^ b,
+        BitVecNot: lambda size, a: ~a,
+        BitVecNeg: lambda size, a: -a,
+        BitVecITE: lambda size, c, a, b: a if c else b,
+        BoolNot: lambda a: not a,
+        BoolEq: lambda a, b: a == b,
+        BoolAnd: lambda *operands: all(operands),
+        BoolOr: lambda *operands: any(operands),
+        BoolXor: lambda a, b: a != b,
+        BoolITE: lambda c, a, b: a if c else b,
+        Equal: lambda a, b: a == b,
+        UnsignedLessThan: lambda a, b: a < b,
+        UnsignedLessOrEqual: lambda a, b: a <= b,
+        UnsignedGreaterThan: lambda a, b: a > b,
+        UnsignedGreaterOrEqual: lambda a, b: a >= b,
+    }
+
+    signed_comparisons = {
+        LessThan: operator.lt,
+        LessOrEqual: operator.le,
+        GreaterThan: operator.gt,
+        GreaterOrEqual: operator.ge,
+    }
+
+    def visit_Constant(self, expression):
+        if isinstance(expression, BitVec):
+            return expression.value & expression.mask
+        return bool(expression.value)
+
+    def visit_Variable(self, expression):
+        value = self.assignment.get(expression)
+        if value is None:
+            raise _Unknown()
+        return value
+
+    def visit_Array(self, expression, *operands):
+        raise _Unknown()
+
+    def visit_ArraySelect(self, expression, *operands):
+        raise _Unknown()
+
+    def visit_BitVecExtract(self, expression, value):
+        return (value >> expression.begining) & expression.mask
+
+    def visit_BitVecConcat(self, expression, *operands):
+        result = 0
+        for operand, value in zip(expression.operands, operands):
+            result = (result << operand.size) | value
+        return result
+
+    def visit_BitVecZeroExtend(self, expression, value):
+        return value
+
+    def visit_BitVecSignExtend(self, expression, value):
+        return _signed(value, expression.operands[0].size) & expression.mask
+
+    def visit_Operation(self, expression, *operands):
+        cls = type(expression)
+        if cls in self.signed_comparisons:
+            size = expression.operands[0].size
+            return self.signed_comparisons[cls](*(_signed(value, size) for value in operands))
+        if isinstance(expression, BitVec):
+            return self.operations[cls](expression.size, *operands) & expression.mask
+        return self.operations[cls](*operands)
+
+
+def evaluate(expression, assignment):
+    ''' The value of expression when its variables take the values of
+        assignment (a dict from variables) or None if some is missing there
+    '''
+    visitor = Evaluator(assignment)
+    try:
+        visitor.visit(expression)
+    except _Unknown:
+        return None
+    return visitor.result
+
+
+class Fingerprint(Visitor):
+    ''' Simple visitor to compute a canonical digest of an expression.
+        Structurally equal expressions get the same fingerprint no matter
+        which objects they are built from. Taint is ignored.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(Fingerprint, self).__init__(*args, **kwargs)
+        # Whether a mutable array was part of the expression
+        self.mutable = False
+
+    def visit_ArrayProxy(self, expression):
+        self.mutable = True
+        return fingerprint(expression.array)
+
+    def visit_ArraySlice(self, expression):
+        self.mutable = True
+        offset = expression._slice_offset
+        if isinstance(offset, Expression):
+            offset = fingerprint(offset)
+        params = ['ArraySlice', offset, expression.index_max, fingerprint(expression._array)]
+        return hashlib.sha1(repr(params)).digest()
+
+    def visit_Expression(self, expression, *operands):
+        params = [type(expression).__name__]
+        if isinstance(expression, BitVec):
+            params.append(expression.size)
+        elif isinstance(expression, Array):
+            params.extend((expression.index_bits, expression.value_bits, expression.index_max))
+        if isinstance(expression, Variable):
+            params.append(expression.name)
+        elif isinstance(expression, Constant):
+            params.append(expression.value)
+        elif isinstance(expression, BitVecExtract):
+            params.append(expression.begining)
+        params.extend(operands)
+        return hashlib.sha1(repr(params)).digest()
+
+
+# Constraints are fingerprinted over and over, remember them while they live.
+# Keyed by id as expressions overload __eq__ (so no WeakKeyDictionary)
+_fingerprints = {}  # id(expression) -> (ref(expression), fingerprint)
+
+
+def fingerprint(expression):
+    key = id(expression)
+    entry = _fingerprints.get(key)
+    if entry is not None and entry[0]() is expression:
+        return entry[1]
+    visitor = Fingerprint()
+    visitor.visit(expression)
+    result = visitor.result
+    # A mutable array (ex. an ArrayProxy) gets another digest once written
+    if not (expression._mutable or visitor.mutable):
+        _fingerprints[key] = (ref(expression, lambda _, key=key: _fingerprints.pop(key, None)), result)
+    return result
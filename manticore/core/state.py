@@ -7,7 +7,7 @@ from ..utils.event import Eventful
 
 #import exceptions
 from .cpu.abstractcpu import ConcretizeRegister
-from .memory import ConcretizeMemory, MemoryException
+from .memory import ConcretizeMemory, ForkMemoryAddress, MemoryException
 from ..platforms.platform import *
 
 logger = logging.getLogger(__name__)
@@ -122,6 +122,21 @@ class State(Eventful):
         self._constraints.__exit__(ty, value, traceback)
         self._child = None
 
+    def inherit(self):
+        '''
+        Build a child state that takes over the platform of this state in place
+        (nothing is copied). Unlike the child of `with state as new_state`, it
+        keeps building on the constraints of this state, which must not be
+        used anymore.
+
+        :return: the new state
+        :rtype: State
+        '''
+        new_state = self.__enter__()
+        self._constraints._child = None
+        self._child = None
+        return new_state
+
     def execute(self):
         try:
             result = self._platform.execute()
@@ -147,6 +162,16 @@ class State(Eventful):
                              expression=expression,
                              setstate=setstate,
                              policy=e.policy)
+        except ForkMemoryAddress as e:
+            # The instruction was cut short by the access, every child runs it again
+            pc = self.cpu._last_pc
+
+            def setstate(state, value):
+                state.cpu.PC = pc
+            raise Concretize(e.message,
+                             expression=e.address,
+                             setstate=setstate,
+                             policy=e.policy)
         except MemoryException as e:
             raise TerminateState(e.message, testcase=True)
 
@@ -301,6 +326,9 @@ class State(Eventful):
     def can_be_true(self, expr):
         return self._solver.can_be_true(self._constraints, expr)
 
+    def can_be_true_many(self, exprs):
+        return self._solver.can_be_true_many(self._constraints, exprs)
+
     def must_be_true(self, expr):
         return not self._solver.can_be_true(self._constraints, expr == False)
 
@@ -374,12 +402,7 @@ class State(Eventful):
         :rtype: list[int]
         '''
         buffer = self.cpu.read_bytes(addr, nbytes)
-        result = []
-        with self._constraints as temp_cs:
-            for c in buffer:
-                result.append(self._solver.get_value(temp_cs, c))
-                temp_cs.add(c == result[-1])
-        return result
+        return self._solver.get_values(self._constraints, buffer)
 
     def invoke_model(self, model):
         '''
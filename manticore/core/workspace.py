@@ -3,6 +3,8 @@ import sys
 import glob
 import signal
 import cPickle
+import fnmatch
+import hashlib
 import logging
 import tempfile
 try:
@@ -10,15 +12,65 @@ try:
 except ImportError:
     import StringIO
 
+from collections import OrderedDict
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
 
 from .smtlib import solver
 from .smtlib.solver import SolverException
 from .state import State
+from ..utils.helpers import issymbolic
 
 logger = logging.getLogger(__name__)
 
+
+class PageRefs(object):
+    """
+    Reference counts of the content addressed pages shared by the saved states.
+    Lives in the manager process so every worker sees the same counts.
+    """
+
+    def __init__(self):
+        self._refs = {}
+
+    def acquire(self, hashes):
+        """
+        Add a reference to each page in `hashes`.
+
+        :return: the pages that were not referenced before (need to be written)
+        :rtype: list
+        """
+        new = []
+        for h in hashes:
+            count = self._refs.get(h, 0)
+            if count == 0:
+                new.append(h)
+            self._refs[h] = count + 1
+        return new
+
+    def release(self, hashes):
+        """
+        Drop a reference to each page in `hashes`.
+
+        :return: the pages that are not referenced anymore (can be removed)
+        :rtype: list
+        """
+        dead = []
+        for h in hashes:
+            count = self._refs.get(h, 0) - 1
+            if count <= 0:
+                self._refs.pop(h, None)
+                dead.append(h)
+            else:
+                self._refs[h] = count
+        return dead
+
+    def count(self, h):
+        return self._refs.get(h, 0)
+
+
+SyncManager.register('PageRefs', PageRefs)
+
 manager = SyncManager()
 manager.start(lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
 
@@ -32,25 +84,42 @@ class StateSerializer(object):
     def __init__(self):
         pass
 
-    def serialize(self, state, f):
+    def serialize(self, state, f, persistent_id=None):
+        """
+        :param persistent_id: optional callable returning an external reference
+                              for an object (or None to serialize it inline)
+        """
         raise NotImplementedError
 
-    def deserialize(self, f):
+    def deserialize(self, f, persistent_load=None):
+        """
+        :param persistent_load: optional callable resolving the external
+                                references made by `persistent_id`
+        """
         raise NotImplementedError
 
 
 class PickleSerializer(StateSerializer):
-    def serialize(self, state, f):
+    def serialize(self, state, f, persistent_id=None):
         try:
-            f.write(cPickle.dumps(state, 2))
+            buf = StringIO.StringIO()
+            pickler = cPickle.Pickler(buf, 2)
+            if persistent_id is not None:
+                # Only called for objects that are not builtin containers/atoms
+                pickler.inst_persistent_id = persistent_id
+            pickler.dump(state)
+            f.write(buf.getvalue())
         except RuntimeError:
             # recursion exceeded. try a slower, iterative solution
             from ..utils import iterpickle
             logger.debug("Using iterpickle to dump state")
             f.write(iterpickle.dumps(state, 2))
 
-    def deserialize(self, f):
-        return cPickle.load(f)
+    def deserialize(self, f, persistent_load=None):
+        unpickler = cPickle.Unpickler(f)
+        if persistent_load is not None:
+            unpickler.persistent_load = persistent_load
+        return unpickler.load()
 
 
 class Store(object):
@@ -272,7 +341,7 @@ class MemoryStore(Store):
         del self._data[key]
 
     def ls(self, glob_str):
-        return list(self._data)
+        return fnmatch.filter(self._data, glob_str)
 
 
 class RedisStore(Store):
@@ -333,11 +402,44 @@ def sync(f):
     return new_function
 
 
+class PageCollector(object):
+    """
+    Splits the big buffers of a state (i.e. the `bytearray` backing an `AnonMap`)
+    into content addressed pages while it is serialized. Identical pages, no
+    matter in which state or map they are, are stored just once.
+    """
+    page_size = 0x1000
+
+    def __init__(self):
+        self.pages = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, bytearray) or len(obj) < self.page_size:
+            return None
+        hashes = []
+        for offset in xrange(0, len(obj), self.page_size):
+            page = str(obj[offset:offset + self.page_size])
+            h = hashlib.sha1(page).hexdigest()
+            self.pages[h] = page
+            hashes.append(h)
+        return ('pages', tuple(hashes))
+
+
 class Workspace(object):
     """
     A workspace maintains a list of states to run and assigns them IDs.
+
+    States are saved as a list of the pages they reference followed by the
+    serialized state. Pages are kept while some saved state references them.
     """
 
+    # Loaded pages are immutable, keep the most recently used ones around
+    page_cache_size = 0x1000
+
+    # Starts the states saved with their list of pages. The ones saved before
+    # that are just the serialized state
+    _pages_magic = 'MCPAGES\n'
+
     def __init__(self, lock, store_or_desc=None):
         if isinstance(store_or_desc, Store):
             self._store = store_or_desc
@@ -348,6 +450,16 @@ class Workspace(object):
         self._lock = lock
         self._prefix = 'state_'
         self._suffix = '.pkl'
+        self._page_prefix = 'page_'
+        self._page_refs = manager.PageRefs()
+        # Pages are written and removed under their own lock, not the executor
+        # one, so they do not hold back the workers picking states meanwhile
+        self._page_lock = manager.Lock()
+        self._page_cache = OrderedDict()
+        # Pages of the last state loaded (and deleted) by this process. They are
+        # released lazily as its descendants will most likely reference them, or
+        # by release_held_pages once this process is done
+        self._held_pages = ()
 
     def try_loading_workspace(self):
         state_names = self._store.ls('{}*'.format(self._prefix))
@@ -362,6 +474,10 @@ class Workspace(object):
 
         self._last_id.value = max(state_ids) + 1
 
+        for name in state_names:
+            with self._store.load_stream(name) as f:
+                self._page_refs.acquire(self._load_page_list(f))
+
         return state_ids
 
     @sync
@@ -375,6 +491,57 @@ class Workspace(object):
         self._last_id.value += 1
         return id_
 
+    def _state_key(self, state_id):
+        return '{}{:08x}{}'.format(self._prefix, state_id, self._suffix)
+
+    def _page_key(self, h):
+        return '{}{}'.format(self._page_prefix, h)
+
+    def _load_page_list(self, f):
+        """
+        Read the pages referenced by a saved state, leaving `f` at the state.
+
+        :return: the page hashes, none if it was saved without pages
+        """
+        if f.read(len(self._pages_magic)) != self._pages_magic:
+            f.seek(0)
+            return []
+        return cPickle.load(f)
+
+    def _load_page(self, h):
+        page = self._page_cache.pop(h, None)
+        if page is None:
+            page = self._store.load_value(self._page_key(h))
+            if len(self._page_cache) >= self.page_cache_size:
+                self._page_cache.popitem(last=False)
+        self._page_cache[h] = page
+        return page
+
+    def _persistent_load(self, pid):
+        kind, hashes = pid
+        assert kind == 'pages'
+        return bytearray(''.join(self._load_page(h) for h in hashes))
+
+    def _acquire_pages(self, pages):
+        with self._page_lock:
+            for h in self._page_refs.acquire(pages.keys()):
+                self._store.save_value(self._page_key(h), pages[h])
+
+    def _release_pages(self, hashes):
+        with self._page_lock:
+            for h in self._page_refs.release(hashes):
+                self._page_cache.pop(h, None)
+                self._store.rm(self._page_key(h))
+
+    def release_held_pages(self):
+        """
+        Release the pages of the last state loaded by this process. To be
+        called once it is not going to load more states.
+        """
+        if self._held_pages:
+            self._release_pages(self._held_pages)
+            self._held_pages = ()
+
     def load_state(self, state_id, delete=True):
         """
         Load a state from storage identified by `state_id`.
@@ -383,28 +550,52 @@ class Workspace(object):
         :return: The deserialized state
         :rtype: State
         """
-        return self._store.load_state('{}{:08x}{}'.format(self._prefix, state_id, self._suffix), delete=delete)
+        key = self._state_key(state_id)
+        with self._store.load_stream(key) as f:
+            hashes = self._load_page_list(f)
+            state = self._serializer.deserialize(f, persistent_load=self._persistent_load)
+        if delete:
+            self._store.rm(key)
+            self.release_held_pages()
+            self._held_pages = hashes
+        return state
 
-    def save_state(self, state):
+    def save_state(self, state, state_id=None):
         """
         Save a state to storage, return identifier.
 
+        Only the pages that no other saved state references are written.
+
         :param state: The state to save
+        :param state_id: An id previously taken with _get_id, or None for a new one
         :return: New state id
         :rtype: int
         """
         assert isinstance(state, State)
-        id_ = self._get_id()
-        self._store.save_state(state, '{}{:08x}{}'.format(self._prefix, id_, self._suffix))
+        id_ = self._get_id() if state_id is None else state_id
+        pages = PageCollector()
+        buf = StringIO.StringIO()
+        self._serializer.serialize(state, buf, persistent_id=pages.persistent_id)
+        # The pages must be there before anyone can see the state
+        self._acquire_pages(pages.pages)
+        with self._store.save_stream(self._state_key(id_)) as f:
+            f.write(self._pages_magic)
+            f.write(cPickle.dumps(pages.pages.keys(), 2))
+            f.write(buf.getvalue())
         return id_
 
     def rm_state(self, state_id):
         """
-        Remove a state from storage identified by `state_id`.
+        Remove a state from storage identified by `state_id`. The pages no
+        other saved state references are removed too.
 
         :param state_id: The state reference of what to load
         """
-        return self._store.rm('{}{:08x}{}'.format(self._prefix, state_id, self._suffix))
+        key = self._state_key(state_id)
+        with self._store.load_stream(key) as f:
+            hashes = self._load_page_list(f)
+        self._store.rm(key)
+        self._release_pages(hashes)
 
 
 class ManticoreOutput(object):
@@ -561,8 +752,8 @@ class ManticoreOutput(object):
 
     def save_input_symbols(self, state):
         with self._named_stream('input') as f:
-            for symbol in state.input_symbols:
-                buf = solver.get_value(state.constraints, symbol)
+            symbols = list(state.input_symbols)
+            for symbol, buf in zip(symbols, solver.get_values(state.constraints, symbols)):
                 f.write('%s: %s\n' % (symbol.name, repr(buf)))
 
     def save_syscall_trace(self, state):
@@ -570,24 +761,35 @@ class ManticoreOutput(object):
             f.write(repr(state.platform.syscall_trace))
 
     def save_fds(self, state):
-        def solve_to_fd(data, fd):
+        def solve_to_fds(writes):
+            # All the symbolic bytes are solved at once, in a single model
+            symbols = [c for data, _ in writes for c in data if issymbolic(c)]
             try:
-                for c in data:
-                    fd.write(chr(solver.get_value(state.constraints, c)))
+                values = iter(solver.get_values(state.constraints, symbols))
             except SolverException:
-                fd.write('{SolverException}')
+                values = None
+            for data, fd in writes:
+                for c in data:
+                    if issymbolic(c):
+                        if values is None:
+                            fd.write('{SolverException}')
+                            break
+                        c = chr(next(values))
+                    fd.write(c)
 
         with self._named_stream('stdout') as _out:
             with self._named_stream('stderr') as _err:
                 with self._named_stream('stdin') as _in:
                     with self._named_stream('net') as _net:
+                        writes = []
                         for name, fd, data in state.platform.syscall_trace:
                             if name in ('_transmit', '_write'):
                                 if fd == 1:
-                                    solve_to_fd(data, _out)
+                                    writes.append((data, _out))
                                 elif fd == 2:
-                                    solve_to_fd(data, _err)
+                                    writes.append((data, _err))
                             if name in ('_recv'):
-                                solve_to_fd(data, _net)
+                                writes.append((data, _net))
                             if name in ('_receive', '_read') and fd == 0:
-                                solve_to_fd(data, _in)
+                                writes.append((data, _in))
+                        solve_to_fds(writes)
@@ -1,8 +1,10 @@
+import array
 import hashlib
 import binascii
 import string
 import re
 import os
+import time
 from . import Manticore
 from .manticore import ManticoreError
 from .core.smtlib import ConstraintSet, Operators, solver, issymbolic, istainted, taint_with, get_taints, Constant, operators
@@ -24,6 +26,10 @@ from functools import reduce
 from contextlib import contextmanager
 logger = logging.getLogger(__name__)
 
+# Seconds a worker may keep the coverage it saw before merging it into the
+# shared context. It is merged too whenever a state terminates.
+coverage_flush_interval = 1
+
 
 class EthereumError(ManticoreError):
     pass
@@ -352,10 +358,12 @@ class DetectIntegerOverflow(Detector):
         if mnemonic in ('SLT', 'SGT', 'SDIV', 'SMOD'):
             result = taint_with(result, "SIGNED")
 
-        if state.can_be_true(ios):
+        # Both checks are independent, let the solver answer them at once
+        ios_can_be_true, iou_can_be_true = state.can_be_true_many([ios, iou])
+        if ios_can_be_true:
             id_val = self._save_current_location(state, "Signed integer overflow at %s instruction" % mnemonic, ios)
             result = taint_with(result, "IOS_{:s}".format(id_val))
-        if state.can_be_true(iou):
+        if iou_can_be_true:
             id_val = self._save_current_location(state, "Unsigned integer overflow at %s instruction" % mnemonic, iou)
             result = taint_with(result, "IOU_{:s}".format(id_val))
 
@@ -1127,8 +1135,13 @@ class ManticoreEVM(Manticore):
         self.context['seth']['_final_states'] = []
         self.context['seth']['_completed_transactions'] = 0
 
+        # context name -> address -> pcs executed by this worker not yet merged
+        self._coverage = {}
+        self._coverage_flushed = time.time()
+
         self._executor.subscribe('did_load_state', self._load_state_callback)
         self._executor.subscribe('will_terminate_state', self._terminate_state_callback)
+        self._executor.subscribe('will_fork_state', self._fork_state_callback)
         self._executor.subscribe('did_evm_execute_instruction', self._did_evm_execute_instruction_callback)
         self._executor.subscribe('did_read_code', self._did_evm_read_code)
         self._executor.subscribe('on_symbolic_sha3', self._symbolic_sha3)
@@ -1555,6 +1568,7 @@ class ManticoreEVM(Manticore):
             Every time a state finishes executing last transaction we save it in
             our private list
         '''
+        self._flush_coverage()
         if str(e) == 'Abandoned state':
             #do nothing
             return
@@ -1591,6 +1605,12 @@ class ManticoreEVM(Manticore):
             del state.context['processed']
             self.save(state)  # Add to running states
 
+    def _fork_state_callback(self, state, expression, solutions, policy):
+        ''' INTERNAL USE
+            A forked state is never terminated, merge what it covered
+        '''
+        self._flush_coverage()
+
     #Callbacks
     def _load_state_callback(self, state, state_id):
         ''' INTERNAL USE
@@ -1630,16 +1650,44 @@ class ManticoreEVM(Manticore):
         logger.debug("%s", state.platform.current_vm)
         #TODO move to a plugin
         at_init = state.platform.current_transaction.sort == 'CREATE'
+        address = state.platform.current_vm.address
         pc = instruction.offset
         if at_init:
             coverage_context_name = 'init_coverage'
         else:
             coverage_context_name = 'runtime_coverage'
 
-        with self.locked_context(coverage_context_name, set) as coverage:
-            coverage.add((state.platform.current_vm.address, pc))
+        # Merged into the shared context by _flush_coverage, not per instruction
+        self._coverage.setdefault(coverage_context_name, {}).setdefault(address, set()).add(pc)
+        if time.time() - self._coverage_flushed > coverage_flush_interval:
+            self._flush_coverage()
+
+        # Runs of the pcs executed in a row at the same contract, it is copied
+        # on every fork and saved with the state so no tuple per instruction
+        trace = state.context.setdefault('evm.trace', [])
+        if not trace or trace[-1][0] != address or trace[-1][1] != at_init:
+            trace.append((address, at_init, array.array('I')))
+        trace[-1][2].append(pc)
 
-        state.context.setdefault('evm.trace', []).append((state.platform.current_vm.address, pc, at_init))
+    @staticmethod
+    def _iter_trace(trace):
+        ''' INTERNAL USE
+            The (address, pc, at_init) of every instruction in an evm.trace
+        '''
+        for address, at_init, pcs in trace:
+            for pc in pcs:
+                yield address, pc, at_init
+
+    def _flush_coverage(self):
+        ''' INTERNAL USE
+            Merges the coverage seen by this worker into the shared context
+        '''
+        pending, self._coverage = self._coverage, {}
+        self._coverage_flushed = time.time()
+        for coverage_context_name, seen in pending.iteritems():
+            with self.locked_context(coverage_context_name, set) as coverage:
+                for address, pcs in seen.iteritems():
+                    coverage.update((address, pc) for pc in pcs)
 
     def _did_evm_read_code(self, state, offset, size):
         ''' INTERNAL USE '''
@@ -1724,7 +1772,8 @@ class ManticoreEVM(Manticore):
             summary.write("Last exception: %s\n" % state.context['last_exception'])
 
             at_runtime = blockchain.last_transaction.sort != 'CREATE'
-            address, offset, at_init = state.context['evm.trace'][-1]
+            address, at_init, pcs = state.context['evm.trace'][-1]
+            offset = pcs[-1]
             assert at_runtime != at_init
 
             #Last instruction if last tx vas valid
@@ -1792,7 +1841,7 @@ class ManticoreEVM(Manticore):
                     fcode = StringIO.StringIO(runtime_code)
                     for chunk in iter(lambda: fcode.read(32), b''):
                         summary.write('\t%s\n' % chunk.encode('hex'))
-                    runtime_trace = set((pc for contract, pc, at_init in state.context['evm.trace'] if address == contract and not at_init))
+                    runtime_trace = set((pc for contract, pc, at_init in self._iter_trace(state.context['evm.trace']) if address == contract and not at_init))
                     summary.write("Coverage %d%% (on this state)\n" % calculate_coverage(runtime_code, runtime_trace))  # coverage % for address in this account/state
                 summary.write("\n")
 
@@ -1884,15 +1933,15 @@ class ManticoreEVM(Manticore):
                 statef.write(iterpickle.dumps(state, 2))
 
         with testcase.open_stream('trace') as f:
-            self._emit_trace_file(f, state.context['evm.trace'])
+            self._emit_trace_file(f, self._iter_trace(state.context['evm.trace']))
         return testcase
 
     @staticmethod
     def _emit_trace_file(filestream, trace):
         """
         :param filestream: file object for the workspace trace file
-        :param trace: list of (contract address, pc) tuples
-        :type trace: list[tuple(int, int)]
+        :param trace: (contract address, pc, at_init) tuples
+        :type trace: iterable[tuple(int, int, bool)]
         """
         for contract, pc, at_init in trace:
             if pc == 0:
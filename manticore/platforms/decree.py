@@ -875,9 +875,11 @@ class Decree(Platform):
         :todo: This is where we could implement a simple schedule.
         """
         try:
-            self.current.execute()
-            self.clocks += 1
-            if self.clocks % 10000 == 0:
+            cpu = self.current
+            icount, clocks = cpu.icount, self.clocks
+            cpu.execute_block()
+            self.clocks += cpu.icount - icount
+            if self.clocks // 10000 != clocks // 10000:
                 self.check_timers()
                 self.sched()
         except Interruption as e:
@@ -1,6 +1,7 @@
 ''' Symbolic EVM implementation based on the yellow paper: http://gavwood.com/paper.pdf '''
 import random
 import copy
+import hashlib
 import inspect
 from functools import wraps
 from ..utils.helpers import issymbolic, memoized
@@ -951,6 +952,40 @@ def concretized_args(**policies):
     return concretizer
 
 
+EVMProgram = namedtuple("EVMProgram", ['instructions', 'jumpdests', 'blocks'])
+
+# Predecoded programs shared by every EVM running the same code, by code sha1
+_programs = {}
+
+
+def predecode(bytecode):
+    ''' The EVMProgram of a concrete bytecode: its instructions by offset, the
+        offsets of its JUMPDESTs and the offsets starting a basic block. Every
+        code is disassembled once per process.
+    '''
+    bytecode = str(bytecode)
+    key = hashlib.sha1(bytecode).digest()
+    program = _programs.get(key)
+    if program is None:
+        instructions = {}
+        jumpdests = set()
+        blocks = set([0])
+        # Operands running past the end of the code are padded with zeros
+        for instruction in EVMAsm.disassemble_all(bytecode + '\x00' * 32):
+            offset = instruction.offset
+            if offset >= len(bytecode):
+                break
+            instructions[offset] = instruction
+            if instruction.semantics == 'JUMPDEST':
+                jumpdests.add(offset)
+                blocks.add(offset)
+            if instruction.is_branch or instruction.is_terminator:
+                blocks.add(offset + instruction.size)
+        program = EVMProgram(instructions, frozenset(jumpdests), frozenset(blocks))
+        _programs[key] = program
+    return program
+
+
 class EVM(Eventful):
     '''Machine State. The machine state is defined as
         the tuple (g, pc, m, i, s) which are the gas available, the
@@ -1019,6 +1054,9 @@ class EVM(Eventful):
 
         '''
         super(EVM, self).__init__(**kwargs)
+        # The concrete code, decoded by predecode() when first executed
+        self._code = None
+        self._program = None
         if data is not None and not issymbolic(data):
             data_size = len(data)
             data_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=data_size, name='DATA')
@@ -1026,6 +1064,7 @@ class EVM(Eventful):
             data = data_symbolic
 
         if bytecode is not None and not issymbolic(bytecode):
+            self._code = str(bytecode)
             bytecode_size = len(bytecode)
             bytecode_symbolic = constraints.new_array(index_bits=256, value_bits=8, index_max=bytecode_size, name='BYTECODE')
             bytecode_symbolic[0:bytecode_size] = bytecode
@@ -1082,6 +1121,7 @@ class EVM(Eventful):
         state['data'] = self.data
         state['value'] = self.value
         state['bytecode'] = self._bytecode
+        state['code'] = self._code
         state['pc'] = self.pc
         state['stack'] = self.stack
         state['gas'] = self._gas
@@ -1103,6 +1143,8 @@ class EVM(Eventful):
         self.data = state['data']
         self.value = state['value']
         self._bytecode = state['bytecode']
+        self._code = state['code']
+        self._program = None
         self.pc = state['pc']
         self.stack = state['stack']
         self._allocated = state['allocated']
@@ -1151,6 +1193,13 @@ class EVM(Eventful):
     def disassemble(self):
         return EVMAsm.disassemble(self.bytecode)
 
+    @property
+    def program(self):
+        ''' The predecoded EVMProgram of the code, None if it is symbolic '''
+        if self._program is None and self._code is not None:
+            self._program = predecode(self._code)
+        return self._program
+
     @property
     def PC(self):
         return self.pc
@@ -1165,6 +1214,13 @@ class EVM(Eventful):
         #    return InvalidOpcode('Code out of range')
         # if self.pc in self.invalid:
         #    raise InvalidOpcode('Opcode inside a PUSH immediate')
+        program = self.program
+        if program is not None:
+            instruction = program.instructions.get(self.pc)
+            if instruction is not None:
+                return instruction
+
+        # Symbolic code or a pc off the instruction boundaries
         try:
             _decoding_cache = getattr(self, '_decoding_cache')
         except:
@@ -1175,8 +1231,11 @@ class EVM(Eventful):
 
         def getcode():
             bytecode = self.bytecode
-            for pc in range(self.pc, len(bytecode)):
-                yield simplify(bytecode[pc]).value
+            for pc in xrange(self.pc, len(bytecode)):
+                byte = bytecode[pc]
+                if not isinstance(byte, Constant):
+                    byte = simplify(byte)
+                yield byte.value
 
             while True:
                 yield 0
@@ -1197,12 +1256,13 @@ class EVM(Eventful):
         if len(self.stack) >= 1024:
             raise StackOverflow()
 
+        # Concrete words stay python ints, constants that carry no taint too
         if isinstance(value, (int, long)):
             value = value & TT256M1
-
-        value = simplify(value)
-        if isinstance(value, Constant) and not value.taint:
-            value = value.value
+        else:
+            value = simplify(value)
+            if isinstance(value, Constant) and not value.taint:
+                value = value.value
         self.stack.append(value)
 
     def _top(self, n=0):
@@ -1260,17 +1320,16 @@ class EVM(Eventful):
         #Get arguments (imm, pop)
         current = self.instruction
         arguments = []
-        if self.instruction.has_operand:
+        if current.has_operand:
             arguments.append(current.operand)
-        for _ in range(current.pops):
-            arguments.append(self._pop())
 
-        # simplify stack arguments
-        for i in range(len(arguments)):
-            #if isinstance(arguments[i], Expression):
-            #    arguments[i] = simplify(arguments[i])
-            if isinstance(arguments[i], Constant) and not arguments[i].taint:
-                arguments[i] = arguments[i].value
+        # _push already turned untainted constants into ints
+        pops = current.pops
+        if pops:
+            if len(self.stack) < pops:
+                raise StackUnderflow()
+            arguments.extend(reversed(self.stack[-pops:]))
+            del self.stack[-pops:]
 
         return arguments
 
@@ -1354,19 +1413,19 @@ class EVM(Eventful):
             #do not push result nor advance the pc
             if not current.is_branch:
                 #advance pc pointer
-                self.pc += self.instruction.size
+                self.pc += current.size
             self._publish('did_evm_execute_instruction', current, arguments, Ref(result))
             self._publish('did_execute_instruction', last_pc, self.pc, current)
             raise
         except Emulated as e:
             if not current.is_branch:
                 #advance pc pointer
-                self.pc += self.instruction.size
+                self.pc += current.size
             result = e.result
 
         if not current.is_branch:
             #advance pc pointer
-            self.pc += self.instruction.size
+            self.pc += current.size
         result_ref = Ref(result)
         self._publish('did_evm_execute_instruction', current, arguments, result_ref)
         self._publish('did_execute_instruction', last_pc, self.pc, current)
@@ -1387,23 +1446,37 @@ class EVM(Eventful):
             self._store(offset + i, Operators.ORD(c))
 
     def _load(self, offset, size=1):
-        value = self.memory.read_BE(offset, size)
-        try:
-            value = simplify(value)
-            if not value.taint:
-                value = value.value
-        except:
-            pass
+        value = None
+        if isinstance(offset, (int, long)):
+            # Concrete bytes are joined as ints, no expression involved
+            value = 0
+            for i in xrange(size):
+                byte = self.memory.get(offset + i, 0)
+                if not isinstance(byte, Constant) or byte.taint:
+                    value = None
+                    break
+                value = (value << 8) | (byte.value & 0xff)
+
+        if value is None:
+            value = self.memory.read_BE(offset, size)
+            try:
+                value = simplify(value)
+                if not value.taint:
+                    value = value.value
+            except:
+                pass
 
-        for i in range(size):
-            self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        if self._subscribers('did_evm_read_memory'):
+            for i in range(size):
+                self._publish('did_evm_read_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
         return value
 
     def _store(self, offset, value, size=1):
         ''' Stores value in memory as a big endian '''
         self.memory.write_BE(offset, value, size)
-        for i in range(size):
-            self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
+        if self._subscribers('did_evm_write_memory'):
+            for i in range(size):
+                self._publish('did_evm_write_memory', offset + i, Operators.EXTRACT(value, (size - i - 1) * 8, 8))
     ############################################################################
     #INSTRUCTIONS
 
@@ -1823,9 +1823,7 @@ class Linux(Platform):
             buf = cpu.read_int(iov + i * sizeof_iovec, ptrsize)
             size = cpu.read_int(iov + i * sizeof_iovec + (sizeof_iovec // 2), ptrsize)
 
-            data = ""
-            for j in xrange(0, size):
-                data += Operators.CHR(cpu.read_int(buf + j, 8))
+            data = cpu.read_bytes(buf, size)
             data = self._transform_write_data(data)
             write_fd.write(data)
             self.syscall_trace.append(("_write", fd, data))
@@ -2208,9 +2206,11 @@ class Linux(Platform):
         :todo: This is where we could implement a simple schedule.
         """
         try:
-            self.current.execute()
-            self.clocks += 1
-            if self.clocks % 10000 == 0:
+            cpu = self.current
+            icount, clocks = cpu.icount, self.clocks
+            cpu.execute_block()
+            self.clocks += cpu.icount - icount
+            if self.clocks // 10000 != clocks // 10000:
                 self.check_timers()
                 self.sched()
         except (Interruption, Syscall) as e:
@@ -2503,12 +2503,11 @@ class SLinux(Linux):
         return f
 
     def _transform_write_data(self, data):
-        bytes_concretized = 0
+        bytes_concretized = len([c for c in data if issymbolic(c)])
         concrete_data = []
-        for c in data:
+        for c, value in zip(data, solver.get_values(self.constraints, data)):
             if issymbolic(c):
-                bytes_concretized += 1
-                c = chr(solver.get_value(self.constraints, c))
+                c = chr(value)
             concrete_data.append(c)
 
         if bytes_concretized > 0:
@@ -2664,14 +2663,21 @@ class SLinux(Linux):
         return super(SLinux, self).sys_getrandom(buf, size, flags)
 
     def generate_workspace_files(self):
-        def solve_to_fd(data, fd):
+        def solve_to_fds(writes):
+            # All the symbolic bytes are solved at once, in a single model
+            symbols = [c for data, _ in writes for c in data if issymbolic(c)]
             try:
+                values = iter(solver.get_values(self.constraints, symbols))
+            except SolverException:
+                values = None
+            for data, fd in writes:
                 for c in data:
                     if issymbolic(c):
-                        c = chr(solver.get_value(self.constraints, c))
+                        if values is None:
+                            fd.write('{SolverException}')
+                            break
+                        c = chr(next(values))
                     fd.write(c)
-            except SolverException:
-                fd.write('{SolverException}')
 
         out = StringIO.StringIO()
         inn = StringIO.StringIO()
@@ -2680,24 +2686,27 @@ class SLinux(Linux):
         argIO = StringIO.StringIO()
         envIO = StringIO.StringIO()
 
+        writes = []
         for name, fd, data in self.syscall_trace:
             if name in ('_transmit', '_write'):
                 if fd == 1:
-                    solve_to_fd(data, out)
+                    writes.append((data, out))
                 elif fd == 2:
-                    solve_to_fd(data, err)
+                    writes.append((data, err))
             if name in ('_recv'):
-                solve_to_fd(data, net)
+                writes.append((data, net))
             if name in ('_receive', '_read') and fd == 0:
-                solve_to_fd(data, inn)
+                writes.append((data, inn))
 
         for a in self.argv:
-            solve_to_fd(a, argIO)
-            argIO.write("\n")
+            writes.append((a, argIO))
+            writes.append(("\n", argIO))
 
         for e in self.envp:
-            solve_to_fd(e, envIO)
-            envIO.write("\n")
+            writes.append((e, envIO))
+            writes.append(("\n", envIO))
+
+        solve_to_fds(writes)
 
         ret = {
             'syscalls': repr(self.syscall_trace),
@@ -4,6 +4,28 @@ from weakref import WeakKeyDictionary, ref
 
 logger = logging.getLogger(__name__)
 
+# Bumped on every subscription or forwarding change anywhere, invalidating the
+# compiled dispatch lists
+_version = 0
+
+
+def _changed():
+    global _version
+    _version += 1
+
+
+class _Forwards(WeakKeyDictionary):
+    ''' Sink -> include_source. A dying sink changes the subscriptions '''
+
+    def __init__(self):
+        WeakKeyDictionary.__init__(self)
+        remove = self._remove
+
+        def _remove(k):
+            _changed()
+            remove(k)
+        self._remove = _remove
+
 
 class EventsGatherMetaclass(type):
     '''
@@ -69,13 +91,16 @@ class Eventful(object):
         # Note that several methods can be associated with the same object
         self._signals = dict()
         # a set of sink eventful objects (see forward_events_from())
-        self._forwards = WeakKeyDictionary()
+        self._forwards = _Forwards()
+        # "event name" -> (version, all the callbacks reached from here)
+        self._dispatch = dict()
         super(Eventful, self).__init__(*args, **kwargs)
 
     def __setstate__(self, state):
         ''' It wont get serialized by design, user is responsible to reconnect'''
         self._signals = dict()
-        self._forwards = WeakKeyDictionary()
+        self._forwards = _Forwards()
+        self._dispatch = dict()
         return True
 
     def __getstate__(self):
@@ -94,6 +119,7 @@ class Eventful(object):
                 remove.add(name)
         for name in remove:
             del self._signals[name]
+        _changed()
 
     def _get_signal_bucket(self, name):
         # Each event name has a bucket of callback methods
@@ -110,28 +136,49 @@ class Eventful(object):
         if basename not in cls.__all_events__[cls]:
             logger.warning("Event '%s' not pre-declared. (self: %s)", _name, repr(self))
 
-    # Wrapper for _publish_impl that also makes sure the event is published from
-    # a class that supports it.
+    # Publishes an event from a class that supports it.
+    # The callbacks of an event name are resolved through the forward chain once
+    # and reused until any subscription changes, so publishing an event nobody
+    # listens to costs a dict lookup.
     # The underscore _name is to avoid naming collisions with callback params
     def _publish(self, _name, *args, **kwargs):
-        self._check_event(_name)
-        self._publish_impl(_name, *args, **kwargs)
-
-    # Separate from _publish since the recursive method call to forward an event
-    # shouldn't check the event.
-    def _publish_impl(self, _name, *args, **kwargs):
-        bucket = self._get_signal_bucket(_name)
-        for robj, methods in bucket.iteritems():
-            for callback in methods:
+        for robj, callback, sources in self._subscribers(_name):
+            if sources:
+                callback(robj(), *(tuple(source() for source in sources) + args), **kwargs)
+            else:
                 callback(robj(), *args, **kwargs)
 
+    def _subscribers(self, _name):
+        ''' The callbacks an event published here reaches, empty if nobody listens '''
+        compiled = self._dispatch.get(_name)
+        if compiled is None or compiled[0] != _version:
+            if compiled is None:
+                self._check_event(_name)
+            compiled = self._dispatch[_name] = (_version, self._compile_subscribers(_name))
+        return compiled[1]
+
+    def _compile_subscribers(self, _name, sources=()):
+        '''
+        Flatten the callbacks subscribed to _name here and on every forwarded
+        sink into a tuple of (subscriber ref, callback, source refs to prepend)
+        '''
+        compiled = []
+        for robj, methods in self._signals.get(_name, {}).iteritems():
+            # A plain ref, robj's callback would keep self alive
+            obj = robj()
+            if obj is None:
+                continue
+            for callback in methods:
+                compiled.append((ref(obj), callback, sources))
+
         # The include_source flag indicates to prepend the source of the event in
         # the callback signature. This is set on forward_events_from/to
         for sink, include_source in self._forwards.items():
             if include_source:
-                sink._publish_impl(_name, self, *args, **kwargs)
+                compiled.extend(sink._compile_subscribers(_name, (ref(self),) + sources))
             else:
-                sink._publish_impl(_name, *args, **kwargs)
+                compiled.extend(sink._compile_subscribers(_name, sources))
+        return tuple(compiled)
 
     def subscribe(self, name, method):
         if not inspect.ismethod(method):
@@ -140,6 +187,7 @@ class Eventful(object):
         bucket = self._get_signal_bucket(name)
         robj = ref(obj, self._unref)  # see unref() for explanation
         bucket.setdefault(robj, set()).add(callback)
+        _changed()
 
     def forward_events_from(self, source, include_source=False):
         if not isinstance(source, Eventful):
@@ -151,3 +199,4 @@ class Eventful(object):
         if not isinstance(sink, Eventful):
             raise TypeError
         self._forwards[sink] = include_source
+        _changed()
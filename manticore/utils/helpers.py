@@ -55,7 +55,8 @@ def get_taints(arg, taint=None):
 
 def taint_with(arg, taint, value_bits=256, index_bits=256):
     '''
-    Helper to taint a value, Fixme this should not taint in place.
+    Helper to taint a value. Interned expressions are shared, those are
+    rebuilt with the taint instead of tainted in place.
     :param arg: a value or Expression
     :param taint: a regular expression matching a taint value (eg. 'IMPORTANT.*'). If None this functions check for any taint value.
     '''
@@ -64,7 +65,10 @@ def taint_with(arg, taint, value_bits=256, index_bits=256):
             arg = BitVecConstant(value_bits, arg)
     if not issymbolic(arg):
         raise ValueError("type not supported")
-    arg._taint = arg.taint | frozenset((taint,))
+    taint = arg.taint | frozenset((taint,))
+    if type(arg)._interned:
+        return type(arg)(*arg._args(), taint=taint)
+    arg._taint = taint
     return arg
 
 
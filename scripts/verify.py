@@ -77,7 +77,8 @@ def post_mcore(state, last_instruction):
         if writes:
             logger.debug("Got %d writes", len(writes))
         for addr, val in writes:
-            gdb.setByte(addr, val[0])
+            for offset, byte in enumerate(val):
+                gdb.setByte(addr + offset, byte)
 
         # Write return val to gdb
         gdb_r0 = gdb.getR('R0')
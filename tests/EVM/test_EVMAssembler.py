@@ -40,6 +40,27 @@ class EVMTest_Assembler(unittest.TestCase):
         asmcode =  evm.EVMAsm.disassemble_hex('0x606040526002610100')
         self.assertEqual(asmcode, '''PUSH1 0x60\nBLOCKHASH\nMSTORE\nPUSH1 0x2\nPUSH2 0x100''')
 
+    def test_predecode(self):
+        #PUSH1 0x4, JUMP, STOP, JUMPDEST and a truncated PUSH1
+        bytecode = '\x60\x04\x56\x00\x5b\x60'
+        program = evm.predecode(bytecode)
+        self.assertIs(evm.predecode(bytearray(bytecode)), program)
+        self.assertItemsEqual(program.instructions.keys(), [0, 2, 3, 4, 5])
+        self.assertEqual(program.instructions[5].operand, 0)
+        self.assertEqual(program.jumpdests, frozenset([4]))
+        self.assertEqual(program.blocks, frozenset([0, 3, 4]))
+
+        #Every vm running the code shares it, also once unpickled
+        import pickle
+        vms = []
+        for _ in range(2):
+            constraints = ConstraintSet()
+            world = evm.EVMWorld(constraints)
+            vms.append(evm.EVM(constraints, 0x222, '', 0x111, 0, bytecode, world=world))
+        vms.append(pickle.loads(pickle.dumps(vms[0])))
+        for vm in vms:
+            self.assertIs(vm.instruction, program.instructions[0])
+
 
 
 
@@ -39,7 +39,8 @@ class IntegrationTest(unittest.TestCase):
         """
         dirname = os.path.dirname(__file__)
         filename = os.path.join(dirname, 'binaries', filename)
-        command = ['python', '-m', 'manticore']
+        workspace = os.path.join(self.test_dir, 'workspace')
+        command = ['python', '-m', 'manticore', '--workspace', workspace]
 
         if contract:
             command.append('--contract')
@@ -89,7 +90,8 @@ class IntegrationTest(unittest.TestCase):
 
         dirname = os.path.dirname(__file__)
         filename = os.path.join(dirname, 'binaries', 'basic_linux_amd64')
-        output = subprocess.check_output(['python', '-m', 'manticore', filename])
+        workspace = os.path.join(self.test_dir, 'workspace')
+        output = subprocess.check_output(['python', '-m', 'manticore', '--workspace', workspace, filename])
         output_lines = output.splitlines()
         start_info = output_lines[:2]
         testcase_info = output_lines[2:-5]
@@ -1,9 +1,12 @@
 from __future__ import absolute_import
+import pickle
 import struct
 import unittest
 from manticore.core.cpu.x86 import *
 from manticore.core.smtlib import Operators
 from manticore.core.memory import *
+from manticore.core.state import Concretize, State
+from manticore.platforms.platform import Platform
 from tests import mockmem
 from functools import reduce
 
@@ -22,6 +25,32 @@ class RWOperand(ROOperand):
 
 sizes = {'RAX': 64, 'EAX': 32, 'AX': 16, 'AL': 8, 'AH': 8, 'RCX': 64, 'ECX': 32, 'CX': 16, 'CL': 8, 'CH': 8, 'RDX': 64, 'EDX': 32, 'DX': 16, 'DL': 8, 'DH': 8, 'RBX': 64, 'EBX': 32, 'BX': 16, 'BL': 8, 'BH': 8, 'RSP': 64, 'ESP': 32, 'SP': 16, 'SPL': 8, 'RBP': 64, 'EBP': 32, 'BP': 16, 'BPL': 8, 'RSI': 64, 'ESI': 32, 'SI': 16, 'SIL': 8, 'RDI': 64, 'EDI': 32, 'DI': 16, 'DIL': 8, 'R8': 64, 'R8D': 32, 'R8W': 16, 'R8B': 8, 'R9': 64, 'R9D': 32, 'R9W': 16, 'R9B': 8, 'R10': 64, 'R10D': 32, 'R10W': 16, 'R10B': 8, 'R11': 64, 'R11D': 32, 'R11W': 16, 'R11B': 8, 'R12': 64, 'R12D': 32, 'R12W': 16, 'R12B': 8, 'R13': 64, 'R13D': 32, 'R13W': 16, 'R13B': 8, 'R14': 64, 'R14D': 32, 'R14W': 16, 'R14B': 8, 'R15': 64, 'R15D': 32, 'R15W': 16, 'R15B': 8, 'ES': 16, 'CS': 16, 'SS': 16, 'DS': 16, 'FS': 16, 'GS': 16, 'RIP': 64, 'EIP':32, 'IP': 16, 'RFLAGS': 64, 'EFLAGS': 32, 'FLAGS': 16, 'XMM0': 128, 'XMM1': 128, 'XMM2': 128, 'XMM3': 128, 'XMM4': 128, 'XMM5': 128, 'XMM6': 128, 'XMM7': 128, 'XMM8': 128, 'XMM9': 128, 'XMM10': 128, 'XMM11': 128, 'XMM12': 128, 'XMM13': 128, 'XMM14': 128, 'XMM15': 128, 'YMM0': 256, 'YMM1': 256, 'YMM2': 256, 'YMM3': 256, 'YMM4': 256, 'YMM5': 256, 'YMM6': 256, 'YMM7': 256, 'YMM8': 256, 'YMM9': 256, 'YMM10': 256, 'YMM11': 256, 'YMM12': 256, 'YMM13': 256, 'YMM14': 256, 'YMM15': 256}
 
+class CpuPlatform(Platform):
+    ''' Runs a single cpu '''
+    def __init__(self, cpu):
+        super(CpuPlatform, self).__init__(None)
+        self.current = cpu
+
+    def __getstate__(self):
+        state = super(CpuPlatform, self).__getstate__()
+        state['current'] = self.current
+        return state
+
+    def __setstate__(self, state):
+        super(CpuPlatform, self).__setstate__(state)
+        self.current = state['current']
+
+    @property
+    def constraints(self):
+        return self.current.memory.constraints
+
+    @constraints.setter
+    def constraints(self, constraints):
+        self.current.memory.constraints = constraints
+
+    def execute(self):
+        return self.current.execute()
+
 class SymCPUTest(unittest.TestCase):
     _multiprocess_can_split_ = True
     _flag_offsets = {
@@ -587,6 +616,150 @@ class SymCPUTest(unittest.TestCase):
 
         self.assertRaises(Exception, cpu.read_int, 0xf100, 0x414243445464748, 64)
 
+    def test_bytes_range(self):
+        cs = ConstraintSet()
+        mem = SMemory64(cs)
+        cpu = AMD64Cpu(mem)
+        mem.mmap(0x1000, 0x2000, 'rw')
+        mem.mmap(0x3000, 0x1000, 'r')
+
+        class Recorder(object):
+            events = []
+            def did_write(self, where, data):
+                self.events.append((where, len(data)))
+        recorder = Recorder()
+        cpu.subscribe('did_write_memory_range', recorder.did_write)
+        sym = cs.new_bitvec(8)
+        cpu.write_bytes(0x1ffe, ['A', sym, 0x42, 'C'] + ['D'] * 0xffe)
+        self.assertEqual(recorder.events, [(0x1ffe, 0x1002)])
+        data = cpu.read_bytes(0x1ffe, 0x1002)
+        self.assertEqual(data[0], 'A')
+        self.assertIs(data[1], sym)
+        self.assertEqual(''.join(data[2:]), 'BC' + 'D' * 0xffe)
+
+        # Concrete writes drop the symbolic byte, strings stop at it
+        cpu.write_bytes(0x1fff, '\x00')
+        self.assertEqual(cpu.read_string(0x1ffe), 'A')
+        cpu.write_bytes(0x1fff, [sym])
+        self.assertEqual(cpu.read_string(0x2000), 'BC' + 'D' * 0xffe)
+        self.assertEqual(cpu.read_string(0x2000, 0x100), 'BC' + 'D' * 0xfe)
+
+        # Nothing is written when a part of the range can not be
+        self.assertRaises(InvalidMemoryAccess, cpu.write_bytes, 0x2ffe, 'XXXX')
+        self.assertEqual(cpu.read_bytes(0x2ffe, 4), ['D', 'D', '\x00', '\x00'])
+
+    def test_lazy_flags(self):
+        import pickle
+        from manticore.core.cpu import x86
+        cs = ConstraintSet()
+        value = cs.new_bitvec(64)
+        # add rax, rbx; adc rcx, rax; inc rdx; xor rsi, rax; test rsi, rdx; cmp rax, rcx; neg rdi; sbb rcx, rdx
+        code = '\x48\x01\xd8\x48\x11\xc1\x48\xff\xc2\x48\x31\xc6\x48\x85\xd6\x48\x39\xc8\x48\xf7\xdf\x48\x19\xd1'
+        flags = ('CF', 'PF', 'AF', 'ZF', 'SF', 'OF')
+
+        def run(lazy, symbolic, count):
+            mem = SMemory64(cs)
+            cpu = AMD64Cpu(mem)
+            mem.mmap(0x1000, 0x1000, 'rwx')
+            mem.write(0x1000, code)
+            cpu.RIP = 0x1000
+            cpu.RAX = value if symbolic else 0xfffffffffffffffe
+            cpu.RBX = 3
+            cpu.RDI = 7
+            old, x86.lazy_flags = x86.lazy_flags, lazy
+            try:
+                for _ in range(count):
+                    cpu.execute()
+            finally:
+                x86.lazy_flags = old
+            return cpu
+
+        for symbolic in (False, True):
+            for count in range(1, 9):
+                eager, lazy = run(False, symbolic, count), run(True, symbolic, count)
+                self.assertFalse(eager.regfile._lazy_flags)
+                self.assertTrue(lazy.regfile._lazy_flags)
+                lazy = pickle.loads(pickle.dumps(lazy))
+                for flag in flags + ('RFLAGS',):
+                    self.assertEqual(visitors.translate_to_smtlib(getattr(lazy, flag)),
+                                     visitors.translate_to_smtlib(getattr(eager, flag)))
+                self.assertFalse(lazy.regfile._lazy_flags)
+
+        # Flags are written eagerly while someone listens to register writes
+        class Recorder(object):
+            registers = []
+            def did_write(self, register, value):
+                self.registers.append(register)
+        recorder = Recorder()
+        mem = SMemory64(cs)
+        cpu = AMD64Cpu(mem)
+        mem.mmap(0x1000, 0x1000, 'rwx')
+        mem.write(0x1000, code)
+        cpu.RIP = 0x1000
+        cpu.subscribe('did_write_register', recorder.did_write)
+        cpu.execute()
+        self.assertFalse(cpu.regfile._lazy_flags)
+        self.assertItemsEqual([r for r in recorder.registers if r in flags], flags)
+
+    def test_self_modifying_code(self):
+        # inc rax; inc rax; jmp $
+        code = '\x48\xff\xc0\x48\xff\xc0\xeb\xfe'
+        mem = SMemory64(ConstraintSet())
+        cpu = AMD64Cpu(mem)
+        mem.mmap(0x1000, 0x2000, 'rwx')
+        mem.write(0x1000, code)
+
+        def run():
+            cpu.RIP = 0x1000
+            cpu.RAX = 0
+            cpu.execute_block()
+            self.assertEqual(cpu.RIP, 0x1006)
+            return cpu.RAX
+
+        self.assertEqual(run(), 2)
+        # The decoded block is dropped once its code is written...
+        cpu.write_bytes(0x1003, '\x48\xff\xc8')  # dec rax
+        self.assertEqual(run(), 0)
+        # ...or remapped
+        mem.munmap(0x1000, 0x1000)
+        mem.mmap(0x1000, 0x1000, 'rwx')
+        mem.write(0x1000, code.replace('\xc0', '\xc8'))
+        self.assertEqual(run(), 0xfffffffffffffffe)
+        # Writing to other pages keeps it
+        block = cpu.decode_block(0x1000)
+        mem.write(0x2000, 'A')
+        self.assertIs(cpu.decode_block(0x1000), block)
+
+    def test_fork_on_symbolic_address(self):
+        from manticore.core import memory
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        cpu = I386Cpu(mem)
+        mem.mmap(0x1000, 0x1000, 'rwx')
+        mem.mmap(0x2000, 0x1000, 'rw')
+        mem.write(0x1000, '\x8a\x03')  # mov al, byte ptr [ebx]
+        mem.write(0x2000, 'AB')
+        cpu.EIP = 0x1000
+        cpu.EBX = cs.new_bitvec(32)
+        cs.add(Operators.OR(cpu.EBX == 0x2000, cpu.EBX == 0x2001))
+        state = State(cs, CpuPlatform(cpu))
+
+        strategy, memory.symbolic_access_strategy = memory.symbolic_access_strategy, 'fork'
+        try:
+            with self.assertRaises(Concretize) as e:
+                state.execute()
+            # Every child loads from its own address
+            for address, byte in [(0x2000, 'A'), (0x2001, 'B')]:
+                # As the executor forks it
+                with state as child:
+                    child.constrain(e.exception.expression == address)
+                    e.exception.setstate(child, address)
+                    child = pickle.loads(pickle.dumps(child))
+                child.execute()
+                self.assertEqual(child.cpu.EIP, 0x1002)
+                self.assertEqual(solver.get_all_values(child.constraints, child.cpu.AL), [ord(byte)])
+        finally:
+            memory.symbolic_access_strategy = strategy
 
     def test_IDIV_concrete(self):
         cs = ConstraintSet()
@@ -24,7 +24,7 @@ class ManticoreDriverTest(unittest.TestCase):
 
 
     def testCreating(self):
-        m = Manticore('/bin/ls')
+        m = Manticore('/bin/ls', workspace_url=self.test_dir)
         m.log_file = '/dev/null'
 
     def test_issymbolic(self):
@@ -7,11 +7,11 @@ import os
 
 from manticore.core.plugin import Plugin
 from manticore.core.smtlib import ConstraintSet, operators
-from manticore.core.smtlib.expression import BitVec
+from manticore.core.smtlib.expression import BitVec, BitVecConstant
 from manticore.core.smtlib import solver
 from manticore.core.state import State
 from manticore.ethereum import ManticoreEVM, DetectIntegerOverflow, Detector, NoAliveStates, ABI, EthereumError
-from manticore.platforms.evm import EVMWorld, ConcretizeStack, concretized_args, Return, Stop
+from manticore.platforms.evm import EVM, EVMWorld, ConcretizeStack, concretized_args, Return, Stop, StackUnderflow
 from manticore.core.smtlib.visitors import pretty_print, translate_to_smtlib, simplify, to_constant
 
 import shutil
@@ -30,8 +30,14 @@ def make_mock_evm_state():
 
 
 class EthDetectorsIntegrationTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
     def test_int_ovf(self):
-        mevm = ManticoreEVM()
+        mevm = ManticoreEVM(workspace_url=self.test_dir)
         mevm.register_detector(DetectIntegerOverflow())
         filename = os.path.join(THIS_DIR, 'binaries/int_overflow.sol')
         mevm.multi_tx_analysis(filename, tx_limit=1)
@@ -277,6 +283,53 @@ class EthTests(unittest.TestCase):
                 self.assertEquals(x.result, 'RETURN')
                 self.assertEquals(state.solve_one(x.return_data), b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01')
 
+    def _create_branching_contract(self, owner):
+        # PUSH1 0; CALLDATALOAD; PUSH1 10; JUMPI; PUSH1 1; STOP; STOP;
+        # JUMPDEST; PUSH1 2; STOP
+        runtime = '600035600a57600100005b600200'.decode('hex')
+        # Copies the runtime code to memory and returns it
+        init = '600e80600b6000396000f3'.decode('hex') + runtime
+        return int(self.mevm.create_contract(owner=owner, init=init))
+
+    def _test_coverage(self):
+        m = self.mevm
+        owner = m.create_account(balance=1000)
+        contract = self._create_branching_contract(owner)
+        for _ in range(2):
+            m.transaction(caller=owner, address=contract, value=0, data=m.make_symbolic_buffer(32))
+        self.assertEqual(m.count_running_states(), 4)
+
+        with m.locked_context('init_coverage', set) as coverage:
+            self.assertEqual(set(coverage), set((contract, pc) for pc in [0, 2, 3, 5, 7, 8, 10]))
+        # Every pc but the unreachable STOP at 9
+        with m.locked_context('runtime_coverage', set) as coverage:
+            self.assertEqual(set(coverage), set((contract, pc) for pc in [0, 2, 3, 5, 6, 8, 10, 11, 13]))
+        self.assertEqual(m.global_coverage(contract), 100 * 9 / 10.)
+
+    def test_coverage(self):
+        self._test_coverage()
+
+    def test_trace(self):
+        m = self.mevm
+        owner = m.create_account(balance=1000)
+        contract = self._create_branching_contract(owner)
+        m.transaction(caller=owner, address=contract, value=0, data='\x00' * 32)
+        state = next(m.running_states)
+        expected = [(contract, pc, True) for pc in [0, 2, 3, 5, 7, 8, 10]]
+        expected += [(contract, pc, False) for pc in [0, 2, 3, 5, 6, 8]]
+        self.assertEqual(list(m._iter_trace(state.context['evm.trace'])), expected)
+        # One run of pcs per transaction
+        self.assertEqual(len(state.context['evm.trace']), 2)
+
+    def test_coverage_flushed_on_terminate_and_fork(self):
+        from manticore import ethereum
+        # Only the flushes when states terminate or fork happen
+        interval, ethereum.coverage_flush_interval = ethereum.coverage_flush_interval, 3600
+        try:
+            self._test_coverage()
+        finally:
+            ethereum.coverage_flush_interval = interval
+
     def test_emit_did_execute_end_instructions(self):
         """
         Tests whether the did_evm_execute_instruction event is fired for instructions that internally trigger
@@ -491,6 +544,38 @@ class EthHelpersTest(unittest.TestCase):
         inner_func(None, self.bv, 123)
 
 
+class EthEVMTest(unittest.TestCase):
+    def setUp(self):
+        cs = ConstraintSet()
+        world = EVMWorld(cs)
+        self.vm = EVM(cs, 0x222222222222222222222222222222222222200, '',
+                      0x111111111111111111111111111111111111100, 0, '\x01',
+                      gas=1000000, world=world)
+
+    def test_load_concrete(self):
+        self.vm._store(1, 0x41)
+        # Bytes never written read as 0
+        value = self.vm._load(0, 4)
+        self.assertIsInstance(value, (int, long))
+        self.assertEqual(value, 0x00410000)
+
+    def test_load_tainted(self):
+        self.vm._store(0, 0x41)
+        self.vm._store(1, BitVecConstant(8, 0x42, taint=('T',)))
+        value = self.vm._load(0, 2)
+        # The taint is kept, so the word is an expression
+        self.assertIsInstance(value, BitVec)
+        self.assertEqual(value.taint, frozenset(['T']))
+        self.assertEqual(to_constant(value), 0x4142)
+
+    def test_pop_arguments_underflow(self):
+        # ADD needs two arguments
+        self.vm._push(1)
+        with self.assertRaises(StackUnderflow):
+            self.vm.execute()
+        self.assertEqual(self.vm.stack, [1])
+
+
 class EthSolidityCompilerTest(unittest.TestCase):
     def test_run_solc(self):
         source_a = '''
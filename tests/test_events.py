@@ -1,4 +1,5 @@
 
+import gc
 import unittest
 
 from manticore.utils.event import Eventful
@@ -76,4 +77,43 @@ class ManticoreDriver(unittest.TestCase):
         b.do_stuff()
         self.assertSequenceEqual(c.received, [(1, 'a'), (2, 'b')])
 
+    def test_forward_source(self):
+        a = A()
+        b = B(a)
+        d = B(a)
+        d.forward_events_from(b, True)
+        c = C()
+        d.subscribe('eventA', c.callback)
+        d.subscribe('eventB', c.callback)
+
+        a.do_stuff()
+        self.assertItemsEqual(c.received, [(1, 'a'), (b, 1, 'a')])
+        b.do_stuff()
+        self.assertSequenceEqual(c.received[2:], [(b, 2, 'b')])
+
+    def test_subscriptions_change(self):
+        a = A()
+        b = B(a)
+        c = C()
 
+        # Nobody listens yet
+        a.do_stuff()
+        b.subscribe('eventA', c.callback)
+        a.do_stuff()
+        self.assertSequenceEqual(c.received, [(1, 'a')])
+
+        # A late subscriber gets the next events
+        other = C()
+        a.subscribe('eventA', other.callback)
+        a.do_stuff()
+        self.assertSequenceEqual(c.received, [(1, 'a'), (1, 'a')])
+        self.assertSequenceEqual(other.received, [(1, 'a')])
+
+        # Neither a dead subscriber nor a dead sink is called anymore
+        del other
+        a.do_stuff()
+        self.assertEqual(len(c.received), 3)
+        del b
+        gc.collect()
+        a.do_stuff()
+        self.assertEqual(len(c.received), 3)
@@ -0,0 +1,227 @@
+import threading
+import unittest
+
+from manticore.core import executor
+from manticore.core.executor import Executor, Scheduler, manager
+from manticore.core.smtlib import ConstraintSet
+from manticore.core.state import ForkState, State
+from manticore.platforms.platform import Platform
+
+
+class LoopCpu(object):
+    PC = 0x1000
+
+
+class SymbolicLoop(Platform):
+    ''' Branches on a new symbolic condition at the same pc, forever '''
+
+    def __init__(self):
+        super(SymbolicLoop, self).__init__(None)
+        self.current = LoopCpu()
+        self.constraints = None
+
+    def __getstate__(self):
+        state = super(SymbolicLoop, self).__getstate__()
+        state['current'] = self.current
+        state['constraints'] = self.constraints
+        return state
+
+    def __setstate__(self, state):
+        super(SymbolicLoop, self).__setstate__(state)
+        self.current = state['current']
+        self.constraints = state['constraints']
+
+    def execute(self):
+        self._publish('will_execute_instruction', self.current.PC, None)
+        raise ForkState('loop', self.constraints.new_bool())
+
+
+class SchedulerTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def test_priority_order(self):
+        for state_id, priority in enumerate([5, 1, 3, 1, 4]):
+            self.scheduler.put(state_id, priority)
+        self.assertEqual(self.scheduler.size(), 5)
+        # Ties are served in queuing order
+        self.assertEqual([self.scheduler.get() for _ in range(5)], [1, 3, 2, 4, 0])
+        self.assertIsNone(self.scheduler.get())
+        self.assertEqual(self.scheduler.size(), 0)
+
+    def test_local_first_then_steal(self):
+        self.scheduler.put(0, 0, worker='a')
+        self.scheduler.put(1, 9, worker='b')
+        self.scheduler.put(2, 5, worker='c')
+        self.scheduler.put(3, 7, worker='b')
+        self.assertEqual(self.scheduler.get('b'), 3)
+        self.assertEqual(self.scheduler.get('b'), 1)
+        # b has nothing left, it steals the best state of the others
+        self.assertEqual(self.scheduler.get('b'), 0)
+        self.assertEqual(self.scheduler.get('d'), 2)
+        self.assertIsNone(self.scheduler.get('b'))
+
+    def test_remove(self):
+        for state_id in range(4):
+            self.scheduler.put(state_id, state_id)
+        self.assertTrue(self.scheduler.remove(0))
+        self.assertFalse(self.scheduler.remove(0))
+        self.assertTrue(self.scheduler.remove(2))
+        self.assertItemsEqual(self.scheduler.ids(), [1, 3])
+        self.assertEqual(self.scheduler.get(), 1)
+
+        # A removed id may be queued again
+        self.scheduler.put(0, 10)
+        self.assertEqual(self.scheduler.get(), 3)
+        self.assertEqual(self.scheduler.get(), 0)
+        self.assertIsNone(self.scheduler.get())
+
+    def test_bump(self):
+        self.scheduler.put(0, 0.5, key='a')
+        self.scheduler.put(1, 0.7, key='b')
+        self.scheduler.put(2, 0.6, key='a')
+        self.scheduler.put(3, 0.9)
+        # Every state at a reprioritizes
+        self.scheduler.bump({'a': 1}, cap=1)
+        self.scheduler.bump({'a': 1, 'b': 1}, cap=1)
+        self.assertEqual(self.scheduler.weight('a'), 1)
+        self.assertEqual(self.scheduler.size(), 4)
+        # States queued later get the current weight
+        self.scheduler.put(4, 0.1, key='b')
+        self.assertEqual([self.scheduler.get() for _ in range(5)], [3, 4, 0, 2, 1])
+
+    def test_limit(self):
+        self.scheduler.put(0, 0, key='a')
+        self.scheduler.put(1, 0, worker='w', key='b')
+        self.scheduler.bump({'a': 3})
+        self.scheduler.bump({'b': 6})
+        self.assertEqual(self.scheduler.get('w', limit=5), 0)
+        self.assertIsNone(self.scheduler.get('w', limit=5))
+        self.assertEqual(self.scheduler.size(), 1)
+        self.assertEqual(self.scheduler.get('w'), 1)
+
+    def test_resident(self):
+        self.scheduler.put(0, 1, worker='a', resident=True)
+        self.scheduler.put(1, 2, worker='a')
+        # Only the worker that queued a resident state gets it
+        self.assertEqual(self.scheduler.size('b'), 1)
+        self.assertEqual(self.scheduler.get('b'), 1)
+        self.assertIsNone(self.scheduler.get('b'))
+        self.assertEqual(self.scheduler.size('a'), 1)
+        self.scheduler.share(0)
+        self.assertEqual(self.scheduler.size('b'), 1)
+        self.assertEqual(self.scheduler.get('b'), 0)
+
+    def test_resident_priority(self):
+        self.scheduler.put(0, 0, worker='a', key='loop', resident=True)
+        self.scheduler.put(1, 1, worker='a')
+        # A resident state is served in priority order too, and not over the limit
+        self.scheduler.bump({'loop': 5})
+        self.assertEqual(self.scheduler.get('a', limit=4), 1)
+        self.assertIsNone(self.scheduler.get('a', limit=4))
+        self.assertEqual(self.scheduler.get('a'), 0)
+
+    def test_shared(self):
+        scheduler = manager.Scheduler()
+        scheduler.put(7, 1, worker=1)
+        scheduler.put(8, 0, worker=2)
+        self.assertEqual(scheduler.size(), 2)
+        self.assertEqual(scheduler.get(1), 7)
+        self.assertEqual(scheduler.get(1), 8)
+        self.assertEqual(scheduler.ids(), [])
+
+
+class ExecutorQueueTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.executor = Executor(store='mem:')
+
+    def test_get_does_not_lock(self):
+        self.executor.put(0)
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.executor._lock:
+                held.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        try:
+            # A queued state is dequeued while someone else holds the lock
+            self.assertEqual(self.executor.get(), 0)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_get_waits_for_running_workers(self):
+        # The only worker bails out on an empty queue
+        self.executor._notify_start_run()
+        self.assertIsNone(self.executor.get())
+
+        # Another worker waits for the states this one forks
+        got = []
+
+        def worker():
+            self.executor._notify_start_run()
+            got.append(self.executor.get())
+            self.executor._notify_stop_run()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.executor.put(1)
+        thread.join()
+        self.executor._notify_stop_run()
+        self.assertEqual(got, [1])
+        self.assertEqual(self.executor.running, 0)
+
+    def test_idle_workers_stop(self):
+        # Workers with nothing to run all stop, they do not keep waking each other
+        got = []
+
+        def worker():
+            self.executor._notify_start_run()
+            got.append(self.executor.get())
+            self.executor._notify_stop_run()
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join(30)
+            self.assertEqual(got, [None] * 8)
+        finally:
+            self.executor.shutdown()
+
+
+class ExecutorResidentTest(unittest.TestCase):
+    _multiprocess_can_split_ = True
+
+    def setUp(self):
+        self.max_resident_states, executor.max_resident_states = executor.max_resident_states, 1
+
+    def tearDown(self):
+        executor.max_resident_states = self.max_resident_states
+
+    def _loaded(self, state, state_id):
+        self.loaded.append(state_id)
+
+    def _enqueued(self, state_id, state):
+        self.enqueued.append(state_id)
+
+    def test_branch_limited_loop(self):
+        ex = Executor(store='mem:', policy='branchlimited')
+        loaded, enqueued = self.loaded, self.enqueued = [], []
+        ex.subscribe('did_load_state', self._loaded)
+        ex.subscribe('did_enqueue_state', self._enqueued)
+        ex.enqueue(State(ConstraintSet(), SymbolicLoop()))
+        ex.run()
+        # The loop is cut once its pc ran more than the limit, the children
+        # kept in the worker included
+        self.assertEqual(len(loaded), ex._policy.limit + 1)
+        self.assertEqual(len(enqueued), 1 + 2 * len(loaded))
+        self.assertEqual(len(ex.list()), len(enqueued) - len(loaded))
+        self.assertEqual(ex._resident, [])
@@ -103,6 +103,21 @@ class LinuxTest(unittest.TestCase):
         self.assertIn('stderr', files)
         self.assertIn('net', files)
 
+    def test_linux_workspace_files_symbolic(self):
+        platform = self.symbolic_linux
+        platform.argv = ["arg1"]
+        data = [platform.constraints.new_bitvec(8) for _ in range(3)]
+        platform.constraints.add(data[0] == ord('i'))
+        platform.constraints.add(data[1] == data[0] + 1)
+        platform.constraints.add(data[2] == ord('\n'))
+        platform.syscall_trace.append(('_read', 0, data))
+        platform.syscall_trace.append(('_write', 1, ['o', 'k', data[2]]))
+
+        files = platform.generate_workspace_files()
+        self.assertEquals(files['stdin'], "ij\n")
+        self.assertEquals(files['stdout'], "ok\n")
+        self.assertEquals(files['argv'], "arg1\n")
+
     def test_syscall_events(self):
         nr_fstat64 = 197
 
@@ -142,6 +157,37 @@ class LinuxTest(unittest.TestCase):
         self.assertEquals(pre_icount+1, post_icount)
         self.assertEquals(r.nevents, 2)
 
+    def test_execute_blocks(self):
+        class Receiver(object):
+            def __init__(self):
+                self.pcs = []
+                self.executed = []
+            def did_exec(self, last_pc, pc, i):
+                self.pcs.append(pc)
+                self.executed.append(last_pc)
+            def did_exec_block(self, pcs, pc):
+                self.executed.extend(pcs)
+
+        # Reference run hooking every instruction
+        r = Receiver()
+        self.linux.current.subscribe('did_execute_instruction', r.did_exec)
+        while self.linux.current.icount < 3000:
+            self.linux.execute()
+
+        # Without hooks whole blocks run per step and end where single steps would be
+        platform = linux.Linux(self.BIN_PATH)
+        # Listening to blocks does not hook the instructions
+        blocks = Receiver()
+        platform.current.subscribe('did_execute_block', blocks.did_exec_block)
+        steps = 0
+        while platform.current.icount < 2900:
+            platform.execute()
+            steps += 1
+            self.assertEqual(platform.current.PC, r.pcs[platform.current.icount - 1])
+        self.assertLess(steps, platform.current.icount)
+        self.assertEqual(blocks.executed, r.executed[:len(blocks.executed)])
+        self.assertEqual(len(blocks.executed), platform.current.icount)
+
     def _create_openat_state(self):
         nr_openat = 322
 
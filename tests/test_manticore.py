@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 
 from manticore import Manticore
@@ -5,7 +7,11 @@ from manticore import Manticore
 class ManticoreTest(unittest.TestCase):
     _multiprocess_can_split_ = True
     def setUp(self):
-        self.m = Manticore('tests/binaries/arguments_linux_amd64')
+        self.test_dir = tempfile.mkdtemp()
+        self.m = Manticore('tests/binaries/arguments_linux_amd64', workspace_url=self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
 
     def test_add_hook(self):
         def tmp(state):
@@ -39,10 +45,12 @@ class ManticoreTest(unittest.TestCase):
                 pass
 
     def test_integration_basic_stdin(self):
-        import os, struct
-        self.m = Manticore('tests/binaries/basic_linux_amd64')
+        import glob, os, struct
+        workspace = os.path.join(self.test_dir, 'workspace')
+        self.m = Manticore('tests/binaries/basic_linux_amd64', workspace_url=workspace)
         self.m.run()
-        workspace = self.m._output.store.uri
+        # No state is left, nor are its pages
+        self.assertEqual(glob.glob(os.path.join(workspace, 'page_*')), [])
         with open(os.path.join(workspace, 'test_00000000.stdin')) as f:
             a = struct.unpack('<I', f.read())[0]
         with open(os.path.join(workspace, 'test_00000001.stdin')) as f:
@@ -1622,6 +1622,89 @@ class MemoryTest(unittest.TestCase):
         m = pickle.loads(pickle.dumps(m))
         self.assertItemsEqual(m[0x10000000:0x10003000], 'X'*0x27f0 + 'Y'*0x20 + '\x00'*0x7f0)
 
+    def test_map_view(self):
+        rwx_file = tempfile.NamedTemporaryFile('w+b', delete=False)
+        rwx_file.file.write('X'*0x1000+'Y'*0x1000+'Z'*0x1000)
+        rwx_file.close()
+        m = FileMap(0x10000000, 0x3000, 'rwx', rwx_file.name)
+        self.assertEqual(str(m.view(0x10000ffe, 0x10001002)), 'XXYY')
+
+        # Writes copy the pages they touch
+        m[0x10000fff:0x10001001] = 'ab'
+        self.assertItemsEqual(m._overlay.keys(), [0x10000000, 0x10001000])
+        self.assertEqual(str(m.view(0x10000ffe, 0x10001002)), 'XabY')
+        self.assertEqual(str(m.view(0x10002000, 0x10002002)), 'ZZ')
+
+        cow = COWMap(m, offset=0x1000)
+        cow[0x10002fff] = 'c'
+        self.assertItemsEqual(cow._overlay.keys(), [0x10002000])
+        self.assertEqual(str(cow.view(0x10001000, 0x10001002)), 'bY')
+        self.assertEqual(str(cow.view(0x10002ffe, 0x10003000)), 'Zc')
+        self.assertEqual(m[0x10002fff], 'Z')
+
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x2000, 'rw')
+        mem.write(addr + 0xffe, 'ABCD')
+        self.assertEqual(str(mem.view(addr + 0xffe, 4)), 'ABCD')
+        mem[addr + 0x1000] = cs.new_bitvec(8)
+        self.assertIsNone(mem.view(addr + 0xffe, 4))
+        self.assertEqual(str(mem.view(addr + 0xffe, 2)), 'AB')
+
+    def test_symbolic_pages(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x3000, 'rw')
+        sym = cs.new_bitvec(8)
+        mem.write(addr + 0xfff, [sym, 'A', sym])
+        self.assertItemsEqual(mem._symbolic_pages.keys(), [mem._page(addr), mem._page(addr) + 1])
+
+        # Concrete pages skip the overlay
+        self.assertEqual(mem.read(addr + 0x2000, 2), ['\x00', '\x00'])
+        self.assertIs(mem.read(addr + 0xfff, 3)[2], sym)
+        mem.write(addr + 0x1001, 'B')
+        self.assertEqual(mem.read(addr + 0xfff, 3)[1:], ['A', 'B'])
+        self.assertItemsEqual(mem._symbolic_pages.keys(), [mem._page(addr)])
+
+        mem = pickle.loads(pickle.dumps(mem))
+        self.assertItemsEqual(mem._symbolic_pages.keys(), [mem._page(addr)])
+        mem.munmap(addr, 0x1000)
+        self.assertEqual(mem._symbols, {})
+        self.assertEqual(mem._symbolic_pages, {})
+
+    def test_symbolic_access_strategies(self):
+        cs = ConstraintSet()
+        mem = SMemory32(cs)
+        addr = mem.mmap(None, 0x1000, 'rw')
+        table = ''.join(chr(i * 7 & 0xff) for i in range(0x20))
+        mem.write(addr, table)
+        index = cs.new_bitvec(32)
+        cs.add(index.ult(0x20))
+
+        # The whole table as an array, no enumeration of the index
+        value = mem.read(addr + index, 1, strategy='array')[0]
+        self.assertIsInstance(value, ArraySelect)
+        with cs as temp_cs:
+            temp_cs.add(value == 7 * 17)
+            self.assertEqual(solver.get_all_values(temp_cs, index), [17])
+
+        mem.write(addr + index, 'Z', strategy='array')
+        with cs as temp_cs:
+            temp_cs.add(index == 5)
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(mem[addr + 5])), [ord('Z')])
+            self.assertEqual(solver.get_all_values(temp_cs, Operators.ORD(mem[addr + 6])), [42])
+
+        # Out of bounds ranges are enumerated, and may crash
+        offset = cs.new_bitvec(32)
+        cs.add(offset.ult(4))
+        with self.assertRaises(InvalidSymbolicMemoryAccess):
+            mem.read(addr + 0xffe + offset, 1, strategy='array')
+
+        with self.assertRaises(ForkMemoryAddress):
+            mem.read(addr + index, 1, strategy='fork')
+        cs.add(index == 9)
+        self.assertEqual(len(mem.read(addr + index, 1, strategy='fork')), 1)
+
     def test_mem_basic_trace(self):
         cs = ConstraintSet()
         mem = SMemory32(cs)
@@ -18,6 +18,12 @@ class ExpressionTest(unittest.TestCase):
     def tearDown(self):
         del self.solver
 
+    def test_single_operand_concat(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        cs.add(a.ult(3))
+        self.assertItemsEqual(self.solver.get_all_values(cs, BitVecConcat(8, a)), [0, 1, 2])
+
     def test_no_variable_expression_can_be_true(self):
         """
         Tests if solver.can_be_true is correct when the expression has no nodes that subclass
@@ -56,12 +62,127 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue('SOURCE2' in c.taint)
 
 
+    def testInterning(self):
+        import pickle
+        from manticore.utils.helpers import taint_with
+        a = BitVecVariable(32, 'VAR')
+        b = BitVecConstant(32, 100)
+        c = a + b
+
+        # Structurally equal expressions are the same object
+        self.assertIs(BitVecConstant(32, 100), b)
+        self.assertIs(BitVecAdd(a, BitVecConstant(32, 100)), c)
+        self.assertIs(Operators.EXTRACT(c, 8, 8), Operators.EXTRACT(c, 8, 8))
+        self.assertIsNot(BitVecVariable(32, 'VAR'), a)
+        self.assertIsNot(BitVecConstant(32, 100, taint=('SOURCE',)), b)
+        self.assertFalse(hasattr(c, '__dict__'))
+
+        # Tainting rebuilds instead of changing the shared expression
+        d = taint_with(c, 'SOURCE')
+        self.assertIsNot(d, c)
+        self.assertEqual(d.taint, frozenset(['SOURCE']))
+        self.assertEqual(c.taint, frozenset())
+
+        # Unpickled expressions are interned again
+        e = pickle.loads(pickle.dumps(Operators.EXTRACT(b, 0, 8), 2))
+        self.assertIs(e, Operators.EXTRACT(b, 0, 8))
+        self.assertEqual((e.begining, e.end, e.size), (0, 7, 8))
+
     def testBasicConstraints(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
         b = cs.new_bitvec(32)
         cs.add(a + b > 100)
 
+    def testRelatedConstraints(self):
+        cs = ConstraintSet()
+        a, b, c, d = [cs.new_bitvec(32) for _ in range(4)]
+        ab = a + b > 100
+        cs.add(ab)
+        cs.add(c == 5)
+        self.assertItemsEqual(map(id, cs.related_to(a == 1)), [id(ab)])
+
+        # A child set relates through the constraints of its parent
+        with cs as child:
+            bc = b > c
+            child.add(bc)
+            self.assertItemsEqual(map(id, child.related_to(a == 1)), map(id, [ab, bc, c == 5]))
+            self.assertItemsEqual(map(id, child.related_to(d == 1)), [])
+            self.assertItemsEqual(map(id, cs.related_to(a == 1)), [id(ab)])
+
+            # Once it has many constraints of its own it indexes them too
+            for i in range(20):
+                child.add(d != i)
+            self.assertEqual(len(child.related_to(d == 1)), 20)
+            self.assertEqual(len(child.related_to(c == 1)), 3)
+            child.add(False)
+            self.assertEqual(len(child.related_to(d == 1)), 1)
+
+        cs.add(b == d)
+        self.assertItemsEqual(map(id, cs.related_to(d == 1)), map(id, [ab, b == d]))
+
+    def testToString(self):
+        cs = ConstraintSet()
+        a, b = cs.new_bitvec(32), cs.new_bitvec(32)
+        cs.add(a + b > 100)
+        text = cs.to_string()
+        self.assertEqual(str(cs), text)
+
+        # A child set reuses the translations of its parent
+        with cs as child:
+            child.add(a > 5)
+            child.add(b == 3)
+            child_text = child.to_string()
+            for line in text.splitlines():
+                self.assertIn(line, child_text)
+            self.assertEqual(child_text.count('\n(assert'), 3)
+            self.assertFalse(self.solver.can_be_true(child, a < 90))
+        self.assertEqual(cs.to_string(), text)
+        self.assertTrue(self.solver.can_be_true(cs, a < 90))
+
+    def testEvaluate(self):
+        from manticore.core.smtlib.visitors import evaluate
+        a = BitVecVariable(8, 'a')
+        b = BitVecVariable(8, 'b')
+        assignment = {a: 0xf0, b: 0}
+        self.assertEqual(evaluate(a + 0x20, assignment), 0x10)
+        self.assertEqual(evaluate(a / b, assignment), 1)
+        self.assertEqual(evaluate(Operators.UDIV(a, b), assignment), 0xff)
+        self.assertEqual(evaluate(Operators.SAR(8, a, 2), assignment), 0xfc)
+        self.assertEqual(evaluate(Operators.SEXTEND(a, 8, 16), assignment), 0xfff0)
+        self.assertEqual(evaluate(Operators.EXTRACT(Operators.CONCAT(16, a, b), 4, 8), assignment), 0)
+        self.assertTrue(evaluate(a < b, assignment))
+        self.assertFalse(evaluate(a.ult(b), assignment))
+        self.assertIsNone(evaluate(a + BitVecVariable(8, 'c'), assignment))
+
+    def testModel(self):
+        cs = ConstraintSet()
+        a, b = cs.new_bitvec(32), cs.new_bitvec(32)
+        cs.add(a.ult(10))
+        cs.add(b == a + 1)
+        self.assertFalse(cs.model_satisfies(b.ugt(0)))
+        self.assertTrue(self.solver.check(cs))
+        self.assertTrue(cs.model_satisfies(b.ugt(0)))
+        self.assertFalse(cs.model_satisfies(b == 0))
+
+        with cs as child:
+            # The model still satisfies the new constraint, no solver involved
+            child.add(b.ult(11))
+            misses = self.solver.cache.misses
+            self.assertTrue(self.solver.can_be_true(child, b.ugt(0)))
+            self.assertEqual(self.solver.cache.misses, misses)
+
+            # Only the constraints related to the query get a new model
+            c = child.new_bitvec(32)
+            child.add(c == 5)
+            child.add(a == 3)
+            self.assertFalse(child.model_satisfies(b == 4))
+            self.assertTrue(self.solver.can_be_true(child, b == 4))
+            self.assertFalse(child.model_satisfies(c == 5))
+            self.assertTrue(self.solver.can_be_true(child, c.ult(6)))
+            self.assertTrue(child.model_satisfies(b == 4))
+            self.assertTrue(child.model_satisfies(c == 5))
+
     def testSolver(self):
         cs =  ConstraintSet()
         a = cs.new_bitvec(32)
@@ -221,6 +342,51 @@ class ExpressionTest(unittest.TestCase):
         # It should not be another solution for index
         self.assertFalse(self.solver.check(cs))
 
+    def testArrayConcreteOverlay(self):
+        import pickle
+        cs = ConstraintSet()
+        array = cs.new_array(index_bits=32, name='buffer')
+        key = cs.new_bitvec(32, name='key')
+        for i in range(1000):
+            array[i] = i & 0xff
+
+        # Concrete stores stay out of the store chain until it is needed
+        array = pickle.loads(pickle.dumps(array))
+        array[1000] = 1
+        self.assertEqual(len(array.written), 1001)
+        self.assertIs(array[999], BitVecConstant(8, 999 & 0xff))
+        self.assertEqual(get_depth(array[1]), 1)
+
+        # Later symbolic stores may alias a concrete read
+        array[key] = 0x41
+        cs.add(array[7] == 0x41)
+        self.assertEqual(self.solver.get_all_values(cs, key), [7])
+        array[7] = 3
+        self.assertIs(array[7], BitVecConstant(8, 3))
+        self.assertTrue(self.solver.can_be_true(cs, array.select(key) == 3))
+
+    def testArrayConcreteOverlayTaint(self):
+        import pickle
+        cs = ConstraintSet()
+        array = cs.new_array(index_max=32)
+        array[0] = BitVecConstant(8, 1, taint=('T',))
+        # The pending stores count before they reach the store chain
+        self.assertEqual(array.taint, frozenset(['T']))
+        array = pickle.loads(pickle.dumps(array))
+        array[1] = BitVecConstant(8, 2, taint=('U',))
+        self.assertEqual(ArrayProxy(array).taint, frozenset(['T', 'U']))
+        array.array
+        self.assertEqual(array.taint, frozenset(['T', 'U']))
+
+    def testArraySlicePickle(self):
+        import pickle
+        cs = ConstraintSet()
+        array = cs.new_array(index_max=32)
+        array[3] = 0x41
+        sliced = pickle.loads(pickle.dumps(array[2:6]))
+        self.assertEqual(len(sliced), 4)
+        self.assertEqual(self.solver.get_value(cs, sliced[1]), 0x41)
+
     def testBasicPickle(self):
         import pickle
         cs =  ConstraintSet()
@@ -267,6 +433,45 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(self.solver.check(cs))
         self.assertEqual(self.solver.get_value(cs, a), 1)
 
+    def testBitvector_get_values(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        b = cs.new_bitvec(8)
+        c = Operators.EXTRACT(b, 0, 1)
+        flag = cs.new_bool()
+        buf = cs.new_array(index_max=3, name='buf')
+        cs.add(a + b == 10)
+        cs.add(a.ult(3))
+        cs.add(flag == (a == b))
+        cs.add(buf[0] == a)
+        cs.add(buf[2] == ord('Z'))
+        values = self.solver.get_values(cs, [a, 'X', b, c, flag, buf, 7])
+        a_value, x, b_value, c_value, flag_value, buf_value, seven = values
+        # All the values come from the same model
+        self.assertEqual((a_value + b_value) & 0xff, 10)
+        self.assertTrue(a_value < 3)
+        self.assertEqual(c_value, b_value & 1)
+        self.assertEqual(flag_value, a_value == b_value)
+        self.assertIsInstance(buf_value, bytearray)
+        self.assertEqual(buf_value[0], a_value)
+        self.assertEqual(buf_value[2], ord('Z'))
+        self.assertEqual((x, seven), ('X', 7))
+        self.assertEqual(self.solver.get_values(cs, []), [])
+
+        cs.add(a == 200)
+        self.assertRaises(SolverException, self.solver.get_values, cs, [a])
+
+    def testBitvector_can_be_true_many(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        cs.add(a.ult(10))
+        checks = [a == 3, a == 10, True, False, a.ult(1), Operators.AND(a == 1, a == 2)]
+        self.assertEqual(self.solver.can_be_true_many(cs, checks),
+                         [True, False, True, False, True, False])
+        # The session is still usable after the pipelined checks
+        self.assertEqual(self.solver.min(cs, a), 0)
+        self.assertEqual(self.solver.can_be_true_many(cs, []), [])
+
     def testBitvector_max(self):
         cs = ConstraintSet()
         a = cs.new_bitvec(32)
@@ -353,6 +558,43 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(get_depth(exp) < 4)
         self.assertEqual(translate_to_smtlib(exp), '(bvand V_1 #x00000001)')
 
+    def test_simplify_rewrites(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32, name='A')
+        b = cs.new_bitvec(8, name='B')
+        c = cs.new_bool(name='C')
+
+        # Extract/concat towers collapse back to the original bytes
+        bytes_ = [Operators.EXTRACT(a, offset, 8) for offset in range(24, -8, -8)]
+        self.assertIs(simplify(Operators.CONCAT(32, *bytes_)), a)
+        tower = Operators.CONCAT(40, b, Operators.ZEXTEND(a, 32))
+        self.assertIs(simplify(Operators.EXTRACT(tower, 8, 16)), simplify(Operators.EXTRACT(a, 8, 16)))
+        self.assertIs(simplify(Operators.EXTRACT(tower, 32, 8)), b)
+        self.assertIs(simplify(Operators.EXTRACT(Operators.EXTRACT(a, 8, 16), 8, 8)),
+                      simplify(Operators.EXTRACT(a, 16, 8)))
+        zext = simplify(Operators.ZEXTEND(Operators.ZEXTEND(b, 16), 32))
+        self.assertEqual(translate_to_smtlib(zext), '((_ zero_extend 24) B_2)')
+        self.assertIs(simplify(Operators.EXTRACT(zext, 0, 8)), b)
+        self.assertEqual(simplify(Operators.EXTRACT(zext, 8, 8)).value, 0)
+
+        # ITE folding and comparison normalization
+        ite = BitVecITE(32, c, BitVecConstant(32, 1), BitVecConstant(32, 0))
+        self.assertIs(simplify(ite == 1), c)
+        self.assertEqual(translate_to_smtlib(simplify(ite == 0)), '(not C_3)')
+        self.assertIs(simplify(BitVecITE(32, BoolNot(c), a, a)), a)
+        self.assertEqual(translate_to_smtlib(simplify(Operators.ULT(5, a))), '(bvugt A_1 #x00000005)')
+        self.assertEqual(translate_to_smtlib(simplify(BoolNot(Operators.ULT(a, 5)))), '(bvuge A_1 #x00000005)')
+        self.assertFalse(simplify(Operators.ULT(a, 0)).value)
+        self.assertFalse(simplify(Operators.ZEXTEND(b, 32) == 0x100).value)
+
+        # Constants fold with the smtlib semantics and keep their taint
+        x = BitVecConstant(8, 0xfe, taint=('signed',))
+        folded = simplify(x < 1)
+        self.assertTrue(folded.value)
+        self.assertItemsEqual(folded.taint, ('signed',))
+        self.assertEqual(simplify(BitVecNot(x)).value, 1)
+        self.assertItemsEqual(simplify(b * x * 0).taint, ('signed',))
+
     def test_ORD(self):
         cs = ConstraintSet()
         a = cs.new_bitvec(8)
@@ -502,6 +744,22 @@ class ExpressionTest(unittest.TestCase):
             self.assertEqual(solver.get_value(cs, c), Operators.SAR(32, A, B))
 
 
+    def test_add_true(self):
+        cs = ConstraintSet()
+        x = cs.new_bitvec(8)
+        cs.add(x == 1)
+        # A concrete check adds nothing
+        cs.add(True)
+        self.assertEqual(len(cs), 1)
+        # but is rejected like any other constraint while a child is alive
+        with cs as child:
+            with self.assertRaises(Exception):
+                cs.add(True)
+            child.add(True)
+            self.assertEqual(len(child), 1)
+        cs.add(True)
+        self.assertEqual(len(cs), 1)
+
     def test_ConstraintsForking(self):
         import pickle
         cs =  ConstraintSet()
@@ -738,6 +996,236 @@ class ExpressionTest(unittest.TestCase):
         self.assertTrue(solver.check(cs))
         self.assertEqual(solver.get_value(cs, a), -7&0xFF)
 
+class IncrementalExpressionTest(ExpressionTest):
+    ''' Same tests but reusing a live incremental solver session '''
+
+    def setUp(self):
+        self.solver = Z3Solver(incremental=True)
+
+    def test_incremental_reuses_prefix(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ugt(10))
+        cs.add(a.ult(100))
+        cs.add(b == a + 1)
+        self.assertTrue(self.solver.can_be_true(cs, a == 11))
+        proc = self.solver._proc
+        asserted = [c for c, _ in self.solver._asserted]
+        self.assertEqual(asserted[:3], list(cs.constraints))
+
+        with cs as temp_cs:
+            temp_cs.add(b.ult(13))
+            self.assertEqual(self.solver.get_all_values(temp_cs, a), [11])
+            self.assertFalse(self.solver.can_be_true(temp_cs, a == 12))
+
+        # Same process, the shared prefix was never popped
+        self.assertIs(self.solver._proc, proc)
+        self.assertTrue(self.solver.can_be_true(cs, a == 12))
+        self.assertEqual(self.solver.min(cs, b), 12)
+        self.assertEqual(self.solver.get_value(cs, b - a), 1)
+        self.assertEqual([c for c, _ in self.solver._asserted][:3], asserted[:3])
+
+    def test_incremental_unpickled_constraints(self):
+        import pickle
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        # Translated with a let binding
+        cs.add((a + 1).ule(3))
+        self.assertItemsEqual(self.solver.get_all_values(cs, a), [0, 1, 2, 0xff])
+        declared = self.solver._declared[0]
+        a, cs = pickle.loads(pickle.dumps((a, cs)))
+        self.solver.cache.clear()
+        self.assertItemsEqual(self.solver.get_all_values(cs, a), [0, 1, 2, 0xff])
+        self.assertIs(self.solver._asserted[0][0], cs.constraints[0])
+        # Its level was kept, not popped and pushed again
+        self.assertIs(self.solver._declared[0], declared)
+
+    def test_new_solver_is_incremental(self):
+        module = importlib.import_module('manticore.core.smtlib.solver')
+        use_native_solver = module.use_native_solver
+        module.use_native_solver = False
+        try:
+            self.assertTrue(new_solver().incremental)
+            self.assertFalse(new_solver(incremental=False).incremental)
+        finally:
+            module.use_native_solver = use_native_solver
+
+
+@unittest.skipIf(z3 is None, 'z3 python bindings not installed')
+class NativeExpressionTest(ExpressionTest):
+    ''' Same tests through the z3 python bindings '''
+
+    def setUp(self):
+        self.solver = Z3NativeSolver()
+
+    def test_terms_are_reused(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        cs.add(a.ugt(10))
+        self.assertTrue(self.solver.can_be_true(cs, a == 11))
+        term = self.solver._terms[cs.constraints[0]]
+        # The constraint is not translated again
+        self.assertFalse(self.solver.can_be_true(cs, a == 10))
+        self.assertIs(self.solver._terms[cs.constraints[0]], term)
+        self.assertEqual(self.solver.minmax(cs, a), (11, 0xffffffff))
+
+
+class SolverPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.solver = SolverPool(size=3)
+
+    def test_checks_are_spread(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ult(100))
+        cs.add(b == a * 2)
+        checks = [b == i for i in range(8)]
+        self.assertEqual(self.solver.can_be_true_many(cs, checks),
+                         [i % 2 == 0 for i in range(8)])
+        self.assertEqual(len(self.solver._solvers), 3)
+        procs = [s._proc for s in self.solver._solvers]
+        self.assertEqual(len(set(procs)), 3)
+
+        # Cached answers are not asked again
+        misses = self.solver.cache.misses
+        self.assertEqual(self.solver.can_be_true_many(cs, checks[:4]), [True, False, True, False])
+        self.assertEqual(self.solver.cache.misses, misses)
+
+        # The processes are kept for the next batches
+        self.assertEqual(self.solver.can_be_true_many(cs, [a == i for i in range(6)]), [True] * 6)
+        self.assertEqual([s._proc for s in self.solver._solvers], procs)
+
+    @unittest.skipIf(z3 is None, 'z3 python bindings not installed')
+    def test_native_members(self):
+        pool = SolverPool(size=3, factory=Z3NativeSolver)
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        cs.add(a.ult(3))
+        self.assertEqual(pool.can_be_true_many(cs, [a == i for i in range(5)]),
+                         [True, True, True, False, False])
+        self.assertEqual(len(pool._solvers), 1)
+
+    def test_single_queries(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        cs.add(a.ult(3))
+        self.assertItemsEqual(self.solver.get_all_values(cs, a), [0, 1, 2])
+        self.assertEqual(self.solver.minmax(cs, a), (0, 2))
+        self.assertTrue(self.solver.check(cs))
+        self.assertIn(self.solver.get_value(cs, a), [0, 1, 2])
+        self.assertEqual(len(self.solver._solvers), 1)
+
+    def test_failed_batch_drops_process(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        self.solver.can_be_true_many(cs, [a == 1, a == 2])
+        first = self.solver._solver(0)
+        first._send('(check-sat)')  # an answer nobody will read
+        original = first._collect_checks
+
+        def broken(count):
+            raise SolverException('broken pipe')
+        first._collect_checks = broken
+        self.assertRaises(SolverException, self.solver.can_be_true_many, cs, [a == 3, a == 4])
+        self.assertIsNone(first._proc)
+        first._collect_checks = original
+        self.assertEqual(self.solver.can_be_true_many(cs, [a == 5, a.ult(0)]), [True, False])
+
+
+class SolverCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.solver = Z3Solver()
+
+    def test_fingerprint_is_structural(self):
+        a = BitVecVariable(32, 'a')
+        b = BitVecVariable(32, 'b')
+        self.assertEqual(fingerprint(a + 1 == b), fingerprint(a + 1 == b))
+        self.assertNotEqual(fingerprint(a + 1 == b), fingerprint(a + 2 == b))
+        self.assertNotEqual(fingerprint(a + 1 == b), fingerprint(b + 1 == a))
+        self.assertNotEqual(fingerprint(Operators.EXTRACT(a, 0, 8)), fingerprint(Operators.EXTRACT(a, 8, 8)))
+
+    def test_sibling_sets_share_answers(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ult(10))
+        cs.add(b.ugt(a))
+        with cs as left:
+            left.add(a != 3)
+            self.assertItemsEqual(self.solver.get_all_values(left, a), [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        misses = self.solver.cache.misses
+        with cs as right:
+            right.add(a != 3)
+            self.assertItemsEqual(self.solver.get_all_values(right, a), [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(self.solver.cache.misses, misses)
+
+    def test_unrelated_constraints_do_not_miss(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(32)
+        b = cs.new_bitvec(32)
+        cs.add(a.ult(10))
+        self.assertTrue(self.solver.can_be_true(cs, a == 9))
+        hits = self.solver.cache.hits
+        cs.add(b == 5)
+        self.assertTrue(self.solver.can_be_true(cs, a == 9))
+        self.assertEqual(self.solver.cache.hits, hits + 1)
+        self.assertFalse(self.solver.can_be_true(cs, a == 10))
+
+    def test_too_many_solutions_is_cached(self):
+        cs = ConstraintSet()
+        a = cs.new_bitvec(8)
+        self.assertEqual(len(self.solver.get_all_values(cs, a, maxcnt=3, silent=True)), 3)
+        self.assertRaises(TooManySolutions, self.solver.get_all_values, cs, a, maxcnt=3)
+
+    def test_lru_eviction(self):
+        cache = SolverCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_shared_backing(self):
+        shared = []
+        one = SolverCache(shared=shared, batch_size=2)
+        other = SolverCache(shared=shared, batch_size=2)
+        one.put('key', True)
+        # Answers are published in batches
+        self.assertEqual(shared, [])
+        other.sync()
+        self.assertIsNone(other.get('key'))
+        one.sync()
+        other.sync()
+        self.assertTrue(other.get('key'))
+        other.put('a', 1)
+        other.put('b', 2)
+        self.assertEqual(len(shared), 2)
+        one.sync()
+        self.assertEqual((one.get('a'), one.get('b')), (1, 2))
+
+        # Past max_shared answers stay local
+        full = SolverCache(shared=shared, batch_size=2, max_shared=4)
+        full.sync()
+        full.put('c', 3)
+        full.sync()
+        self.assertEqual(len(shared), 2)
+
+    def test_mutated_array_fingerprint(self):
+        cs = ConstraintSet()
+        array = cs.new_array(index_max=4)
+        digest = fingerprint(array)
+        array[0] = 1
+        self.assertNotEqual(fingerprint(array), digest)
+        self.assertEqual(fingerprint(array), fingerprint(ArrayProxy(array)))
+        slice_digest = fingerprint(array[0:2])
+        array[1] = 1
+        self.assertNotEqual(fingerprint(array[0:2]), slice_digest)
+
+
 import importlib
 class Z3Test(unittest.TestCase):
     def setUp(self):
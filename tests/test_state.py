@@ -122,6 +122,32 @@ class StateTest(unittest.TestCase):
 
         self.assertTrue(len(initial_state.constraints.declarations) == 1 )
 
+    def test_state_inherit(self):
+        constraints = ConstraintSet()
+        initial_state = State(constraints, FakePlatform())
+        arr = initial_state.symbolicate_buffer('+'*100, label='SYMBA')
+        initial_state.constrain(arr[0] > 0x41)
+        initial_state.context['visited'] = [1]
+
+        with initial_state as sibling:
+            sibling.constrain(arr[0] == 0x42)
+
+        new_state = initial_state.inherit()
+        new_state.constrain(arr[0] != 0x42)
+        new_state.context['visited'].append(2)
+
+        # Same platform, its own copy of the context, parent constraints kept
+        self.assertIs(new_state.platform, initial_state.platform)
+        self.assertIs(new_state.platform.constraints, new_state.constraints)
+        self.assertEqual(initial_state.context['visited'], [1])
+        self.assertEqual(len(new_state.constraints), 2)
+        self.assertFalse(new_state.can_be_true(arr[0] == 0x42))
+        self.assertTrue(new_state.must_be_true(arr[0] > 0x41))
+
+        # The parent may be forked again
+        with initial_state as other:
+            self.assertEqual(len(other.constraints), 1)
+
     def test_new_symbolic_buffer(self):
         length = 64
         expr = self.state.new_symbolic_buffer(length)
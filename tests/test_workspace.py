@@ -79,6 +79,76 @@ class StateTest(unittest.TestCase):
         self.assertEqual(str(state.constraints),
                          str(self.state.constraints))
 
+    def _pages(self, workspace):
+        return [key for key in workspace._store._data if key.startswith('page_')]
+
+    def test_workspace_pages_are_shared(self):
+        workspace = Workspace(self.lock, 'mem:')
+        stack = self.state.cpu.STACK
+        self.state.cpu.write_bytes(stack, 'A' * 16)
+        first = workspace.save_state(self.state)
+        pages = set(self._pages(workspace))
+        self.assertTrue(pages)
+
+        # A single dirty page
+        self.state.cpu.write_bytes(stack, 'B' * 16)
+        second = workspace.save_state(self.state)
+        self.assertEqual(len(set(self._pages(workspace)) - pages), 1)
+
+        state = workspace.load_state(first, delete=False)
+        self.assertEqual(''.join(state.cpu.read_bytes(stack, 16)), 'A' * 16)
+        state = workspace.load_state(second, delete=False)
+        self.assertEqual(''.join(state.cpu.read_bytes(stack, 16)), 'B' * 16)
+        for left, right in zip(sorted(self.state.mem._maps), sorted(state.mem._maps)):
+            self.assertEqual(left[left.start:left.end], right[right.start:right.end])
+
+        # Only the pages nobody else references go away
+        workspace.rm_state(first)
+        self.assertEqual(len(set(pages) - set(self._pages(workspace))), 1)
+        workspace.rm_state(second)
+        self.assertEqual(self._pages(workspace), [])
+
+    def test_workspace_loaded_pages_are_held(self):
+        workspace = Workspace(self.lock, 'mem:')
+        id_ = workspace.save_state(self.state)
+        pages = sorted(self._pages(workspace))
+        state = workspace.load_state(id_)
+        # The descendants of a loaded state reuse its pages
+        self.assertEqual(sorted(self._pages(workspace)), pages)
+        id_ = workspace.save_state(state)
+        self.assertEqual(sorted(self._pages(workspace)), pages)
+        workspace.load_state(id_)
+        self.assertEqual(sorted(self._pages(workspace)), pages)
+        # Until the process is done loading states
+        workspace.release_held_pages()
+        self.assertEqual(self._pages(workspace), [])
+
+    def test_workspace_reload(self):
+        store = Store.fromdescriptor('mem:')
+        workspace = Workspace(self.lock, store)
+        workspace.save_state(self.state)
+        workspace.save_state(self.state)
+        pages = self._pages(workspace)
+
+        workspace = Workspace(self.lock, store)
+        self.assertEqual(sorted(workspace.try_loading_workspace()), [0, 1])
+        workspace.rm_state(0)
+        self.assertEqual(self._pages(workspace), pages)
+        workspace.rm_state(1)
+        self.assertEqual(self._pages(workspace), [])
+
+    def test_workspace_reload_unpaged(self):
+        # States saved before they were split in pages
+        store = Store.fromdescriptor('mem:')
+        with store.save_stream('state_00000000.pkl') as f:
+            PickleSerializer().serialize(self.state, f)
+
+        workspace = Workspace(self.lock, store)
+        self.assertEqual(workspace.try_loading_workspace(), [0])
+        state = workspace.load_state(0)
+        self.assertEqual(len(state.mem._maps), len(self.state.mem._maps))
+        self.assertEqual(store.ls('*'), [])
+
     def test_workspace_id_start_with_zero(self):
         workspace = Workspace(self.lock, 'mem:')
         id_ = workspace.save_state(self.state)